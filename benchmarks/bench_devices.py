@@ -0,0 +1,73 @@
+"""
+Measures the time the playback loop spends in light calls. It calls turn_off() on both lights after every audio
+chunk, as the playback stage does. The drivers are fakes that take as long as the real calls: a serial write at
+115200 baud and a GPIO PWM stop. Compares calling the drivers directly, which is what Light and BTLight used to do,
+with queuing the commands on DeviceControllers. Also counts how often the controller wakes up while pulsing.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_devices
+"""
+import time
+
+from devices.controller import DeviceController
+from enums.light_state_enum import LightState
+
+CHUNKS = 200
+SERIAL_WRITE_TIME = 0.0003  # one byte at 115200 baud plus the syscall
+GPIO_CALL_TIME = 0.0001
+OLD_PULSE_STEP = 0.01  # Light.pulse_led used to sleep this long between duty cycle changes
+PULSE_STEP = 1.4 / 35  # devices.light: PULSE_PERIOD / PULSE_STEPS
+
+
+class FakeDriver:
+    step_interval = PULSE_STEP
+
+    def __init__(self, call_time):
+        self.call_time = call_time
+        self.applied = 0
+        self.steps = 0
+
+    def apply(self, state):
+        time.sleep(self.call_time)
+        self.applied += 1
+
+    def step(self):
+        self.steps += 1
+
+
+def playback(turn_offs):
+    """
+    :return: Seconds spent in the light calls.
+    """
+    in_calls = 0
+    for _ in range(CHUNKS):
+        start = time.perf_counter()
+        for turn_off in turn_offs:
+            turn_off()
+        in_calls += time.perf_counter() - start
+    return in_calls
+
+
+def main():
+    led, serial = FakeDriver(GPIO_CALL_TIME), FakeDriver(SERIAL_WRITE_TIME)
+    direct = playback([lambda: led.apply(LightState.OFF), lambda: serial.apply(LightState.OFF)])
+    print(f"{CHUNKS} chunks, 2 lights: direct driver calls {direct * 1000:.1f} ms in the playback loop, "
+          f"{led.applied + serial.applied} device writes")
+
+    led, serial = FakeDriver(GPIO_CALL_TIME), FakeDriver(SERIAL_WRITE_TIME)
+    controllers = [DeviceController("LED", led), DeviceController("Bluetooth", serial)]
+    for controller in controllers:
+        controller.set_state(LightState.PULSE)
+    time.sleep(1)
+    steps = led.steps
+    queued = playback([lambda c=controller: c.set_state(LightState.OFF) for controller in controllers])
+    time.sleep(0.05)
+    stats = controllers[0].stats()
+    print(f"{CHUNKS} chunks, 2 lights: controllers {queued * 1000:.1f} ms in the playback loop, "
+          f"{led.applied + serial.applied} device writes, {stats['dropped'] + controllers[1].stats()['dropped']} "
+          f"redundant commands dropped, {stats['max_call_time'] * 1e6:.0f} us slowest call")
+    print(f"pulsing: {steps} waveform steps per second (used to be {1 / OLD_PULSE_STEP:.0f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Replays a conversation through GoogleLlm against a local fake of the Gemini API and reports, per turn, the request
+payload and the client-side time spent preparing the request. The conversation is pruned and rewound part way
+through to exercise the chat session resync.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_gemini_chat [--turns 20]
+"""
+import argparse
+import os
+import time
+from types import SimpleNamespace
+
+from benchmarks.bench_hot_paths import SAMPLE_SENTENCES
+from benchmarks.fake_gemini_server import FakeGeminiServer
+from enums.role_enum import Role
+from utils.log import LogFormatter
+
+
+def replay(llm, server, turns):
+    conversation = []
+    system_msg = {"role": Role.SYSTEM, "content": " ".join(SAMPLE_SENTENCES)}
+    sessions = 0
+    for turn in range(turns):
+        if turn == turns // 2:
+            conversation = conversation[4:]  # make_room pruned the two oldest exchanges
+        if turn == turns // 2 + 2:
+            conversation = conversation[:-2]  # pop_message rewound the last exchange
+        conversation.append({"role": Role.USER, "content": SAMPLE_SENTENCES[turn % len(SAMPLE_SENTENCES)]})
+
+        chat = llm.conversation
+        start = time.perf_counter()
+        reply = ""
+        first_chunk = None
+        for chunk in llm.response_generator([system_msg] + conversation):
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - start
+            reply += chunk
+        payload, contents = server.requests[-1]
+        new_session = llm.conversation is not chat
+        sessions += new_session
+        print(f"  turn {turn + 1:>2}: {len(conversation) + 1:>3} messages, {contents:>3} contents, "
+              f"{payload:>6} bytes, first chunk after {first_chunk * 1000:.0f} ms"
+              f"{', new chat session' if new_session else ''}")
+        conversation.append({"role": Role.ASSISTANT, "content": reply})
+    return sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GoogleLlm chat session against a fake Gemini API")
+    parser.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args()
+    LogFormatter.config(level="warning")
+    os.environ.setdefault('GOOGLE_AI_API_KEY', "fake")
+
+    from clients.llm.google_llm import GoogleLlm
+
+    server = FakeGeminiServer().start()
+    llm = GoogleLlm(SimpleNamespace(temperature=1))
+    server.attach(llm.google_client)
+    sessions = replay(llm, server, args.turns)
+    print(f"{sessions} chat sessions started in {args.turns} turns")
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Exercises HedgedLlm against two local stub servers and reports which backend answered, time-to-first-token and the
+per-backend latency EWMA used for routing.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_hedging
+"""
+import time
+from types import SimpleNamespace
+
+from benchmarks.stub_llm_server import StubLlmServer
+from clients.llm.hedged_llm import HedgedLlm
+from clients.llm.local_llm import LocalLlm
+from enums.role_enum import Role
+from utils.log import LogFormatter
+
+MESSAGES = [{"role": Role.USER, "content": "Hello there"}]
+REQUESTS_PER_SCENARIO = 4
+
+
+def run_scenario(title, primary, secondary, hedge_after=0.5):
+    persona = SimpleNamespace(temperature=1)
+    client = HedgedLlm(persona, [LocalLlm(persona, url=primary.url), LocalLlm(persona, url=secondary.url)],
+                       hedge_after=hedge_after)
+    print(f"\n{title}")
+    for i in range(REQUESTS_PER_SCENARIO):
+        start = time.perf_counter()
+        first_token = None
+        text = ""
+        for chunk in client.response_generator(MESSAGES):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            text += chunk
+        print(f"  request {i + 1}: first token after {first_token * 1000:.0f} ms, "
+              f"{len(text.split())} words, ewma {client.latency_report()}")
+    print(f"  primary served {len(primary.requests)} requests ({primary.aborted} aborted), "
+          f"secondary served {len(secondary.requests)} ({secondary.aborted} aborted)")
+
+
+def main():
+    LogFormatter.config(level="warning")
+
+    slow, fast = StubLlmServer(ttft=2.0).start(), StubLlmServer(ttft=0.1).start()
+    run_scenario("Slow primary (2 s), fast secondary (0.1 s), 0.5 s hedge", slow, fast)
+
+    failing, healthy = StubLlmServer(fail_status=503).start(), StubLlmServer(ttft=0.1).start()
+    run_scenario("Failing primary, healthy secondary", failing, healthy)
+
+    for server in (slow, fast, failing, healthy):
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+"""
+Benchmarks for the helpers that run on every audio frame or every message.
+"""
+import os
+import random
+import re
+from types import SimpleNamespace
+
+from benchmarks.harness import benchmark, noted
+
+SAMPLE_SENTENCES = [
+    "The weather in Boston tomorrow looks mild, with a high of 64 degrees.",
+    "You asked me about the Second Age of Middle-earth, which began after the defeat of Morgoth.",
+    "Sure! Here are three ideas for dinner tonight: risotto, tacos, or a simple stir fry.",
+    "It is 3.14 miles from here to the station, roughly a 20 minute walk.",
+    "Would you like me to remind you about that later?",
+]
+MIC_FRAME_SAMPLES = 512  # utils.audio.FRAMES_PER_BUFFER
+POLLY_CHUNK_BYTES = 131072  # chunk size read from the polly AudioStream
+# roughly the pattern tiktoken splits text with before merging byte pairs
+TOKEN_PATTERN = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+
+_tokenizer = None  # "tiktoken" or "estimate", see _require_tokenizer()
+
+
+def _random_pcm(samples, seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    return rng.integers(-3000, 3000, samples, dtype=np.int16)
+
+
+def _synthetic_conversation(n_messages, seed=0):
+    from conversationmanager import add_timestamp
+    from enums.role_enum import Role
+
+    rng = random.Random(seed)
+    conversation = []
+    for i in range(n_messages):
+        role = Role.USER if i % 2 == 0 else Role.ASSISTANT
+        text = " ".join(rng.choice(SAMPLE_SENTENCES) for _ in range(rng.randint(1, 3)))
+        conversation.append({
+            "role": role,
+            "content": add_timestamp(text) if role == Role.USER else text,
+            "origin": "voice" if role == Role.USER else "gpt-4-1106-preview",
+            "timestamp": 1700000000.0 + i * 30,
+        })
+    return conversation
+
+
+class _EstimatedEncoding:
+    """
+    Offline stand-in for a tiktoken encoding. It splits the text the way tiktoken does before merging byte pairs,
+    so the counts are a little high but the work per character is similar.
+    """
+
+    @staticmethod
+    def encode(text):
+        return TOKEN_PATTERN.findall(text)
+
+
+def _require_tokenizer(model="gpt-4-1106-preview"):
+    """
+    Makes sure count_tokens() works. tiktoken downloads its encoding on first use; if that fails (e.g. offline), the
+    encoding is replaced with _EstimatedEncoding so the benchmarks still run.
+    :return: The tokenizer in use, "tiktoken" or "estimate". Results measured with the estimate are noted as such,
+    so they aren't compared against tiktoken results.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        import conversationmanager
+        try:
+            conversationmanager.count_tokens("", model)
+            _tokenizer = "tiktoken"
+        except Exception as e:
+            print(f"  tiktoken unavailable ({type(e).__name__}); estimating tokens")
+            conversationmanager.encoding_for_model = lambda _model: _EstimatedEncoding()
+            _tokenizer = "estimate"
+    return _tokenizer
+
+
+def _conversation_manager(n_messages, max_context_tokens=2048, max_response_tokens=200, count=True):
+    """
+    Builds a ConversationManager without touching the disk or creating an LLM client.
+    :param count: Whether to count the tokens of the conversation, which needs the tokenizer.
+    """
+    import threading
+    from conversation_history import ConversationHistory
+    from conversationmanager import ConversationManager, count_tokens, message_tokens
+    from enums.role_enum import Role
+    from message import Message
+
+    manager = ConversationManager.__new__(ConversationManager)
+    manager.persona = SimpleNamespace(name="Benchmark")
+    manager.llm_client = SimpleNamespace(model="gpt-4-1106-preview", token_model="gpt-4-1106-preview",
+                                         max_context_tokens=max_context_tokens,
+                                         max_response_tokens=max_response_tokens, release_caches=lambda: None)
+    manager.system_msg = {"role": Role.SYSTEM, "content": " ".join(SAMPLE_SENTENCES)}
+    manager._history = ConversationHistory(Message.from_dict(m) for m in _synthetic_conversation(n_messages))
+    manager.suspended = None
+    manager.suspend_lock = threading.Lock()
+    manager.prompt_history = None
+    manager.pkl_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "no_history.pkl")  # never written
+    manager.history_offsets = []
+    manager.total_tokens = 0
+    if count:
+        _require_tokenizer(manager.llm_client.token_model)
+        manager.total_tokens = count_tokens(manager.system_msg['content'], manager.llm_client.token_model) + sum(
+            message_tokens(m, manager.llm_client.token_model) for m in manager.conversation)
+    return manager
+
+
+@benchmark("audio.resample_audio[mic_frame_16k_16k]", group="audio")
+def bench_resample_mic_frame():
+    from utils.resampling import resample_audio
+    frame = _random_pcm(MIC_FRAME_SAMPLES).tobytes()
+    return lambda: resample_audio(frame, 16000, 16000)
+
+
+@benchmark("audio.resample_audio[polly_chunk_16k_48k]", group="audio")
+def bench_resample_tts_chunk():
+    from utils.resampling import resample_audio
+    chunk = _random_pcm(POLLY_CHUNK_BYTES // 2).tobytes()
+    return lambda: resample_audio(chunk, 16000, 48000)
+
+
+@benchmark("audio.convert_frame_length[porcupine_512]", group="audio")
+def bench_convert_frame_length():
+    from utils.resampling import convert_frame_length
+    frame = _random_pcm(MIC_FRAME_SAMPLES)  # wait_for_wake_word passes the samples read from the capture
+    return lambda: convert_frame_length(frame, MIC_FRAME_SAMPLES)
+
+
+@benchmark("conversation.count_tokens[short]", group="conversation")
+def bench_count_tokens_short():
+    from conversationmanager import count_tokens
+    return noted(lambda: count_tokens(SAMPLE_SENTENCES[4], "gpt-4-1106-preview"), _require_tokenizer())
+
+
+@benchmark("conversation.count_tokens[long]", group="conversation")
+def bench_count_tokens_long():
+    from conversationmanager import count_tokens
+    text = " ".join(SAMPLE_SENTENCES * 10)
+    return noted(lambda: count_tokens(text, "gpt-4-1106-preview"), _require_tokenizer())
+
+
+@benchmark("conversation.make_room[prune_200]", group="conversation")
+def bench_make_room():
+    from conversation_history import ConversationHistory
+    manager = _conversation_manager(200)
+    messages = list(manager.conversation)
+    total_tokens = manager.total_tokens
+
+    def run():
+        manager._history = ConversationHistory(messages)
+        manager.total_tokens = total_tokens
+        manager.make_room(silent=True)
+
+    return noted(run, _require_tokenizer())
+
+
+@benchmark("conversation.get_conversation[50]", group="conversation")
+def bench_get_conversation_50():
+    manager = _conversation_manager(50, count=False)
+    return lambda: manager.get_conversation()
+
+
+@benchmark("conversation.get_conversation[1000]", group="conversation")
+def bench_get_conversation_1000():
+    manager = _conversation_manager(1000, count=False)
+    return lambda: manager.get_conversation()
+
+
+def _bench_turn(n_messages):
+    """
+    One turn's prompt work: the user message is appended, get_conversation() renders the prompt and the LLM client
+    converts it. The message is popped again so every round sees the same history.
+    """
+    from clients.llm.gpt_llm import convert_message
+    from clients.llm.prompt_builder import PromptBuilder
+    from enums.role_enum import Role
+
+    tokenizer = _require_tokenizer()
+    manager = _conversation_manager(n_messages, max_context_tokens=10 ** 9, count=False)
+    builder = PromptBuilder(convert_message)
+    builder.build(manager.get_conversation(), bump=True)
+
+    def run():
+        manager.append_message(Role.USER, SAMPLE_SENTENCES[4], silent=True)
+        manager.make_room(silent=True)
+        builder.build(manager.get_conversation(), bump=True)
+        manager.pop_message()
+
+    return noted(run, tokenizer)
+
+
+# the cost of a turn doesn't depend on how long the conversation is
+@benchmark("conversation.turn[200]", group="conversation")
+def bench_turn_200():
+    return _bench_turn(200)
+
+
+@benchmark("conversation.turn[1000]", group="conversation")
+def bench_turn_1000():
+    return _bench_turn(1000)
+
+
+@benchmark("conversation.turn[5000]", group="conversation")
+def bench_turn_5000():
+    return _bench_turn(5000)
+
+
+@benchmark("conversation.resume[200]", group="conversation")
+def bench_resume():
+    manager = _conversation_manager(200, count=False)
+
+    # an inactive persona's conversation is suspended; switching back to it rehydrates it on first access
+    def run():
+        manager.suspend()
+        len(manager.conversation)
+
+    return run
+
+
+def _bench_history_turn(n_messages, chunked):
+    """
+    One turn on a full history: append a message and prune the oldest, as append_message() and make_room() do.
+    """
+    from conversation_history import ConversationHistory
+    messages = _synthetic_conversation(n_messages)
+    if not chunked:
+        history = list(messages)  # what ConversationManager.conversation used to be
+        return lambda: history.append(history.pop(0))
+    history = ConversationHistory(messages)
+    return lambda: history.append(history.popleft())
+
+
+@benchmark("conversation.history_turn[list_10000]", group="conversation")
+def bench_history_turn_list():
+    return _bench_history_turn(10000, chunked=False)
+
+
+@benchmark("conversation.history_turn[chunked_10000]", group="conversation")
+def bench_history_turn_chunked():
+    return _bench_history_turn(10000, chunked=True)
+
+
+@benchmark("conversation.history_snapshot[last_50_of_10000]", group="conversation")
+def bench_history_snapshot():
+    from conversation_history import ConversationHistory
+    history = ConversationHistory(_synthetic_conversation(10000))
+    return lambda: history.snapshot()[-50:]
+
+
+@benchmark("conversation.remove_timestamp", group="conversation")
+def bench_remove_timestamp():
+    from conversationmanager import add_timestamp, remove_timestamp
+    text = add_timestamp(SAMPLE_SENTENCES[0])
+    return lambda: remove_timestamp(text)
+
+
+@benchmark("preprocessing.preprocess[query]", group="preprocessing")
+def bench_preprocess_query():
+    from preprocessing import preprocess
+    return lambda: preprocess("What is the tallest mountain in South America?")
+
+
+@benchmark("preprocessing.preprocess[time]", group="preprocessing")
+def bench_preprocess_time():
+    from preprocessing import preprocess
+    return lambda: preprocess("What time is it?")
+
+
+@benchmark("pipeline.sentence_regex[response]", group="pipeline")
+def bench_sentence_regex():
+    from pipeline.segmenter import SentenceSegmenter
+
+    # replay a response the way the LLM streams it: a few characters per chunk
+    response = " ".join(SAMPLE_SENTENCES)
+    chunks = [response[i:i + 4] for i in range(0, len(response), 4)]
+
+    def run():
+        segmenter = SentenceSegmenter()
+        for chunk in chunks:
+            segmenter.feed(chunk)
+        segmenter.flush()
+
+    return run
+
+
+@benchmark("pipeline.turn_setup[threads_per_turn]", group="pipeline")
+def bench_turn_setup_threads():
+    import threading
+
+    # what run_response_pipeline used to do on every turn: create, start and join four threads
+    def run():
+        threads = [threading.Thread(target=lambda: None, daemon=True) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return run
+
+
+@benchmark("pipeline.turn_setup[persistent_workers]", group="pipeline")
+def bench_turn_setup_persistent():
+    import threading
+    from pipeline.channel import Channel
+    from pipeline.messages import Turn
+
+    # dispatching a turn to four persistent stages that acknowledge it
+    inboxes = [Channel(f"stage{i}") for i in range(4)]
+    acks = Channel("acks")
+
+    def stage(inbox):
+        while True:
+            acks.put(inbox.get())
+
+    for inbox in inboxes:
+        threading.Thread(target=stage, args=(inbox,), daemon=True).start()
+
+    def run():
+        turn = Turn(question_text="")
+        for inbox in inboxes:
+            inbox.put(turn)
+        for _ in inboxes:
+            acks.get()
+
+    return run
+
+
+@benchmark("pipeline.cancel_wakeup[channel]", group="pipeline")
+def bench_cancel_wakeup():
+    import threading
+    from pipeline.cancellation import Cancelled, CancellationToken
+    from pipeline.channel import Channel
+
+    # start a stage blocked on an empty channel, cancel it and wait until it has woken up
+    channel = Channel("empty")
+
+    def run():
+        token = CancellationToken()
+        woke = threading.Event()
+
+        def blocked():
+            try:
+                channel.get(token)
+            except Cancelled:
+                woke.set()
+
+        thread = threading.Thread(target=blocked, daemon=True)
+        thread.start()
+        token.cancel("benchmark")
+        woke.wait()
+        thread.join()
+
+    return run
+
+
+@benchmark("llm.google_llm.update_roles[50]", group="llm")
+def bench_update_roles():
+    from clients.llm.google_llm import update_roles
+    from enums.role_enum import Role
+    messages = [{"role": Role.SYSTEM, "content": " ".join(SAMPLE_SENTENCES)}] + _synthetic_conversation(50)
+    return lambda: update_roles(messages)
+
+
+def _prompt_turns(n_messages):
+    """
+    :return: Function returning the prompt of the next turn: the same history plus a new user message, the way
+    get_conversation hands it to the LLM client.
+    """
+    from clients.llm.prompt_builder import Prompt, new_generation
+    from conversationmanager import add_timestamp
+    from enums.role_enum import Role
+
+    system_msg = {"role": Role.SYSTEM, "content": " ".join(SAMPLE_SENTENCES)}
+    history = _synthetic_conversation(n_messages)
+    generation = new_generation()
+    return lambda: Prompt(system_msg, history + [{"role": Role.USER, "content": add_timestamp(SAMPLE_SENTENCES[4])}],
+                          generation, 0)
+
+
+def _bench_prompt(n_messages, build):
+    next_prompt = _prompt_turns(n_messages)
+    return lambda: build(next_prompt())
+
+
+@benchmark("llm.prompt[gpt_rebuild_1000]", group="llm")
+def bench_prompt_gpt_rebuild():
+    # what GptLlm used to do on every turn
+    return _bench_prompt(1000, lambda messages: [{'content': d['content'], 'role': d['role'].__str__()}
+                                                 for d in messages])
+
+
+@benchmark("llm.prompt[gpt_cached_1000]", group="llm")
+def bench_prompt_gpt_cached():
+    from clients.llm.gpt_llm import convert_message
+    from clients.llm.prompt_builder import PromptBuilder
+    return _bench_prompt(1000, PromptBuilder(convert_message).build)
+
+
+@benchmark("llm.prompt[local_rebuild_1000]", group="llm")
+def bench_prompt_local_rebuild():
+    import json
+    from enums.role_enum import Role
+
+    # what LocalLlm used to do on every turn
+    def build(messages):
+        messages = [{'role': 'bot', 'content': message['content'] + "</s>"} if message['role'] == Role.ASSISTANT
+                    else {'role': str(message['role']), 'content': message['content']} for message in messages]
+        return json.dumps({"messages": messages})
+
+    return _bench_prompt(1000, build)
+
+
+@benchmark("llm.prompt[local_cached_1000]", group="llm")
+def bench_prompt_local_cached():
+    from clients.llm.local_llm import request_body, serialize_message
+    from clients.llm.prompt_builder import PromptBuilder
+    builder = PromptBuilder(serialize_message)
+    return _bench_prompt(1000, lambda messages: request_body(builder.build(messages)))
+
+
+@benchmark("llm.prompt[local_rebuild_5000]", group="llm")
+def bench_prompt_local_rebuild_5000():
+    import json
+    from enums.role_enum import Role
+
+    def build(messages):
+        messages = [{'role': 'bot', 'content': message['content'] + "</s>"} if message['role'] == Role.ASSISTANT
+                    else {'role': str(message['role']), 'content': message['content']} for message in messages]
+        return json.dumps({"messages": messages})
+
+    return _bench_prompt(5000, build)
+
+
+@benchmark("llm.prompt[local_cached_5000]", group="llm")
+def bench_prompt_local_cached_5000():
+    from clients.llm.local_llm import request_body, serialize_message
+    from clients.llm.prompt_builder import PromptBuilder
+    builder = PromptBuilder(serialize_message)
+    return _bench_prompt(5000, lambda messages: request_body(builder.build(messages)))
+
+
+@benchmark("llm.prompt[google_rebuild_1000]", group="llm")
+def bench_prompt_google_rebuild():
+    from clients.llm.google_llm import update_roles
+    return _bench_prompt(1000, update_roles)
+
+
+@benchmark("llm.prompt[google_cached_1000]", group="llm")
+def bench_prompt_google_cached():
+    from clients.llm.google_llm import convert_message
+    from clients.llm.prompt_builder import PromptBuilder
+    builder = PromptBuilder(convert_message)
+    return _bench_prompt(1000, lambda messages: [m for converted in builder.build(messages) for m in converted])
@@ -0,0 +1,58 @@
+"""
+Measures the prefill the local LLM server saves when LocalLlm uses sessions. A stub server charges prompt processing
+time per uncached character; the same conversation is replayed with and without a session, and the server's cache is
+dropped halfway through the session run to exercise the full-resend fallback.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_local_session [--turns 30] [--prefill-per-kchar 0.02]
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+from benchmarks.bench_hot_paths import SAMPLE_SENTENCES
+from benchmarks.stub_llm_server import StubLlmServer
+from clients.llm.local_llm import LocalLlm
+from enums.role_enum import Role
+from utils.log import LogFormatter
+
+
+def replay(server, turns, session):
+    client = LocalLlm(SimpleNamespace(temperature=1, name="bench"), url=server.url, session=session)
+    conversation = [{"role": Role.SYSTEM, "content": " ".join(SAMPLE_SENTENCES)}]
+    prefill_chars, misses = server.prefill_chars, server.cache_misses
+    ttfts = []
+    for turn in range(turns):
+        if session and turn == turns // 2:
+            server.clear_sessions()
+        conversation.append({"role": Role.USER, "content": SAMPLE_SENTENCES[turn % len(SAMPLE_SENTENCES)]})
+        start = time.perf_counter()
+        reply = ""
+        for chunk in client.response_generator(list(conversation)):
+            if chunk and not reply:
+                ttfts.append(time.perf_counter() - start)
+            reply += chunk
+        conversation.append({"role": Role.ASSISTANT, "content": reply})
+    return server.prefill_chars - prefill_chars, server.cache_misses - misses, ttfts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefill with and without LocalLlm sessions")
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--prefill-per-kchar", type=float, default=0.02,
+                        help="seconds of prompt processing per 1000 uncached characters")
+    args = parser.parse_args()
+    LogFormatter.config(level="warning")
+
+    server = StubLlmServer(ttft=0.05, token_delay=0, prefill_per_kchar=args.prefill_per_kchar).start()
+    print(f"{args.turns} turns, {args.prefill_per_kchar * 1000:.0f} ms prefill per 1000 characters")
+    for session in (False, True):
+        chars, misses, ttfts = replay(server, args.turns, session)
+        print(f"  {'session' if session else 'full resend':>11}: {chars} characters prefilled, "
+              f"{misses} cache misses, first token after {ttfts[0] * 1000:.0f} ms (turn 1) / "
+              f"{ttfts[-1] * 1000:.0f} ms (turn {args.turns}), total {sum(ttfts):.2f} s")
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
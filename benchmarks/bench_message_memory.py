@@ -0,0 +1,66 @@
+"""
+Measures the memory of a long history held as the old message dictionaries and as Message records. Each message is
+pickled on its own as a dictionary, as in the pkl history file, and loaded back the way load_conversation() does, so
+strings that repeat in every message (keys, origins) are separate objects unless they are interned.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_message_memory [messages]
+"""
+import gc
+import io
+import pickle
+import sys
+import time
+import tracemalloc
+
+from benchmarks.bench_hot_paths import _synthetic_conversation
+from message import Message
+
+MESSAGES = 100000
+
+
+def load_all(data, convert):
+    messages = []
+    with io.BytesIO(data) as f:
+        while True:
+            try:
+                messages.append(convert(pickle.load(f)))
+            except EOFError:
+                return messages
+
+
+def measure(data, convert):
+    """
+    :param convert: Function applied to every loaded dictionary.
+    :return: Tuple of the bytes held by the loaded messages and the seconds it took to load them.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    loaded = load_all(data, convert)
+    load_time = time.perf_counter() - start
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+    return held, load_time
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    dicts = _synthetic_conversation(count)
+    content_bytes = sum(sys.getsizeof(message['content']) for message in dicts)
+    with io.BytesIO() as f:
+        for message in dicts:
+            pickle.dump(Message.from_dict(message).as_dict(), f)
+        data = f.getvalue()
+
+    print(f"{count} messages ({content_bytes / 2 ** 20:.1f} MiB of which is the content strings), pkl "
+          f"{len(data) / 2 ** 20:.1f} MiB ({len(data) / count:.0f} bytes per message)")
+    for name, convert in (("dict", lambda message: message), ("Message", Message.from_dict)):
+        held, load_time = measure(data, convert)
+        print(f"  {name:>7}: {held / 2 ** 20:6.1f} MiB in memory ({(held - content_bytes) / count:5.0f} bytes per "
+              f"message besides the content), loaded in {load_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
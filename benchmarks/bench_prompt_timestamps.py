@@ -0,0 +1,96 @@
+"""
+Compares the prompt tokens per turn with the timestamp baked into every user message (the old storage format) and
+with timestamp headers rendered from the message metadata by conversationmanager.RenderedHistory. Each user message
+of the history is treated as one turn whose prompt is the last WINDOW messages up to it.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_prompt_timestamps [history.pkl]
+
+Without a pkl file, a synthetic history with conversations separated by pauses of a few hours is used.
+"""
+import os
+import pickle
+import random
+import sys
+from datetime import datetime
+
+from conversationmanager import RenderedHistory, count_tokens, remove_timestamp
+from enums.role_enum import Role
+from message import Message
+
+WINDOW = 40  # messages per prompt
+MODEL = "gpt-4-1106-preview"
+SYNTHETIC_SESSIONS = 60
+
+
+def load_history(path):
+    messages = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                message = pickle.load(f)
+            except EOFError:
+                return messages
+            content = remove_timestamp(message['content']) if message['role'] == Role.USER else message['content']
+            messages.append(Message(message['role'], content, message['origin'], message['timestamp']))
+
+
+def synthetic_history(seed=0):
+    from benchmarks.bench_hot_paths import SAMPLE_SENTENCES
+
+    rng = random.Random(seed)
+    messages = []
+    timestamp = 1790000000.0
+    for _ in range(SYNTHETIC_SESSIONS):
+        for i in range(rng.randint(3, 10) * 2):
+            role = Role.USER if i % 2 == 0 else Role.ASSISTANT
+            text = " ".join(rng.choice(SAMPLE_SENTENCES) for _ in range(rng.randint(1, 2)))
+            messages.append(Message(role, text, "voice" if role == Role.USER else MODEL, timestamp))
+            timestamp += rng.uniform(5, 90)
+        timestamp += rng.uniform(0.5, 30) * 3600
+    return messages
+
+
+def old_format(message):
+    if message['role'] != Role.USER:
+        return message['content']
+    return datetime.fromtimestamp(message['timestamp']).strftime("[%B %-d, %Y %-I:%M:%S%p]") + " " + message['content']
+
+
+def token_counter():
+    try:
+        count_tokens("test", MODEL)
+        return lambda text: count_tokens(text, MODEL), "tiktoken"
+    except Exception as e:
+        # the encoding is downloaded on first use; estimate offline instead of failing
+        print(f"tiktoken unavailable ({type(e).__name__}); estimating 4 characters per token")
+        return lambda text: (len(text) + 3) // 4, "estimate"
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    history = load_history(path) if path else synthetic_history()
+    tokens, method = token_counter()
+
+    old_total = new_total = turns = headers = 0
+    for end in range(1, len(history) + 1):
+        if history[end - 1]['role'] != Role.USER:
+            continue
+        window = history[max(0, end - WINDOW):end]
+        old_total += sum(tokens(old_format(message)) for message in window)
+        rendered = list(RenderedHistory(window).rendered)
+        new_total += sum(tokens(message['content']) for message in rendered)
+        headers += sum(1 for message, original in zip(rendered, window) if message is not original)
+        turns += 1
+
+    print(f"{os.path.basename(path) if path else 'synthetic history'}: {len(history)} messages, {turns} turns, "
+          f"{WINDOW}-message prompts, tokens by {method}")
+    print(f"  timestamp in every user message: {old_total / turns:7.1f} prompt tokens per turn")
+    print(f"  rendered headers:                {new_total / turns:7.1f} prompt tokens per turn "
+          f"({headers / turns:.1f} headers per prompt)")
+    print(f"  saved: {(old_total - new_total) / turns:.1f} tokens per turn "
+          f"({(old_total - new_total) / old_total * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
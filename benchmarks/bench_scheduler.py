@@ -0,0 +1,144 @@
+"""
+Exercises the request scheduler with a fake conversation manager whose responses take RESPONSE_TIME seconds:
+- whether a voice turn and a web message that arrive together interleave in the conversation, without and with the
+  scheduler,
+- how long a voice turn waits when several web messages are already queued,
+- how many of a burst of messages from one web client are rate limited,
+- the per-chunk cost of receiving a response through a worker thread instead of iterating over get_response().
+
+Usage (from the repository root):
+    python -m benchmarks.bench_scheduler
+"""
+import threading
+import time
+
+from pipeline.scheduler import RateLimitedError, RequestScheduler
+from utils.log import LogFormatter
+
+CHUNKS = 20
+RESPONSE_TIME = 0.2  # seconds per response
+WEB_BACKLOG = 3  # web messages queued before the voice turn
+BURST = 10  # messages one web client sends back to back
+OVERHEAD_CHUNKS = 20000
+
+
+class FakeConversationManager:
+    def __init__(self, chunk_delay=RESPONSE_TIME / CHUNKS, chunks=CHUNKS):
+        self.chunk_delay = chunk_delay
+        self.chunks = chunks
+        self.log = []  # (origin, event) in the order they reached the conversation
+
+    def get_response(self, user_message, origin="server", tag=None):
+        self.log.append((origin, "user"))
+        for i in range(self.chunks):
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield f"{i} "
+        self.log.append((origin, "assistant"))
+        yield None
+
+
+def interleaved(log):
+    """
+    :return: Whether a user message was added while another origin's response was still being generated.
+    """
+    return any(log[i][1] == "user" and log[i + 1][0] != log[i][0] for i in range(len(log) - 1))
+
+
+def consume(response, finished=None):
+    for _ in response:
+        pass
+    if finished is not None:
+        finished[0] = time.perf_counter()
+
+
+def unscheduled():
+    manager = FakeConversationManager()
+    threads = [threading.Thread(target=consume, args=(manager.get_response("hi", origin=origin),))
+               for origin in ("voice", "web")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return manager.log
+
+
+def scheduled(scheduler):
+    manager = FakeConversationManager()
+    requests = [scheduler.submit(manager, "hi", origin=origin, client="a") for origin in ("voice", "web")]
+    threads = [threading.Thread(target=consume, args=(request,)) for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return manager.log
+
+
+def voice_behind_backlog(scheduler):
+    """
+    :return: Tuple of the seconds the voice turn waited in the queue and the seconds until its response finished.
+    """
+    manager = FakeConversationManager()
+    web = [scheduler.submit(manager, "hi", origin="web", client=f"client{i}") for i in range(WEB_BACKLOG)]
+    threads = [threading.Thread(target=consume, args=(request,)) for request in web]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.01)  # the first web message is running, the rest are queued
+    finished = [None]
+    start = time.perf_counter()
+    voice = scheduler.submit(manager, "hi", origin="voice")
+    consume(voice, finished)
+    for thread in threads:
+        thread.join()
+    return voice.wait_time, finished[0] - start
+
+
+def burst(scheduler):
+    manager = FakeConversationManager(chunk_delay=0, chunks=1)
+    accepted = []
+    rejected = 0
+    for _ in range(BURST):
+        try:
+            accepted.append(scheduler.submit(manager, "hi", origin="web", client="burst"))
+        except RateLimitedError:
+            rejected += 1
+    for request in accepted:
+        consume(request)
+    return len(accepted), rejected
+
+
+def overhead(scheduler):
+    manager = FakeConversationManager(chunk_delay=0, chunks=OVERHEAD_CHUNKS)
+    start = time.perf_counter()
+    consume(manager.get_response("hi", origin="voice"))
+    direct = time.perf_counter() - start
+    start = time.perf_counter()
+    consume(scheduler.submit(manager, "hi", origin="voice"))
+    through_scheduler = time.perf_counter() - start
+    return direct / OVERHEAD_CHUNKS, through_scheduler / OVERHEAD_CHUNKS
+
+
+def main():
+    LogFormatter.config(level="warning")
+    scheduler = RequestScheduler()
+
+    print(f"voice + web at the same time, without scheduler: "
+          f"{'interleaved' if interleaved(unscheduled()) else 'serialized'}")
+    print(f"voice + web at the same time, with scheduler:    "
+          f"{'interleaved' if interleaved(scheduled(scheduler)) else 'serialized'}")
+
+    wait, total = voice_behind_backlog(scheduler)
+    print(f"voice turn behind {WEB_BACKLOG} web messages ({RESPONSE_TIME * 1000:.0f} ms each): waited "
+          f"{wait * 1000:.0f} ms, answered after {total * 1000:.0f} ms (FIFO would wait "
+          f"~{WEB_BACKLOG * RESPONSE_TIME * 1000:.0f} ms)")
+
+    accepted, rejected = burst(scheduler)
+    print(f"burst of {BURST} messages from one web client: {accepted} accepted, {rejected} rate limited")
+
+    direct, through_scheduler = overhead(scheduler)
+    print(f"per-chunk cost: {direct * 1e6:.1f} us direct, {through_scheduler * 1e6:.1f} us through a worker")
+    print(f"metrics: {scheduler.metrics()}")
+
+
+if __name__ == "__main__":
+    main()
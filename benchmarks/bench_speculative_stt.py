@@ -0,0 +1,100 @@
+"""
+Measures the time from the end of a query (the endpoint, ENDING_PAUSE_TIME after the last word) to its transcript,
+with and without speculative transcription during pauses. Queries are scripted as voiced stretches and pauses and
+played in real time through record_query with a fake microphone and VAD; transcription goes through
+audio.transcribe_audio (at the endpoint) or OpenAiStt (speculations) to a local stub server
+(benchmarks/stub_stt_server.py).
+
+Usage (from the repository root):
+    python -m benchmarks.bench_speculative_stt [--latency 0.8]
+"""
+import argparse
+import time
+
+import numpy as np
+import openai
+
+from benchmarks.stub_stt_server import StubSttServer
+from clients.stt.openai_stt import OpenAiStt
+from states import listening
+from utils.log import LogFormatter
+from utils.speculative_stt import SpeculativeStt
+from utils.stt_encoder import StreamingEncoder
+
+MIC_RATE = 16000
+# (seconds of speech, seconds of pause after it) per stretch; the last pause is the endpoint
+QUERIES = [
+    [(1.2, None)],
+    [(1.0, 0.5), (0.8, None)],
+    [(0.6, 0.8), (1.0, None)],
+]
+
+
+class ScriptedReader:
+    """
+    Plays a query in real time: loud samples while speaking, silence otherwise.
+    """
+
+    def __init__(self, query):
+        self.samples = np.concatenate([np.concatenate((np.full(int(speech * MIC_RATE), 1000, dtype=np.int16),
+                                                       np.zeros(int((pause or 0) * MIC_RATE), dtype=np.int16)))
+                                       for speech, pause in query])
+        self.position = 0
+
+    def read(self, samples, timeout=None):
+        time.sleep(samples / MIC_RATE)
+        chunk = self.samples[self.position:self.position + samples]
+        self.position += samples
+        return np.concatenate((chunk, np.zeros(samples - len(chunk), dtype=np.int16)))
+
+    def dead_time(self):
+        return None
+
+    def replayed(self):
+        # nothing was rewound, the query starts with the recording
+        return 0
+
+
+class LoudnessVad:
+    frame_length = 512
+
+    def process(self, frame):
+        return 1.0 if np.abs(frame).mean() > 100 else 0.0
+
+
+def endpoint_to_transcript(query, speculative_stt):
+    encoder = StreamingEncoder(MIC_RATE)
+    listening.record_query(ScriptedReader(query), encoder, False, MIC_RATE, 1, LoudnessVad(), speculative_stt)
+    endpoint = time.perf_counter()
+    text = speculative_stt.take(timeout=6) if speculative_stt is not None else None
+    if not text:
+        text = listening.speech_to_text(encoder.finish(listening.TRANSCRIPTION_FILE))
+    encoder.abort()
+    assert text
+    return time.perf_counter() - endpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Endpoint-to-transcript time with and without speculative STT")
+    parser.add_argument("--latency", type=float, default=0.8, help="seconds the stub server takes per transcript")
+    args = parser.parse_args()
+    LogFormatter.config(level="warning")
+
+    server = StubSttServer(latency=args.latency).start()
+    openai.base_url = server.url
+    openai.api_key = "stub"
+    print(f"STT latency {args.latency * 1000:.0f} ms, endpoint after {listening.ENDING_PAUSE_TIME} s of silence")
+
+    for name, speculative_stt in (("after endpoint", None), ("speculative", SpeculativeStt(OpenAiStt(url=server.url)))):
+        times = [endpoint_to_transcript(query, speculative_stt) for query in QUERIES]
+        print(f"  {name:>14}: transcript {', '.join(f'{t * 1000:.0f}' for t in times)} ms after the endpoint")
+        if speculative_stt is not None:
+            stats = speculative_stt.stats()
+            print(f"  {stats['started']} speculations: {stats['win_rate']:.0%} used, {stats['waste_rate']:.0%} "
+                  f"cancelled, {stats['saved_time']:.2f} s of STT before the endpoint")
+    print(f"  {len(server.requests)} requests to the STT server")
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
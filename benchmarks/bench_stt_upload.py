@@ -0,0 +1,58 @@
+"""
+Compares the size of the STT upload per codec with the CPU time the encoder costs and the upload time it saves. A
+recording is built from the speech in assets/lotr.mp3 and written through StreamingEncoder in microphone-sized
+chunks, as record_query does. Upload time is computed for the given uplink bandwidth.
+
+Usage (from the repository root, needs ffmpeg):
+    python -m benchmarks.bench_stt_upload [--seconds 8] [--uplink 2]
+"""
+import argparse
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+
+from utils import audio
+from utils.stt_encoder import CODECS, StreamingEncoder
+
+RATE = 16000  # states.listening.VOICE_DETECTION_RATE
+SPEECH_FILE = "assets/lotr.mp3"
+
+
+def load_speech(seconds):
+    pcm = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", SPEECH_FILE, "-f", "s16le",
+                          "-ar", str(RATE), "-ac", "1", "pipe:1"], capture_output=True, check=True).stdout
+    speech = np.frombuffer(pcm, dtype=np.int16)
+    return np.resize(speech, int(seconds * RATE))
+
+
+def encode(samples, codec, directory):
+    encoder = StreamingEncoder(RATE, codec=codec)
+    for start in range(0, len(samples), audio.FRAMES_PER_BUFFER):
+        encoder.write(samples[start:start + audio.FRAMES_PER_BUFFER])
+    file_path = encoder.finish(os.path.join(directory, f"upload_{codec}"))
+    return os.path.getsize(file_path), encoder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="STT upload size and encoding cost per codec")
+    parser.add_argument("--seconds", type=float, default=8, help="length of the recording")
+    parser.add_argument("--uplink", type=float, default=2, help="uplink bandwidth in Mbit/s")
+    args = parser.parse_args()
+
+    samples = load_speech(args.seconds)
+    bytes_per_second = args.uplink * 1e6 / 8
+    print(f"{args.seconds:.0f} s recording, {args.uplink:g} Mbit/s uplink")
+    with tempfile.TemporaryDirectory() as directory:
+        wav_size, _ = encode(samples, "wav", directory)
+        for codec in ["wav", *CODECS]:
+            size, encoder = encode(samples, codec, directory)
+            saved = (wav_size - size) / bytes_per_second
+            print(f"  {codec:>4}: {size / 1024:6.1f} KiB ({size / wav_size:4.0%}), encoder {encoder.cpu_time * 1000:4.0f} "
+                  f"ms CPU, {encoder.finish_time * 1000:3.0f} ms to finish at the endpoint, upload "
+                  f"{size / bytes_per_second * 1000:4.0f} ms ({saved * 1000:.0f} ms saved)")
+
+
+if __name__ == "__main__":
+    main()
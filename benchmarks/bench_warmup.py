@@ -0,0 +1,58 @@
+"""
+Measures what warming up the LLM connection on wake word saves. A local stub server adds a fixed delay to every new
+connection, standing in for DNS, TCP and TLS setup. Each turn starts with a connection the server has dropped (as
+after an idle period); the time-to-first-token is compared with and without calling warm_up() while the user would
+still be speaking.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_warmup [--connect-delay 0.3]
+"""
+import argparse
+import threading
+import time
+from types import SimpleNamespace
+
+import requests
+
+from benchmarks.stub_llm_server import StubLlmServer
+from clients.llm.local_llm import LocalLlm
+from enums.role_enum import Role
+from utils.log import LogFormatter
+
+MESSAGES = [{"role": Role.USER, "content": "Hello there"}]
+RECORDING_TIME = 1.0  # seconds between the wake word and the LLM request
+TURNS = 3
+
+
+def run_turn(client, warm):
+    client.session = requests.Session()  # no live connection left from the previous turn
+    if warm:
+        threading.Thread(target=client.warm_up, daemon=True).start()
+    time.sleep(RECORDING_TIME)
+
+    start = time.perf_counter()
+    first_token = None
+    for chunk in client.response_generator(MESSAGES):
+        if chunk and first_token is None:
+            first_token = time.perf_counter() - start
+    return first_token
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-to-first-token with and without connection warm-up")
+    parser.add_argument("--connect-delay", type=float, default=0.3, help="seconds added to every new connection")
+    args = parser.parse_args()
+    LogFormatter.config(level="warning")
+
+    server = StubLlmServer(ttft=0.1, token_delay=0, connect_delay=args.connect_delay).start()
+    client = LocalLlm(SimpleNamespace(temperature=1), url=server.url)
+    print(f"Connection setup {args.connect_delay * 1000:.0f} ms, server time-to-first-token 100 ms")
+    for warm in (False, True):
+        ttfts = [run_turn(client, warm) for _ in range(TURNS)]
+        print(f"  {'warmed up' if warm else 'cold':>9}: first token after "
+              f"{', '.join(f'{t * 1000:.0f}' for t in ttfts)} ms")
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measures what a web client costs on connect: the time spent in the connect handler and the bytes sent, for the
+per-message replay the web UI used to do and for the compressed history snapshot, at several history sizes. Also
+times loading a page of older messages from the on-disk history. The synthetic messages repeat a handful of
+sentences, so they compress better than a real conversation would.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_web_connect
+"""
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+from benchmarks.bench_hot_paths import _synthetic_conversation
+from utils.log import LogFormatter
+
+HISTORY_SIZES = (200, 1000, 5000)
+ON_DISK_MESSAGES = 20000
+
+
+def conversation_manager(history_file, in_memory):
+    from conversation_history import ConversationHistory
+    from conversationmanager import ConversationManager
+
+    manager = ConversationManager.__new__(ConversationManager)
+    manager.persona = SimpleNamespace(name="Benchmark")
+    manager.pkl_file = history_file
+    manager.llm_client = SimpleNamespace(model="gpt-4-1106-preview", token_model="gpt-4-1106-preview",
+                                         release_caches=lambda: None)
+    manager.suspended = None
+    manager.suspend_lock = threading.Lock()
+    manager.prompt_history = None
+    manager.history_offsets = []
+    manager.index_history()
+    manager._history = ConversationHistory(
+        manager.load_history(manager.history_length() - in_memory, manager.history_length()))
+    return manager
+
+
+def main():
+    LogFormatter.config(level="warning")
+    from web.web_service import WebService, client_message
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_file = os.path.join(tmp_dir, "history.pkl")
+        with open(history_file, "wb") as f:
+            for message in _synthetic_conversation(ON_DISK_MESSAGES):
+                pickle.dump(message, f)
+
+        web_service = WebService()
+        print(f"{ON_DISK_MESSAGES} messages on disk")
+        for size in HISTORY_SIZES:
+            web_service.conversation_manager = conversation_manager(history_file, size)
+
+            client = web_service.socketio.test_client(web_service.app)
+            client.get_received()
+            # what handle_connect used to do: one event per message in the conversation
+            start = time.perf_counter()
+            for message in web_service.conversation_manager.conversation:
+                web_service.socketio.emit('server_chat_msg', client_message(message))
+            replay_time = time.perf_counter() - start
+            received = client.get_received()
+            replay_bytes = sum(len(json.dumps(event['args'])) for event in received)
+            client.disconnect()
+
+            start = time.perf_counter()
+            client = web_service.socketio.test_client(web_service.app)
+            snapshot_time = time.perf_counter() - start
+            snapshot = next(e for e in client.get_received() if e['name'] == "history_snapshot")['args'][0]
+            snapshot_json = zlib.decompress(snapshot)
+            page = json.loads(snapshot_json)
+
+            start = time.perf_counter()
+            client.emit("load_older", {"cursor": page['cursor'], "limit": 50})
+            page_time = time.perf_counter() - start
+            older = next(e for e in client.get_received() if e['name'] == "history_page")['args'][0]
+            client.disconnect()
+
+            print(f"  {size:>5} messages in memory: per-message replay {len(received)} events, {replay_bytes} bytes, "
+                  f"{replay_time * 1000:.1f} ms; snapshot 1 event, {len(snapshot)} bytes "
+                  f"({len(snapshot_json)} uncompressed), "
+                  f"{snapshot_time * 1000:.1f} ms; load older {len(older)} bytes, {page_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
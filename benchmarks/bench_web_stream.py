@@ -0,0 +1,124 @@
+"""
+Measures how much time the LLM loop spends handing streamed chunks to the web clients, for the per-chunk broadcast
+the web service used to do and for the per-client outboxes, with several fast clients and one slow one. Sending a
+packet to the slow client takes SLOW_SEND seconds, and clients acknowledge frames after a round trip, so the slow
+client falls behind. Also reports the number of events each client got and checks that every client ends up with the
+full response.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_web_stream
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+from utils.log import LogFormatter
+
+FAST_CLIENTS = 5
+CHUNKS = 300
+CHUNK_INTERVAL = 0.005  # seconds between chunks from the LLM
+FAST_RTT = 0.005  # seconds before a fast client acknowledges a frame
+SLOW_RTT = 0.3
+SLOW_SEND = 0.002  # seconds it takes to hand a packet to the slow client's socket
+
+
+def connect_clients(web_service, fast, slow):
+    """
+    Connects the test clients and makes packets to the slow one take SLOW_SEND seconds to send. Frames are
+    acknowledged after the client's round trip time.
+    :return: List of (client, is_slow).
+    """
+    server = web_service.socketio.server
+    clients = [(web_service.socketio.test_client(web_service.app), False) for _ in range(fast)]
+    clients += [(web_service.socketio.test_client(web_service.app), True) for _ in range(slow)]
+    slow_eio_sids = {client.eio_sid for client, is_slow in clients if is_slow}
+    send_packet = server._send_packet  # the test client's in-memory transport
+
+    def slow_send_packet(eio_sid, pkt):
+        if eio_sid in slow_eio_sids:
+            time.sleep(SLOW_SEND)
+        send_packet(eio_sid, pkt)
+        if pkt.data and pkt.data[0] == "server_chat_frame":
+            outbox = web_service.outboxes.get(server.manager.sid_from_eio_sid(eio_sid, "/"))
+            if outbox:
+                rtt = SLOW_RTT if eio_sid in slow_eio_sids else FAST_RTT
+                threading.Timer(rtt, web_service._frame_acknowledged, args=(outbox,)).start()
+
+    server._send_packet = slow_send_packet
+    for client, _ in clients:
+        client.get_received()
+    return clients
+
+
+def stream(send_first, send_chunk, chunks):
+    """
+    :return: Seconds spent in the send functions.
+    """
+    in_send = 0
+    for i, chunk in enumerate(chunks):
+        start = time.perf_counter()
+        if i == 0:
+            send_first(chunk)
+        else:
+            send_chunk(chunk)
+        in_send += time.perf_counter() - start
+        time.sleep(CHUNK_INTERVAL)
+    return in_send
+
+
+def received_text(client):
+    """
+    :return: Tuple of the streamed text the client received and the number of events.
+    """
+    text = ""
+    events = client.get_received()
+    for event in events:
+        updates = event['args'][0]['updates'] if event['name'] == "server_chat_frame" else [event['args'][0]]
+        for update in updates:
+            text = update['message'] if update['msg_type'] == "assistant_msg" else text + update['message']
+    return text, len(events)
+
+
+def report(name, in_send, clients, expected):
+    print(f"{name}: LLM loop spent {in_send * 1000:.1f} ms sending ({in_send / CHUNKS * 1e6:.0f} us per chunk)")
+    for i, (client, is_slow) in enumerate(clients):
+        text, events = received_text(client)
+        status = "complete" if text == expected else f"INCOMPLETE ({len(text)}/{len(expected)} chars)"
+        if i == 0 or is_slow:
+            print(f"  {'slow' if is_slow else 'fast'} client: {events} events, response {status}")
+
+
+def main():
+    LogFormatter.config(level="warning")
+    from web.web_service import WebService
+
+    chunks = [f"word{i} " for i in range(CHUNKS)]
+    expected = "".join(chunks)
+    web_service = WebService()
+    web_service.conversation_manager = SimpleNamespace(persona=SimpleNamespace(name="Benchmark"), conversation=[],
+                                                       history_length=lambda: 0)
+    print(f"{CHUNKS} chunks every {CHUNK_INTERVAL * 1000:.0f} ms to {FAST_CLIENTS} fast clients and 1 slow client "
+          f"({SLOW_SEND * 1000:.0f} ms per packet, {SLOW_RTT * 1000:.0f} ms round trip)")
+
+    # what emit_update used to do: broadcast every chunk from inside the LLM loop
+    clients = connect_clients(web_service, FAST_CLIENTS, 1)
+    broadcast = lambda msg_type: lambda chunk: web_service.socketio.emit(
+        'server_chat_msg', {"msg_type": msg_type, "message": chunk, "origin": "gpt", "timestamp": time.time()})
+    in_send = stream(broadcast("assistant_msg"), broadcast("assistant_append"), chunks)
+    report("per-chunk broadcast", in_send, clients, expected)
+    for client, _ in clients:
+        client.disconnect()
+
+    clients = connect_clients(web_service, FAST_CLIENTS, 1)
+    in_send = stream(lambda chunk: web_service.send_new_assistant_msg(chunk, "gpt"),
+                     web_service.append_assistant_msg, chunks)
+    time.sleep(SLOW_RTT * 2 + web_service.flush_interval * 2)  # let the slow client catch up
+    report(f"outboxes ({web_service.flush_interval * 1000:.0f} ms frames)", in_send, clients, expected)
+    merged = sum(outbox.merged for outbox in web_service.outboxes.values())
+    print(f"  {merged} chunks merged into earlier updates")
+    for client, _ in clients:
+        client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
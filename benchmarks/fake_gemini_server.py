@@ -0,0 +1,76 @@
+"""
+Local fake of the Gemini API's StreamGenerateContent gRPC method, so GoogleLlm can be exercised without an API key.
+Every request's serialized size and number of contents are recorded.
+
+Usage:
+    server = FakeGeminiServer().start()
+    server.attach(google_llm.google_client)  # route a genai.GenerativeModel to the fake
+"""
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from google.ai.generativelanguage_v1beta.services.generative_service import GenerativeServiceClient
+from google.ai.generativelanguage_v1beta.services.generative_service.transports.grpc import \
+    GenerativeServiceGrpcTransport
+from google.ai.generativelanguage_v1beta.types import content, generative_service
+
+SERVICE = "google.ai.generativelanguage.v1beta.GenerativeService"
+DEFAULT_REPLY = "This is a canned reply from the fake Gemini server. It streams a few words at a time."
+WORDS_PER_CHUNK = 4
+
+
+class FakeGeminiServer:
+    def __init__(self, port=0, ttft=0.05, chunk_delay=0.01, reply=DEFAULT_REPLY):
+        """
+        :param port: Port to listen on (0 picks a free one; see .address).
+        :param ttft: Seconds before the first chunk is sent.
+        :param chunk_delay: Seconds between chunks.
+        """
+        self.ttft = ttft
+        self.chunk_delay = chunk_delay
+        self.reply = reply
+        self.requests = []  # (serialized bytes, number of contents) per request
+        self.lock = threading.Lock()
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        self.server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler(SERVICE, {
+            "StreamGenerateContent": grpc.unary_stream_rpc_method_handler(
+                self._stream_generate_content,
+                request_deserializer=generative_service.GenerateContentRequest.deserialize,
+                response_serializer=generative_service.GenerateContentResponse.serialize),
+        })])
+        self.port = self.server.add_insecure_port(f"127.0.0.1:{port}")
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.port}"
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(grace=None)
+
+    def attach(self, generative_model):
+        """
+        Points a genai.GenerativeModel at this server instead of the real API.
+        """
+        transport = GenerativeServiceGrpcTransport(channel=grpc.insecure_channel(self.address))
+        generative_model._client = GenerativeServiceClient(transport=transport)
+
+    def _stream_generate_content(self, request, context):
+        with self.lock:
+            self.requests.append((len(generative_service.GenerateContentRequest.serialize(request)),
+                                  len(request.contents)))
+        words = self.reply.split(" ")
+        chunks = [" ".join(words[i:i + WORDS_PER_CHUNK]) + " " for i in range(0, len(words), WORDS_PER_CHUNK)]
+        time.sleep(self.ttft)
+        for i, text in enumerate(chunks):
+            last = i == len(chunks) - 1
+            yield generative_service.GenerateContentResponse(candidates=[generative_service.Candidate(
+                content=content.Content(role="model", parts=[content.Part(text=text.rstrip() if last else text)]),
+                finish_reason=generative_service.Candidate.FinishReason.STOP if last else 0,
+                index=0)])
+            time.sleep(self.chunk_delay)
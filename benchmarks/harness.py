@@ -0,0 +1,169 @@
+import json
+import os
+import platform
+import statistics
+import time
+import timeit
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baselines")
+DEFAULT_ROUNDS = 7
+DEFAULT_THRESHOLD = 0.10  # relative slowdown that is reported as a regression
+
+_registry = []
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def benchmark(name, group="misc"):
+    """
+    Registers a benchmark. The decorated function is the setup step: it receives no arguments and returns the
+    zero-argument callable that will be timed. Raise SkipBenchmark (or let an ImportError escape) from the setup to
+    skip the benchmark on machines that don't have the required dependencies.
+    :param name: Unique name of the benchmark. Used as the key in the baseline file.
+    :param group: Group name used to organize the report.
+    """
+
+    def decorator(setup):
+        _registry.append({"name": name, "group": group, "setup": setup})
+        return setup
+
+    return decorator
+
+
+def noted(func, note):
+    """
+    Attaches a note to the callable returned by a benchmark's setup, e.g. which implementation of a dependency it
+    ran with. The note is stored with the results, and results are only compared against a baseline with the same
+    note.
+    """
+    func.note = note
+    return func
+
+
+def get_benchmarks(name_filter=None):
+    return [b for b in _registry if not name_filter or name_filter in b['name']]
+
+
+def time_callable(func, rounds=DEFAULT_ROUNDS):
+    """
+    Times a callable using timeit's autorange to pick the number of loops so that each round takes at least 0.2s.
+    :return: Dictionary of per-call statistics in microseconds.
+    """
+    timer = timeit.Timer(func, timer=time.perf_counter)
+    loops, _ = timer.autorange()
+    samples = [t / loops * 1e6 for t in timer.repeat(repeat=rounds, number=loops)]
+    return {
+        "median_us": statistics.median(samples),
+        "min_us": min(samples),
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "loops": loops,
+        "rounds": rounds,
+    }
+
+
+def run_benchmarks(name_filter=None, rounds=DEFAULT_ROUNDS, report=print):
+    results = {}
+    for bench in get_benchmarks(name_filter):
+        try:
+            func = bench['setup']()
+            stats = time_callable(func, rounds=rounds)
+        except (SkipBenchmark, ImportError) as e:
+            # missing dependencies, tiktoken unable to download its encoding offline, etc.
+            reason = f"{type(e).__name__}: {e}"
+            report(f"  skipped {bench['name']}: {reason}")
+            results[bench['name']] = {"group": bench['group'], "skipped": reason}
+            continue
+        except Exception as e:
+            # a broken benchmark, e.g. a fixture that no longer matches the code under test
+            reason = f"{type(e).__name__}: {e}"
+            report(f"  ERROR {bench['name']}: {reason}")
+            results[bench['name']] = {"group": bench['group'], "error": reason}
+            continue
+        stats['group'] = bench['group']
+        note = getattr(func, 'note', None)
+        if note:
+            stats['note'] = note
+        results[bench['name']] = stats
+        report(f"  {bench['name']:<45} {format_us(stats['median_us']):>12}" + (f"  ({note})" if note else ""))
+    return results
+
+
+def errors(results):
+    """
+    :return: Names of the benchmarks that failed with something other than a skip.
+    """
+    return [name for name, stats in results.items() if 'error' in stats]
+
+
+def machine_id():
+    return f"{platform.machine()}-py{platform.python_version_tuple()[0]}{platform.python_version_tuple()[1]}"
+
+
+def default_baseline_path():
+    return os.path.join(BASELINE_DIR, f"{machine_id()}.json")
+
+
+def save_baseline(results, path=None):
+    path = path if path else default_baseline_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {
+        "machine": machine_id(),
+        "processor": platform.processor() or platform.machine(),
+        "python": platform.python_version(),
+        "created": time.time(),
+        "results": {name: stats for name, stats in results.items() if 'median_us' in stats},
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    return path
+
+
+def load_baseline(path=None):
+    path = path if path else default_baseline_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def format_us(value):
+    if value >= 1e6:
+        return f"{value / 1e6:.2f} s"
+    if value >= 1e3:
+        return f"{value / 1e3:.2f} ms"
+    return f"{value:.2f} us"
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Builds a comparison report between the current results and a stored baseline.
+    :return: Tuple of (report lines, list of regressed benchmark names)
+    """
+    lines = [f"{'benchmark':<45} {'baseline':>12} {'current':>12} {'change':>9}"]
+    regressions = []
+    baseline_results = baseline['results'] if baseline else {}
+    for name, stats in results.items():
+        if 'skipped' in stats or 'error' in stats:
+            lines.append(f"{name:<45} {'':>12} {'skipped' if 'skipped' in stats else 'ERROR':>12}")
+            continue
+        base = baseline_results.get(name)
+        if base is None:
+            lines.append(f"{name:<45} {'n/a':>12} {format_us(stats['median_us']):>12}")
+            continue
+        if stats.get('note') != base.get('note'):
+            # e.g. measured with a tokenizer estimate against a tiktoken baseline
+            lines.append(f"{name:<45} {format_us(base['median_us']):>12} {format_us(stats['median_us']):>12}  "
+                         f"not comparable ({stats.get('note')} vs {base.get('note')})")
+            continue
+        change = stats['median_us'] / base['median_us'] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        lines.append(f"{name:<45} {format_us(base['median_us']):>12} {format_us(stats['median_us']):>12} "
+                     f"{change * 100:>+8.1f}%{flag}")
+    return lines, regressions
@@ -0,0 +1,61 @@
+"""
+Runs the benchmark suite and compares it against the stored baseline for this machine.
+
+Usage (from the repository root):
+    python -m benchmarks.run                 # run and compare against benchmarks/baselines/<machine>.json
+    python -m benchmarks.run --save          # run and store the results as the new baseline
+    python -m benchmarks.run -k conversation # only run benchmarks whose name contains 'conversation'
+"""
+import argparse
+import logging
+import sys
+
+from benchmarks import bench_hot_paths  # noqa: F401 (registers benchmarks)
+from benchmarks.harness import (DEFAULT_ROUNDS, DEFAULT_THRESHOLD, compare, default_baseline_path, errors,
+                                load_baseline, machine_id, run_benchmarks, save_baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Natalie microbenchmarks")
+    parser.add_argument("-k", "--filter", help="only run benchmarks whose name contains this string")
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS, help="timing rounds per benchmark")
+    parser.add_argument("--baseline", help=f"baseline file (default: {default_baseline_path()})")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown reported as a regression (default: %(default)s)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on regressions")
+    args = parser.parse_args()
+
+    # the code under test logs at info level
+    logging.disable(logging.WARNING)
+
+    print(f"Running benchmarks on {machine_id()}")
+    results = run_benchmarks(args.filter, rounds=args.rounds)
+    failed = errors(results)
+    if failed:
+        print(f"\n{len(failed)} benchmark(s) failed: {', '.join(failed)}")
+        if args.save:
+            print("Baseline not saved.")
+            return 1
+
+    if args.save:
+        path = save_baseline(results, args.baseline)
+        print(f"\nBaseline saved to {path}")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"\nNo baseline found at {args.baseline or default_baseline_path()}. Run with --save to create one.")
+        return 1 if failed else 0
+
+    lines, regressions = compare(results, baseline, threshold=args.threshold)
+    print(f"\nComparison against baseline from {baseline['machine']} (python {baseline['python']}):")
+    print("\n".join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) above {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        return 1 if args.fail_on_regression or failed else 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Local stand-in for the LocalLlm HTTP API: POST {"messages": [...]} and receive the reply as a chunked text stream.
+Latency and failures are configurable so LLM clients can be exercised without a GPU box or API keys.
+
+It also speaks the session protocol: POST {"session": id, "keep": n, "messages": [...]} keeps the first n messages
+the session already has (their KV cache is reused), appends the new messages and only pays prefill for those. A
+session the server doesn't know, or one with fewer than n messages, is answered with 409 so the client resends the
+whole conversation with keep = 0.
+
+Usage:
+    python -m benchmarks.stub_llm_server --port 8001 --ttft 2.0 --token-delay 0.05
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "This is a canned reply from the stub server. It streams one word at a time."
+
+
+class StubLlmServer:
+    def __init__(self, port=0, ttft=0.2, token_delay=0.02, reply=DEFAULT_REPLY, fail_status=None, connect_delay=0,
+                 prefill_per_kchar=0):
+        """
+        :param port: Port to listen on (0 picks a free one; see .url).
+        :param ttft: Seconds before the first token is sent.
+        :param token_delay: Seconds between tokens.
+        :param fail_status: If set, every request is answered with this HTTP status instead of a reply.
+        :param connect_delay: Seconds added to every new connection, standing in for DNS, TCP and TLS setup.
+        :param prefill_per_kchar: Seconds of prompt processing per 1000 characters the server hasn't cached, added to
+        the time before the first token.
+        """
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.reply = reply
+        self.fail_status = fail_status
+        self.connect_delay = connect_delay
+        self.prefill_per_kchar = prefill_per_kchar
+        self.sessions = {}  # session id -> messages whose KV cache the server keeps
+        self.prefill_chars = 0  # characters of prompt processed over all requests
+        self.cache_misses = 0
+        self.connections = 0
+        self.requests = []  # (bytes received, number of messages) per request
+        self.aborted = 0  # streams closed by the client before the reply was complete
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reply_tokens(self, request):
+        return [word + " " for word in self.reply.split(" ")]
+
+    def clear_sessions(self):
+        """
+        Drops every session's cache, as a server restart would.
+        """
+        self.sessions.clear()
+
+    def prompt_to_prefill(self, request):
+        """
+        Updates the request's session and returns the messages that have to be processed, or None on a cache miss.
+        """
+        if 'session' not in request:
+            return request['messages']
+        keep = request.get('keep', 0)
+        history = self.sessions.get(request['session'])
+        if keep and (history is None or len(history) < keep):
+            self.cache_misses += 1
+            return None
+        self.sessions[request['session']] = (history[:keep] if keep else []) + request['messages']
+        return request['messages']
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                server.connections += 1
+                time.sleep(server.connect_delay)
+                super().setup()
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                request = json.loads(body)
+                server.requests.append((len(body), len(request.get('messages', []))))
+
+                if server.fail_status:
+                    self.send_error_json(server.fail_status, "stub failure")
+                    return
+                prefill = server.prompt_to_prefill(request)
+                if prefill is None:
+                    self.send_error_json(409, "session cache miss")
+                    return
+                prefill_chars = sum(len(message['content']) for message in prefill)
+                server.prefill_chars += prefill_chars
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(server.ttft + server.prefill_per_kchar * prefill_chars / 1000)
+                try:
+                    for token in server.reply_tokens(request):
+                        data = token.encode()
+                        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                        self.wfile.flush()
+                        time.sleep(server.token_delay)
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    server.aborted += 1
+
+            def send_error_json(self, status, message):
+                error = json.dumps({"error": message}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(error)))
+                self.end_headers()
+                self.wfile.write(error)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub LLM server speaking the LocalLlm protocol")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between tokens")
+    parser.add_argument("--fail-status", type=int, help="answer every request with this HTTP status")
+    parser.add_argument("--connect-delay", type=float, default=0, help="seconds added to every new connection")
+    parser.add_argument("--prefill-per-kchar", type=float, default=0,
+                        help="seconds of prompt processing per 1000 uncached characters")
+    args = parser.parse_args()
+
+    server = StubLlmServer(args.port, ttft=args.ttft, token_delay=args.token_delay, fail_status=args.fail_status,
+                           connect_delay=args.connect_delay, prefill_per_kchar=args.prefill_per_kchar)
+    print(f"Stub LLM listening on {server.url}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
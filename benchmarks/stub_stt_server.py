@@ -0,0 +1,88 @@
+"""
+Local stand-in for OpenAI's transcription endpoint: POST /v1/audio/transcriptions (multipart, as the openai client
+sends it) and receive a canned transcript as plain text after a configurable latency. Point the openai client at it
+with OPENAI_BASE_URL=<url> (any OPENAI_API_KEY will do) to exercise STT without network access or API keys.
+
+Usage:
+    python -m benchmarks.stub_stt_server --port 8002 --latency 0.8
+"""
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_TRANSCRIPT = "What time is it in Tokyo?"
+
+
+class StubSttServer:
+    def __init__(self, port=0, latency=0.8, per_second=0.05, transcript=DEFAULT_TRANSCRIPT):
+        """
+        :param port: Port to listen on (0 picks a free one; see .url).
+        :param latency: Seconds before every transcript is returned.
+        :param per_second: Seconds added per second of uploaded audio (16-bit mono WAV assumed).
+        """
+        self.latency = latency
+        self.per_second = per_second
+        self.transcript = transcript
+        self.requests = []  # seconds of audio per request
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                # models.retrieve(), used to warm up the connection
+                self._send(200, b'{"id": "whisper-1", "object": "model", "owned_by": "stub"}', "application/json")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                seconds = len(body) / 2 / 16000
+                server.requests.append(seconds)
+                time.sleep(server.latency + seconds * server.per_second)
+                self._send(200, server.transcript.encode() + b"\n", "text/plain")
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub OpenAI transcription server")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency", type=float, default=0.8, help="seconds before every transcript")
+    parser.add_argument("--transcript", default=DEFAULT_TRANSCRIPT)
+    args = parser.parse_args()
+    server = StubSttServer(port=args.port, latency=args.latency, transcript=args.transcript)
+    print(f"Stub STT server on {server.url}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import logging
+import threading
+import weakref
+
+
+def close_stream(stream):
+    """
+    Closes a streaming response: gRPC calls are cancelled, HTTP responses and botocore StreamingBody objects closed.
+    """
+    raw = getattr(stream, "raw", None)
+    if callable(getattr(raw, "shutdown", None)):
+        # requests/urllib3 (>= 2.3): closing alone waits for a read blocked in another thread to return
+        try:
+            raw.shutdown()
+        except ValueError:
+            pass
+    for method in ("cancel", "close"):
+        if callable(getattr(stream, method, None)):
+            getattr(stream, method)()
+            return
+    logging.warning(f"Don't know how to close stream of type {type(stream).__name__}")
+
+
+class RequestToken:
+    """
+    One request of a CancellableClient. Each request checks its own token, so starting a request never undoes a
+    cancel() meant for another one. A caller that has to be able to cancel a request before it has started (e.g.
+    from another thread) creates the token with new_request() and passes it to the request.
+    """
+
+    __slots__ = ("cancelled", "stream", "__weakref__")
+
+    def __init__(self):
+        self.cancelled = False
+        self.stream = None  # the streaming response being read, once attached
+
+
+class CancellableClient:
+    """
+    Tracks the network streams a client is currently reading so another thread can abort them. Clients call
+    _begin_request() before sending a request and _attach_stream() once the streaming response object exists. A
+    cancel() that arrives while the request is still connecting, or before it has even started, closes the stream as
+    soon as it is attached.
+    """
+
+    def __init__(self):
+        self._stream_lock = threading.Lock()
+        self._requests = weakref.WeakSet()  # tokens of the requests that can still be cancelled
+
+    def new_request(self):
+        """
+        :return: RequestToken for a request that is about to be made. cancel() applies to it from now on.
+        """
+        token = RequestToken()
+        with self._stream_lock:
+            self._requests.add(token)
+        return token
+
+    def _begin_request(self, token=None):
+        """
+        :param token: The caller's RequestToken, if it created one with new_request().
+        :return: The request's token.
+        """
+        return token if token is not None else self.new_request()
+
+    def _attach_stream(self, token, stream):
+        """
+        :return: False if the request was cancelled before the stream was attached (the stream is closed).
+        """
+        with self._stream_lock:
+            if not token.cancelled:
+                token.stream = stream
+                return True
+        close_stream(stream)
+        return False
+
+    def _detach_stream(self, token):
+        with self._stream_lock:
+            token.stream = None
+
+    def cancel(self, token=None):
+        """
+        Aborts a request, releasing its connection right away. The generator reading from it ends quietly instead of
+        raising.
+        :param token: RequestToken of the request to cancel. By default every request made so far is cancelled.
+        """
+        with self._stream_lock:
+            tokens = [token] if token is not None else list(self._requests)
+            streams = []
+            for request in tokens:
+                request.cancelled = True
+                if request.stream is not None:
+                    streams.append(request.stream)
+                    request.stream = None
+        for stream in streams:
+            try:
+                close_stream(stream)
+            except Exception as e:
+                logging.debug(f"Error closing {type(self).__name__} stream: {e}")
+            logging.info(f"{type(self).__name__} stream aborted.")
@@ -6,6 +6,7 @@ from dotenv import load_dotenv
 from timeout_function_decorator.timeout_decorator import timeout
 
 from clients.llm.llm_interface import LlmClient
+from clients.llm.prompt_builder import PromptBuilder
 from enums.role_enum import Role
 
 MAX_RESPONSE_TOKENS = 600
@@ -15,6 +16,8 @@ MODEL = "gemini-pro"
 load_dotenv()
 
 FinishReason = Candidate.FinishReason
+# streamed chunks before the last one don't have a finish reason yet
+COMPLETE_FINISH_REASONS = (FinishReason.FINISH_REASON_UNSPECIFIED, FinishReason.STOP)
 
 
 class GoogleLlm(LlmClient):
@@ -22,7 +25,8 @@ class GoogleLlm(LlmClient):
     def __init__(self, persona, max_response_tokens=MAX_RESPONSE_TOKENS, max_context_tokens=MAX_CONTEXT_TOKENS,
                  model=MODEL):
         super().__init__(persona)
-        self.bump_system_message = True
+        # the chat session's history has to stay a prefix of the conversation
+        self.bump_system_message = False
         self.max_response_tokens = max_response_tokens
         self.max_context_tokens = max_context_tokens
         self.model = model
@@ -32,17 +36,47 @@ class GoogleLlm(LlmClient):
             # max_response_tokens=max_response_tokens
         )
         self.google_client = genai.GenerativeModel(self.model)
-        self.conversation = None  # create in first response_generator
+        self.conversation = None  # chat session, created in the first response_generator
+        self.chat_length = 0  # messages sent with the last request, in the chat session's history
+        self.chat_reply = None  # the last reply if it was received completely
+        self.prompt_builder = PromptBuilder(convert_message)
 
-    @timeout(3)
-    def response_generator(self, messages):
-        messages = update_roles(messages)
+    def warm_up(self):
+        genai.get_model(f"models/{self.model}")
+
+    def release_caches(self):
+        # the chat session has its own copy of the history; the next request starts a new one
+        super().release_caches()
+        self.conversation = None
+        self.chat_length = 0
+        self.chat_reply = None
 
-        if not self.conversation:
-            self.conversation = self.google_client.start_chat(history=messages)
+    def chat_in_sync(self, history):
+        """
+        The chat session only has to be advanced with the new message if the history is exactly what was sent last
+        turn followed by the complete reply. Anything else (a pruned, rewound or interrupted conversation) needs a
+        resync. Call it after building the prompt: the prompt builder knows which messages didn't change.
+        """
+        if self.conversation is None or self.chat_reply is None or len(history) != self.chat_length + 1:
+            return False
+        if self.prompt_builder.unchanged_prefix < self.chat_length:
+            return False
+        return history[-1]['role'] == Role.ASSISTANT and history[-1]['content'] == self.chat_reply
+
+    @timeout(3)
+    def response_generator(self, messages, token=None):
+        converted = self.prompt_builder.build(messages, bump=self.bump_system_message)
+        if not self.chat_in_sync(messages[:-1]):
+            logging.debug("Starting a new Gemini chat session from the conversation.")
+            # the system message turns into two messages
+            self.conversation = self.google_client.start_chat(
+                history=[message for parts in converted[:-1] for message in parts])
+        self.chat_length = len(messages)
+        self.chat_reply = None
 
-        raw_generator = self.google_client.generate_content(
-            messages,
+        token = self._begin_request(token)
+        raw_generator = self.conversation.send_message(
+            converted[-1][0],
             generation_config=genai.types.GenerationConfig(
                 candidate_count=1,
                 max_output_tokens=MAX_RESPONSE_TOKENS,
@@ -51,28 +85,46 @@ class GoogleLlm(LlmClient):
             stream=True
         )
 
-        for chunk in raw_generator:
-            if hasattr(chunk.candidates[0], 'finish_reason') and chunk.candidates[0].finish_reason != FinishReason.STOP:
-                # logging.debug2(f"Candidate FinishReason Module: {type(chunk.candidates[0].finish_reason).__module__}")
+        # the streaming gRPC call is kept privately by the response object
+        if not self._attach_stream(token, getattr(raw_generator, '_iterator', raw_generator)):
+            return
+
+        reply = ""
+        try:
+            for chunk in raw_generator:
+                if hasattr(chunk.candidates[0], 'finish_reason') and \
+                        chunk.candidates[0].finish_reason not in COMPLETE_FINISH_REASONS:
+                    # logging.debug2(f"Candidate FinishReason Module: {type(chunk.candidates[0].finish_reason).__module__}")
+
+                    yield ". I'm sorry, but I could not continue generating my response. I put some details about the " \
+                          "problem in my log file.\n"
+                    logging.warning(f"Unable to generate response: finish_reason = {FinishReason(chunk.candidates[0].finish_reason).name}")
+                else:
+                    reply += chunk.text
+                    yield chunk.text
+            self.chat_reply = reply
+        except Exception:
+            if not token.cancelled:
+                raise
+        finally:
+            self._detach_stream(token)
+
 
-                yield ". I'm sorry, but I could not continue generating my response. I put some details about the " \
-                      "problem in my log file.\n"
-                logging.warning(f"Unable to generate response: finish_reason = {FinishReason(chunk.candidates[0].finish_reason).name}")
-            else:
-                yield chunk.text
+def convert_message(raw_message):
+    """
+    :return: List of Gemini messages for one message. There is no system role, so the system message is sent as a
+    user message followed by an acknowledgement.
+    """
+    if raw_message['role'] == Role.SYSTEM:
+        return [{'role': str(Role.USER), 'parts': [raw_message['content']]},
+                {'role': 'model', 'parts': ['Okay. I will remember these directives forever.']}]
+    elif raw_message['role'] == Role.USER:
+        return [{'role': str(Role.USER), 'parts': [raw_message['content']]}]
+    elif raw_message["role"] == Role.ASSISTANT:
+        return [{'role': 'model', 'parts': [raw_message['content']]}]
+    logging.warning(f"Unknown role '{raw_message['role']}'")
+    return []
 
 
-# TODO cache this in the object
 def update_roles(raw_messages):
-    messages = []
-    for raw_message in raw_messages:
-        if raw_message['role'] == Role.SYSTEM:
-            messages.append({'role': str(Role.USER), 'parts': [raw_message['content']]})
-            messages.append({'role': 'model', 'parts': ['Okay. I will remember these directives forever.']})
-        elif raw_message['role'] == Role.USER:
-            messages.append({'role': str(Role.USER), 'parts': [raw_message['content']]})
-        elif raw_message["role"] == Role.ASSISTANT:
-            messages.append({'role': 'model', 'parts': [raw_message['content']]})
-        else:
-            logging.warning(f"Unknown role '{raw_message['role']}'")
-    return messages
+    return [message for raw_message in raw_messages for message in convert_message(raw_message)]
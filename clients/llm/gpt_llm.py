@@ -1,6 +1,8 @@
 import os
 
 from clients.llm.llm_interface import LlmClient
+from clients.llm.prompt_builder import PromptBuilder
+from clients.warmup import WARM_UP_TIMEOUT
 from openai import OpenAI
 from dotenv import load_dotenv
 from timeout_function_decorator.timeout_decorator import timeout
@@ -13,6 +15,18 @@ MODEL = "gpt-4-1106-preview"
 
 load_dotenv()
 
+_openai_client = None
+
+
+def get_openai_client():
+    """
+    :return: The OpenAI client shared by every GptLlm in the process, so all personas use one connection pool.
+    """
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = OpenAI(api_key=os.getenv("OPEN_API_KEY"))
+    return _openai_client
+
 
 class GptLlm(LlmClient):
 
@@ -21,18 +35,24 @@ class GptLlm(LlmClient):
         self.max_response_tokens = max_response_tokens
         self.max_context_tokens = max_context_tokens
         self.model = model
-        self.openai_client = OpenAI(api_key=os.getenv("OPEN_API_KEY"))
+        self.openai_client = get_openai_client()
+        self.prompt_builder = PromptBuilder(convert_message)
+
+    def warm_up(self):
+        # any cheap request opens a connection the client's pool keeps alive
+        self.openai_client.models.retrieve(self.model, timeout=WARM_UP_TIMEOUT)
 
     @timeout(8)
-    def response_generator(self, messages):
+    def response_generator(self, messages, token=None):
         """
         Converts openai chat completion generator chunks into text chunks.
         :param messages: List of messages of appropriate dictionaries
         :return:
         """
 
-        messages = [{'content': d['content'], 'role': d['role'].__str__()} for d in messages]
+        messages = self.prompt_builder.build(messages, bump=self.bump_system_message)
 
+        token = self._begin_request(token)
         raw_generator = self.openai_client.chat.completions.create(
             model=self.model,
             messages=messages,
@@ -40,9 +60,17 @@ class GptLlm(LlmClient):
             max_tokens=MAX_RESPONSE_TOKENS,
             stream=True
         )
+        if not self._attach_stream(token, raw_generator.response):
+            return
 
-        for chunk in raw_generator:
-            yield chunk.choices[0].delta.content
+        try:
+            for chunk in raw_generator:
+                yield chunk.choices[0].delta.content
+        except Exception:
+            if not token.cancelled:
+                raise
+        finally:
+            self._detach_stream(token)
 
     # @timeout(15)
     # def get_response(self, message):
@@ -59,3 +87,7 @@ class GptLlm(LlmClient):
     #     self.append_message("assistant", response, to_disk=True)
     #
     #     return response
+
+
+def convert_message(message):
+    return {'content': message['content'], 'role': str(message['role'])}
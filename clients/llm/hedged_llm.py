@@ -0,0 +1,190 @@
+import logging
+import queue
+import threading
+import time
+
+from clients.llm.llm_interface import LlmClient
+from clients.warmup import warm_up_all
+
+HEDGE_AFTER = 1.5  # seconds without a first token before the request is also sent to the next backend
+FIRST_TOKEN_TIMEOUT = 8  # seconds without a first token from any backend before giving up
+EWMA_ALPHA = 0.3  # weight of the newest time-to-first-token sample
+
+
+class HedgedLlm(LlmClient):
+    """
+    Sends each request to the backend with the lowest expected time-to-first-token (an EWMA per backend). If it
+    hasn't streamed its first token within the hedging budget, or fails before doing so, the request is also sent to
+    the next backend. Whichever streams a token first wins and the others are cancelled. With a single backend, it
+    only enforces the first token timeout.
+    """
+
+    def __init__(self, persona, backends, hedge_after=HEDGE_AFTER, first_token_timeout=FIRST_TOKEN_TIMEOUT):
+        super().__init__(persona)
+        if not backends:
+            raise ValueError("HedgedLlm needs at least one backend")
+        self.backends = backends
+        self.hedge_after = hedge_after
+        self.first_token_timeout = first_token_timeout
+
+        self.names = {}
+        for backend in backends:
+            name = backend_name(backend)
+            while name in self.names.values():
+                name += "'"
+            self.names[id(backend)] = name
+        self.ttft_ewma = {name: None for name in self.names.values()}
+
+        # the conversation has to fit every backend
+        self.max_context_tokens = min(b.max_context_tokens for b in backends)
+        self.max_response_tokens = min(b.max_response_tokens for b in backends)
+        # each backend moves the system message (or not) when it builds its prompt
+        self.bump_system_message = False
+        self.model = backends[0].model  # model of the backend that answered last
+        self.active_requests = []  # (backend, RequestToken) of every backend the current request was sent to
+
+    @property
+    def token_model(self):
+        return self.backends[0].token_model
+
+    def name(self, backend):
+        return self.names[id(backend)]
+
+    def ranked_backends(self):
+        """
+        Backends ordered by expected time-to-first-token. Backends that haven't been measured yet go first, in their
+        configured order, so they get sampled.
+        """
+        return sorted(self.backends, key=lambda b: (self.ttft_ewma[self.name(b)] is not None,
+                                                   self.ttft_ewma[self.name(b)] or 0))
+
+    def record_ttft(self, backend, seconds):
+        name = self.name(backend)
+        previous = self.ttft_ewma[name]
+        self.ttft_ewma[name] = seconds if previous is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * previous
+
+    def warm_up(self):
+        # a hedged request can go to any backend
+        return warm_up_all({self.name(backend): backend.warm_up for backend in self.backends})
+
+    def release_caches(self):
+        for backend in self.backends:
+            backend.release_caches()
+
+    def response_generator(self, messages, token=None):
+        token = self._begin_request(token)
+        self.active_requests = []
+        try:
+            yield from self._race(messages, token)
+        except GeneratorExit:
+            # the caller stopped reading (e.g. barge-in)
+            self._cancel_backends(self.active_requests)
+            raise
+
+    def _race(self, messages, token):
+        events = queue.Queue()
+        candidates = self.ranked_backends()
+        started = {}  # backend name -> time.perf_counter() when the request was sent
+        failed = set()
+
+        def consume(backend, backend_token):
+            try:
+                for chunk in backend.response_generator(messages, token=backend_token):
+                    events.put(("chunk", backend, chunk))
+            except Exception as e:
+                events.put(("error", backend, e))
+            else:
+                events.put(("end", backend, None))
+
+        def start_next():
+            for backend in candidates:
+                if self.name(backend) not in started:
+                    started[self.name(backend)] = time.perf_counter()
+                    # created before the backend is made active, so cancelling it reaches the request even if its
+                    # thread hasn't sent it yet
+                    backend_token = backend.new_request()
+                    self.active_requests.append((backend, backend_token))
+                    threading.Thread(target=consume, args=(backend, backend_token), daemon=True).start()
+                    logging.debug(f"LLM request sent to {self.name(backend)}")
+                    return True
+            return False
+
+        start_time = time.perf_counter()
+        deadline = start_time + self.first_token_timeout
+        next_hedge = start_time + self.hedge_after
+        start_next()
+
+        # wait for the first token
+        winner = None
+        while winner is None:
+            if token.cancelled:
+                return
+            now = time.perf_counter()
+            if now >= deadline:
+                self._cancel_backends(self.active_requests)
+                raise TimeoutError(f"No LLM backend produced a token within {self.first_token_timeout} seconds")
+            try:
+                kind, backend, payload = events.get(timeout=min(next_hedge, deadline) - now)
+            except queue.Empty:
+                if time.perf_counter() >= next_hedge:
+                    if start_next():
+                        logging.info(f"No first token after {time.perf_counter() - start_time:.1f} seconds. "
+                                     f"Hedging request...")
+                    next_hedge += self.hedge_after
+                continue
+
+            name = self.name(backend)
+            if kind == "chunk" and payload:
+                winner = backend
+                self.record_ttft(backend, time.perf_counter() - started[name])
+            elif kind in ("error", "end"):
+                # fail over right away; the failure counts as a slow first token
+                failed.add(name)
+                self.record_ttft(backend, time.perf_counter() - started[name] + self.hedge_after)
+                logging.warning(f"LLM backend {name} failed before its first token: {payload}")
+                if not start_next() and len(failed) == len(started):
+                    if isinstance(payload, Exception):
+                        raise payload
+                    return
+
+        losing_requests = [(b, t) for b, t in self.active_requests if b is not winner]
+        self._cancel_backends(losing_requests)
+        for loser, _ in losing_requests:
+            if self.name(loser) not in failed:
+                # it took at least this long, so use it as a lower bound
+                self.record_ttft(loser, time.perf_counter() - started[self.name(loser)])
+        self.model = winner.model
+        logging.info(f"LLM response from {self.name(winner)} "
+                     f"(first token after {time.perf_counter() - start_time:.2f} seconds)")
+
+        yield payload
+        while True:
+            kind, backend, payload = events.get()
+            if backend is not winner:
+                continue
+            if kind == "chunk":
+                yield payload
+            elif kind == "error" and not token.cancelled:
+                raise payload
+            else:
+                return
+
+    @staticmethod
+    def _cancel_backends(requests):
+        """
+        :param requests: List of (backend, RequestToken). Only these requests are cancelled, not whatever else the
+        backend is doing by then.
+        """
+        for backend, backend_token in requests:
+            backend.cancel(backend_token)
+
+    def cancel(self, token=None):
+        super().cancel(token)
+        self._cancel_backends(self.active_requests)
+
+    def latency_report(self):
+        return {name: (f"{ewma * 1000:.0f} ms" if ewma is not None else "n/a") for name, ewma in self.ttft_ewma.items()}
+
+
+def backend_name(backend):
+    return f"{type(backend).__name__}({backend.model})" if backend.model else type(backend).__name__
@@ -0,0 +1,76 @@
+import importlib
+import json
+import logging
+import os
+
+LLM_CONFIG_PATH = "config/llm.json"
+
+# backends are imported lazily so only the SDKs of configured backends need to be installed
+BACKENDS = {
+    "gpt": ("clients.llm.gpt_llm", "GptLlm"),
+    "google": ("clients.llm.google_llm", "GoogleLlm"),
+    "local": ("clients.llm.local_llm", "LocalLlm"),
+}
+
+
+def get_llm_config():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    file_path = os.path.join(dir_path, "../..", LLM_CONFIG_PATH)
+
+    with open(file_path) as f:
+        try:
+            return json.load(f)
+        except json.decoder.JSONDecodeError:
+            logging.error(f"Error in llm config file (extra comma?): {file_path}")
+            exit(1)
+
+
+def create_backend(persona, backend_config):
+    """
+    :param backend_config: Dictionary with the backend 'type' (see BACKENDS). The other keys are passed to the
+    client's constructor (e.g. 'model', 'url', 'max_context_tokens').
+    """
+    backend_config = dict(backend_config)
+    backend_type = backend_config.pop('type')
+    if backend_type not in BACKENDS:
+        raise KeyError(f"Unknown LLM backend '{backend_type}'. Expected one of {', '.join(BACKENDS)}.")
+    module_name, class_name = BACKENDS[backend_type]
+    client_class = getattr(importlib.import_module(module_name), class_name)
+    return client_class(persona, **backend_config)
+
+
+def create_llm_client(persona, config=None, count_tokens=None):
+    """
+    Creates the LLM client described by config/llm.json: a HedgedLlm over the backends, in order of preference. It
+    wraps a single backend as well, so first_token_timeout applies to every request. If the config has "routes"
+    instead, each route is created the same way and a RoutedLlm picks one per turn.
+    :param count_tokens: Function taking a text and a model name and returning its token count. RoutedLlm needs it
+    for the token budgets.
+    """
+    from clients.llm.hedged_llm import HEDGE_AFTER, FIRST_TOKEN_TIMEOUT, HedgedLlm
+
+    config = config if config else get_llm_config()
+    if 'routes' in config:
+        return create_router(persona, config, count_tokens)
+    backends = [create_backend(persona, backend_config) for backend_config in config['backends']]
+    return HedgedLlm(persona, backends,
+                     hedge_after=config.get('hedge_after', HEDGE_AFTER),
+                     first_token_timeout=config.get('first_token_timeout', FIRST_TOKEN_TIMEOUT))
+
+
+def create_router(persona, config, count_tokens):
+    from clients.llm import router
+
+    root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..")
+    # routes inherit the top-level hedging settings unless they set their own
+    shared = {key: config[key] for key in ('hedge_after', 'first_token_timeout') if key in config}
+    routes = {name: create_llm_client(persona, {**shared, **route}) for name, route in config['routes'].items()}
+    budgets = {name: route['token_budget'] for name, route in config['routes'].items() if 'token_budget' in route}
+    usage = router.get_token_usage(os.path.join(root_dir, config.get('usage_file', router.USAGE_PATH)),
+                                   config.get('budget_window_hours', router.BUDGET_WINDOW_HOURS))
+    decision_log = config.get('decision_log', router.DECISION_LOG_PATH)
+    return router.RoutedLlm(persona, routes, count_tokens, budgets=budgets, usage=usage,
+                            decision_log=os.path.join(root_dir, decision_log) if decision_log else None,
+                            long_query_words=config.get('long_query_words', router.LONG_QUERY_WORDS),
+                            ttft_target=config.get('ttft_target', router.TTFT_TARGET),
+                            ttft_probe_interval=config.get('ttft_probe_interval', router.TTFT_PROBE_INTERVAL))
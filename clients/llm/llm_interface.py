@@ -1,14 +1,46 @@
 from abc import ABC, abstractmethod
 
+from clients.cancellable import CancellableClient
 
-class LlmClient(ABC):
+
+class LlmClient(ABC, CancellableClient):
 
     def __init__(self, persona):
+        CancellableClient.__init__(self)
         self.persona = persona
-        self.bump_system_message = True  # whether to move system message near the end of the conversation
+        # whether to move system message near the end of the conversation, see PromptBuilder.build()
+        self.bump_system_message = True
+
+    @property
+    def token_model(self):
+        """
+        Model whose tokenizer counts the conversation's tokens. It must not change between requests, so the counts
+        cached on messages stay valid.
+        """
+        return self.model
+
+    def warm_up(self):
+        """
+        Opens the connection to the backend ahead of a request so the request doesn't pay for DNS, TCP and TLS
+        setup. Called on wake word while the user is still speaking. Does nothing by default.
+        """
+        pass
+
+    def release_caches(self):
+        """
+        Drops what the client keeps about the conversation between requests (e.g. converted prompt messages) while
+        its persona is inactive. It is rebuilt by the next request.
+        """
+        prompt_builder = getattr(self, "prompt_builder", None)
+        if prompt_builder is not None:
+            prompt_builder.clear()
 
     @abstractmethod
-    def response_generator(self, text):
+    def response_generator(self, messages, token=None):
+        """
+        :param token: RequestToken from new_request(), so the request can be cancelled before it has started.
+        """
         raise NotImplementedError(f"TTS Client {type(self)} has not implemented audio_chunk_generator()")
 
-    # TODO create a function to convert roles to whatever roles this model uses
\ No newline at end of file
+    # TODO create a function to convert roles to whatever roles this model uses
+
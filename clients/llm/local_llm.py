@@ -1,17 +1,21 @@
 import logging
 import json
 import os
+import uuid
 
 import requests
 from dotenv import load_dotenv
 from timeout_function_decorator.timeout_decorator import timeout
 
 from clients.llm.llm_interface import LlmClient
+from clients.llm.prompt_builder import PromptBuilder
+from clients.warmup import WARM_UP_TIMEOUT
 from enums.role_enum import Role
 
 MAX_RESPONSE_TOKENS = 200
 MAX_CONTEXT_TOKENS = 4096
 MODEL = None  # can't be set with this api
+CACHE_MISS_STATUS = 409  # the server no longer has the session's messages
 
 load_dotenv()
 
@@ -19,34 +23,78 @@ load_dotenv()
 class LocalLlm(LlmClient):
 
     def __init__(self, persona, max_response_tokens=MAX_RESPONSE_TOKENS, max_context_tokens=MAX_CONTEXT_TOKENS,
-                 model=MODEL):
+                 model=MODEL, url=None, session=False):
+        """
+        :param session: Whether the server keeps the conversation (and its KV cache) between requests. Only messages
+        the server hasn't seen are sent; see request_body().
+        """
         super().__init__(persona)
 
         self.max_response_tokens = max_response_tokens
         self.max_context_tokens = max_context_tokens
         self.model = model
-        # self.first_message = True  # the api only requires the most recent message once it has built a cache
+        self.url = url if url else os.getenv("LOCAL_LLM_URL")
+        self.session = requests.Session()  # keeps the connection alive between requests
+        self.prompt_builder = PromptBuilder(serialize_message)
+        self.session_id = f"{getattr(persona, 'name', 'natalie')}-{uuid.uuid4().hex}" if session else None
+        self.session_length = 0  # leading messages of the last prompt the server has for this session
+        if session:
+            # moving the system message would change the prefix the server has cached on every turn
+            self.bump_system_message = False
+
+    def warm_up(self):
+        # the status doesn't matter, only that the connection is open
+        self.session.head(self.url, timeout=WARM_UP_TIMEOUT)
+
+    def release_caches(self):
+        # rehydrated messages are new objects, so the next request resends the session's messages anyway
+        super().release_caches()
+        self.session_length = 0
 
     @timeout(8)
-    def response_generator(self, messages):
+    def response_generator(self, messages, token=None):
         suffix = "</s>"
-        headers = {'Content-Type': 'application/json'}
+        serialized = self.prompt_builder.build(messages, bump=self.bump_system_message)
 
-        # uses "bot" instead of "assistant" -- also add the </s> back to bot messages
-        messages = [{**message, 'role': 'bot', 'content': message['content'] + "</s>"} if message[
-                                                                                              'role'] == Role.ASSISTANT else message
-                    for message in messages]
-        messages = json.dumps({"messages": messages})
-
-        response = requests.post(os.getenv("LOCAL_LLM_URL"), data=messages, stream=True, headers=headers)
+        token = self._begin_request(token)
+        if self.session_id:
+            # messages are compared by identity; pruning the start of the conversation invalidates the whole session
+            keep = min(self.prompt_builder.unchanged_prefix, self.session_length)
+            self.session_length = 0
+            response = self.post(request_body(serialized[keep:], self.session_id, keep))
+            if response.status_code == CACHE_MISS_STATUS:
+                logging.info("Local LLM session not cached. Resending the whole conversation...")
+                response.close()
+                response = self.post(request_body(serialized, self.session_id, 0))
+            self.session_length = len(serialized) if response.status_code == 200 else 0
+        else:
+            response = self.post(request_body(serialized))
         if response.status_code != 200:
             logging.debug2(response.json())
             raise requests.exceptions.HTTPError(f"Received status code {response.status_code} from LLM")
+        if not self._attach_stream(token, response):
+            self.session_length = 0
+            return
+
+        complete = False
+        try:
+            for chunk in response.iter_content(chunk_size=None):
+                if chunk:
+                    chunk = chunk.decode('utf-8')
+                    yield chunk[:-len(suffix)] if chunk.endswith(suffix) else chunk
+            complete = not token.cancelled
+        except Exception:
+            if not token.cancelled:
+                raise
+        finally:
+            self._detach_stream(token)
+            if not complete:
+                # the server's session has a partial reply (e.g. it lost a hedged race or was cancelled), so don't
+                # trust any of it
+                self.session_length = 0
 
-        for chunk in response.iter_content(chunk_size=None):
-            if chunk:
-                chunk = chunk.decode('utf-8')
-                yield chunk[:-len(suffix)] if chunk.endswith(suffix) else chunk
+    def post(self, body):
+        return self.session.post(self.url, data=body, stream=True, headers={'Content-Type': 'application/json'})
 
     # @timeout(15)
     # def get_response(self, message):
@@ -63,3 +111,22 @@ class LocalLlm(LlmClient):
     #     self.append_message("assistant", response, to_disk=True)
     #
     #     return response
+
+
+def serialize_message(message):
+    # uses "bot" instead of "assistant" -- also add the </s> back to bot messages
+    if message['role'] == Role.ASSISTANT:
+        return json.dumps({'role': 'bot', 'content': message['content'] + "</s>"})
+    return json.dumps({'role': str(message['role']), 'content': message['content']})
+
+
+def request_body(serialized_messages, session_id=None, keep=0):
+    """
+    Joins serialized messages into the same body json.dumps({"messages": [...]}) would produce.
+    :param session_id: With a session, the server keeps the first 'keep' messages it has for the session and appends
+    the given messages to them.
+    """
+    messages = '[' + ', '.join(serialized_messages) + ']'
+    if session_id:
+        return f'{{"session": {json.dumps(session_id)}, "keep": {keep}, "messages": {messages}}}'
+    return f'{{"messages": {messages}}}'
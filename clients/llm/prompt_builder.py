@@ -0,0 +1,155 @@
+import itertools
+
+from enums.role_enum import Role
+
+_generations = itertools.count(1)
+
+
+def new_generation():
+    return next(_generations)
+
+
+class Prompt(list):
+    """
+    The messages of a prompt, system message first, as ConversationManager.get_conversation() hands them to the LLM
+    client. Prompts of one generation follow each other the way the conversation changes: 'start' messages pruned
+    from the front, messages popped from and appended to the end, and, after pruning, the messages up to the new
+    first user message rendered again. Nothing else changes, so PromptBuilder only converts what did.
+    """
+
+    def __init__(self, system_msg, messages, generation, start):
+        """
+        :param messages: The conversation after the system message.
+        :param generation: Changes whenever the conversation is rendered from scratch, see new_generation().
+        :param start: Number of messages pruned from the front of the conversation during this generation.
+        """
+        super().__init__((system_msg,))
+        self += messages
+        self.generation = generation
+        self.start = start
+
+
+def system_message_position(conversation):
+    """
+    :param conversation: Messages starting with the system message.
+    :return: Negative index into the rest of the conversation the system message is moved in front of, or None if
+    the conversation is too short to move it.
+    """
+    if len(conversation) <= 5:
+        return None
+    # don't place system message after a user message as some models don't like this
+    return -3 if conversation[-4]["role"] == Role.ASSISTANT else -4
+
+
+class PromptBuilder:
+    """
+    Keeps the backend-specific form of every message of the last prompt, so each turn only converts the messages
+    that are new in the conversation. Given a Prompt of the same generation as the last one, the messages that didn't
+    change aren't even looked at; any other list is matched message by message, by identity (the conversation
+    manager never edits a message, so a message that is still in the conversation converts to the same thing).
+    """
+
+    def __init__(self, convert):
+        """
+        :param convert: Function that takes a message dictionary and returns its backend-specific form.
+        """
+        self.convert = convert
+        self.clear()
+
+    def clear(self):
+        self.generation = None
+        self.start = 0
+        self.system = None  # (system message, converted) of the last build
+        self.sources = []  # the other messages of the last build. Kept so their ids can't be reused.
+        self.converted = []  # their converted forms
+        self.converted_count = 0  # messages converted by the last build()
+        self.unchanged_prefix = 0  # leading messages of the last build() that were the same in the one before
+
+    def build(self, messages, bump=False):
+        """
+        :param messages: Messages of the prompt, system message first, ideally a Prompt.
+        :param bump: Whether to move the system message near the end, see system_message_position().
+        :return: List of the converted messages, in order.
+        """
+        self.converted_count = 0
+        if isinstance(messages, Prompt) and messages.generation == self.generation and messages.start >= self.start:
+            unchanged = self._update(messages)
+        else:
+            unchanged = self._rebuild(messages)
+        if isinstance(messages, Prompt):
+            self.generation, self.start = messages.generation, messages.start
+        else:
+            self.generation, self.start = None, 0
+
+        if self.system is None or self.system[0] is not messages[0]:
+            self.system = (messages[0], self.convert(messages[0]))
+            self.converted_count += 1
+            unchanged = -1
+        self.unchanged_prefix = unchanged + 1
+
+        position = system_message_position(messages) if bump else None
+        if position is None:
+            return [self.system[1]] + self.converted
+        prompt = self.converted[:]
+        prompt.insert(len(prompt) + position, self.system[1])
+        return prompt
+
+    def _convert(self, message):
+        self.converted_count += 1
+        return self.convert(message)
+
+    def _update(self, prompt):
+        """
+        Applies the changes since the last Prompt of the same generation.
+        :return: Number of leading messages (after the system message) that didn't change.
+        """
+        sources, converted = self.sources, self.converted
+        pruned = prompt.start - self.start
+        if pruned:
+            del sources[:pruned]
+            del converted[:pruned]
+        count = len(prompt) - 1
+        del sources[count:]
+        del converted[count:]
+        unchanged = len(sources)
+
+        # pruning renders the new first user message again
+        for i in range(len(sources)):
+            message = prompt[i + 1]
+            if sources[i] is not message:
+                sources[i] = message
+                converted[i] = self._convert(message)
+                unchanged = min(unchanged, i)
+            if message['role'] == Role.USER:
+                break
+        # messages popped from the end and replaced
+        i = len(sources) - 1
+        while i >= 0 and sources[i] is not prompt[i + 1]:
+            sources[i] = prompt[i + 1]
+            converted[i] = self._convert(sources[i])
+            unchanged = min(unchanged, i)
+            i -= 1
+        for message in prompt[len(sources) + 1:]:
+            sources.append(message)
+            converted.append(self._convert(message))
+        # pruning moves every message, which matters to backends that keep the conversation (see LocalLlm)
+        return 0 if pruned else unchanged
+
+    def _rebuild(self, messages):
+        """
+        Converts a prompt that isn't a continuation of the last one, reusing the converted messages it shares with it.
+        :return: Number of leading messages (after the system message) that are the same as in the last build.
+        """
+        previous = {id(message): form for message, form in zip(self.sources, self.converted)}
+        sources = messages[1:]
+        converted = []
+        unchanged = 0
+        for i, message in enumerate(sources):
+            form = previous.get(id(message))
+            if form is None:
+                form = self._convert(message)
+            converted.append(form)
+            if unchanged == i and i < len(self.sources) and self.sources[i] is message:
+                unchanged += 1
+        self.sources, self.converted = sources, converted
+        return unchanged
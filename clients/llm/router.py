@@ -0,0 +1,306 @@
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+from enum import Enum
+
+from clients.llm.hedged_llm import EWMA_ALPHA
+from clients.llm.llm_interface import LlmClient
+from clients.warmup import warm_up_all
+from enums.role_enum import Role
+from message import Message, remove_timestamp
+
+USAGE_PATH = "personas/llm_usage.json"
+DECISION_LOG_PATH = "personas/llm_routing.jsonl"
+BUDGET_WINDOW_HOURS = 24  # token budgets apply to a rolling window of this many hours
+LONG_QUERY_WORDS = 25  # queries at least this long always go to the capable route
+TTFT_TARGET = 1.5  # seconds; plain questions go to the fast route while the capable route is slower than this
+TTFT_PROBE_INTERVAL = 300  # seconds after which a plain question goes to a slow capable route to measure it again
+SAVE_DELAY = 10  # seconds token usage is kept in memory before it is written to the file
+
+CHITCHAT_REGEX = re.compile(
+    r"^(hi|hello|hey|yo|good (morning|afternoon|evening|night)|how are you|how's it going|what's up|thanks|thank you|"
+    r"ok|okay|cool|nice|great|awesome|sure|yes|yeah|yep|no|nope|i'm (good|fine|great|back|home|tired)|"
+    r"i love you|good job|well done|never ?mind|goodbye|bye|see you)\b")
+COMPLEX_REGEX = re.compile(
+    r"\b(explain|why|how (do|does|did|can|could|would|should|to)|compare|difference between|write|plan|summari[sz]e|"
+    r"translate|calculate|solve|analy[sz]e|code|program|recipe|steps|pros and cons|help me|step by step)\b")
+
+
+class Intent(Enum):
+    CHITCHAT = "chitchat"
+    QUESTION = "question"
+    COMPLEX = "complex"
+
+
+def classify_intent(query):
+    query = query.strip().lower()
+    if COMPLEX_REGEX.search(query):
+        return Intent.COMPLEX
+    if CHITCHAT_REGEX.search(query) or ("?" not in query and len(query.split()) < 6):
+        return Intent.CHITCHAT
+    return Intent.QUESTION
+
+
+class TokenUsage:
+    """
+    Tokens used per model over a rolling window plus the measured time-to-first-token per model, stored in a json
+    file so budgets survive restarts. Use get_token_usage() so every client in the process shares one instance per
+    file.
+    """
+
+    def __init__(self, file_path, window_hours=BUDGET_WINDOW_HOURS):
+        self.file_path = file_path
+        self.window = window_hours * 3600
+        self.lock = threading.Lock()
+        self.usage = {}  # model -> [[timestamp, tokens], ...]
+        self.ttft = {}  # model -> EWMA in seconds
+        self.ttft_time = {}  # model -> time.time() of the last TTFT sample
+        self.save_timer = None  # pending save, see record()
+        try:
+            with open(file_path) as f:
+                data = json.load(f)
+            self.usage = data.get('usage', {})
+            self.ttft = data.get('ttft', {})
+            self.ttft_time = data.get('ttft_time', {})
+        except FileNotFoundError:
+            pass
+        except (json.decoder.JSONDecodeError, AttributeError) as e:
+            logging.warning(f"Ignoring unreadable token usage file {file_path}: {e}")
+        self._prune(time.time())
+
+    def _prune(self, now):
+        for model in self.usage:
+            self.usage[model] = [entry for entry in self.usage[model] if entry[0] > now - self.window]
+
+    def used(self, model):
+        with self.lock:
+            self._prune(time.time())
+            return sum(tokens for _, tokens in self.usage.get(model, []))
+
+    def record(self, model, tokens, ttft=None):
+        """
+        Records a request. The file is written SAVE_DELAY seconds later, together with whatever else was recorded
+        meanwhile, and when the process exits (see get_token_usage()).
+        """
+        with self.lock:
+            now = time.time()
+            self.usage.setdefault(model, []).append([round(now, 1), tokens])
+            if ttft is not None:
+                previous = self.ttft.get(model)
+                self.ttft[model] = ttft if previous is None else EWMA_ALPHA * ttft + (1 - EWMA_ALPHA) * previous
+                self.ttft_time[model] = round(now, 1)
+            self._prune(now)
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(SAVE_DELAY, self.save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def save(self):
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            data = json.dumps({'usage': self.usage, 'ttft': self.ttft, 'ttft_time': self.ttft_time})
+        # write a tmp file first so a crash mid-write doesn't corrupt the usage history
+        try:
+            with open(f"{self.file_path}.tmp", "w") as f:
+                f.write(data)
+            os.replace(f"{self.file_path}.tmp", self.file_path)
+        except OSError as e:
+            logging.warning(f"Error saving token usage to {self.file_path}: {e}")
+
+    def flush(self):
+        """
+        Saves a pending update right away.
+        """
+        if self.save_timer is not None:
+            self.save()
+
+
+_token_usage = {}
+_token_usage_lock = threading.Lock()
+
+
+def get_token_usage(file_path, window_hours=BUDGET_WINDOW_HOURS):
+    with _token_usage_lock:
+        if file_path not in _token_usage:
+            _token_usage[file_path] = TokenUsage(file_path, window_hours)
+            atexit.register(_token_usage[file_path].flush)
+        return _token_usage[file_path]
+
+
+class RoutedLlm(LlmClient):
+    """
+    Picks a route per turn: "capable" for complex or long queries, "fast" for chit-chat, where time-to-first-token
+    matters more than quality. Plain questions use the capable route unless it is currently slower than the TTFT
+    target. A route whose token budget for the rolling window is used up is skipped. Each route is a regular LLM
+    client (a HedgedLlm, see create_llm_client()).
+    """
+
+    def __init__(self, persona, routes, count_tokens, budgets=None, usage=None, decision_log=None,
+                 long_query_words=LONG_QUERY_WORDS, ttft_target=TTFT_TARGET, ttft_probe_interval=TTFT_PROBE_INTERVAL):
+        """
+        :param routes: Dictionary with the "fast" and "capable" LLM clients.
+        :param count_tokens: Function taking a text and a model name and returning the text's token count, for the
+        token budgets.
+        :param budgets: Dictionary of route name to the maximum tokens per window. Routes without a budget are
+        unlimited.
+        :param usage: TokenUsage shared by all routers.
+        :param decision_log: Path of a jsonl file every routing decision is appended to, or None.
+        :param ttft_probe_interval: Seconds after which a plain question goes to the capable route even if it was
+        slower than the TTFT target, so its TTFT gets measured again.
+        """
+        super().__init__(persona)
+        for route in ("fast", "capable"):
+            if route not in routes:
+                raise KeyError(f"RoutedLlm needs a '{route}' route")
+        self.routes = routes
+        self.count_tokens = count_tokens
+        self.budgets = budgets if budgets else {}
+        self.usage = usage if usage else get_token_usage(os.path.join(_root_dir(), USAGE_PATH))
+        self.decision_log = decision_log
+        self.long_query_words = long_query_words
+        self.ttft_target = ttft_target
+        self.ttft_probe_interval = ttft_probe_interval
+        self.last_probe = 0  # time.time() when a plain question was last sent to a slow capable route
+
+        # the conversation has to fit every route
+        self.max_context_tokens = min(client.max_context_tokens for client in routes.values())
+        self.max_response_tokens = min(client.max_response_tokens for client in routes.values())
+        # each route moves the system message (or not) when it builds its prompt
+        self.bump_system_message = False
+        self.model = routes['capable'].model  # model of the route that answered last
+        self.active_request = None  # (client, RequestToken) of the current request
+
+    @property
+    def token_model(self):
+        # usage is counted with the same tokenizer whichever route answers, so cached message counts stay valid
+        return self.routes['capable'].token_model
+
+    def budget_left(self, route):
+        if route not in self.budgets:
+            return None
+        return self.budgets[route] - self.usage.used(self.routes[route].model)
+
+    def choose_route(self, query):
+        """
+        :return: Tuple of the route name and a dictionary describing the decision.
+        """
+        words = len(query.split())
+        intent = classify_intent(query)
+        capable_model = self.routes['capable'].model
+        capable_ttft = self.usage.ttft.get(capable_model)
+
+        if words >= self.long_query_words:
+            route, reason = "capable", "long query"
+        elif intent == Intent.COMPLEX:
+            route, reason = "capable", "complex request"
+        elif intent == Intent.CHITCHAT:
+            route, reason = "fast", "chit-chat"
+        elif capable_ttft is not None and capable_ttft > self.ttft_target:
+            # questions only go to the capable route again once its TTFT is measured again
+            now = time.time()
+            if now - max(self.usage.ttft_time.get(capable_model, 0), self.last_probe) >= self.ttft_probe_interval:
+                self.last_probe = now
+                route, reason = "capable", f"probing capable route TTFT ({capable_ttft:.2f}s over target)"
+            else:
+                route, reason = "fast", f"capable route TTFT {capable_ttft:.2f}s over target"
+        else:
+            route, reason = "capable", "question"
+
+        budget_left = self.budget_left(route)
+        if budget_left is not None and budget_left <= 0:
+            other = "fast" if route == "capable" else "capable"
+            other_left = self.budget_left(other)
+            if other_left is None or other_left > 0:
+                route, reason = other, f"{reason}; {route} token budget used up"
+
+        decision = {
+            "time": round(time.time(), 1),
+            "persona": getattr(self.persona, 'name', None),
+            "words": words,
+            "intent": intent.value,
+            "route": route,
+            "model": self.routes[route].model,
+            "reason": reason,
+            "budget_left": {name: self.budget_left(name) for name in self.routes},
+            "ttft_ewma": {name: _round(self.usage.ttft.get(client.model)) for name, client in self.routes.items()},
+        }
+        return route, decision
+
+    def warm_up(self):
+        # the route isn't known until the query is transcribed
+        return warm_up_all({route: client.warm_up for route, client in self.routes.items()})
+
+    def release_caches(self):
+        for client in self.routes.values():
+            client.release_caches()
+
+    def response_generator(self, messages, token=None):
+        token = self._begin_request(token)
+        query = next((remove_timestamp(m['content']) for m in reversed(messages) if m['role'] == Role.USER), "")
+        route, decision = self.choose_route(query)
+        client = self.routes[route]
+        # created before the client is made active, so a cancel() from now on reaches the request
+        client_token = client.new_request()
+        self.active_request = (client, client_token)
+        self.model = client.model
+        if token.cancelled:
+            return
+        logging.info(f"Routing to {route} ({client.model}): {decision['reason']}")
+
+        start_time = time.perf_counter()
+        ttft = None
+        response = ""
+        try:
+            for chunk in client.response_generator(messages, token=client_token):
+                if token.cancelled:
+                    return
+                if chunk:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start_time
+                    response += chunk
+                yield chunk
+        finally:
+            self._record(client, decision, messages, response, ttft, token.cancelled)
+
+    def _record(self, client, decision, messages, response, ttft, cancelled):
+        # the prompt is paid for even if the response was cut short
+        prompt_tokens = sum(self.message_tokens(m) for m in messages)
+        response_tokens = self.count_tokens(response, self.token_model)
+        self.usage.record(client.model, prompt_tokens + response_tokens, ttft)
+
+        if self.decision_log:
+            decision = {**decision, "ttft": _round(ttft),
+                        "prompt_tokens": prompt_tokens, "response_tokens": response_tokens,
+                        "cancelled": cancelled}
+            try:
+                with open(self.decision_log, "a") as f:
+                    f.write(json.dumps(decision) + "\n")
+            except OSError as e:
+                logging.warning(f"Error writing routing decision to {self.decision_log}: {e}")
+
+    def message_tokens(self, message):
+        # Message records cache their count
+        if isinstance(message, Message):
+            return message.tokens(self.token_model, self.count_tokens)
+        return self.count_tokens(message['content'], self.token_model)
+
+    def cancel(self, token=None):
+        super().cancel(token)
+        active_request = self.active_request
+        if active_request is not None:
+            client, client_token = active_request
+            client.cancel(client_token)
+
+
+def _root_dir():
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..")
+
+
+def _round(seconds):
+    return round(seconds, 3) if seconds is not None else None
@@ -0,0 +1,100 @@
+import io
+import logging
+import os
+
+import requests
+from dotenv import load_dotenv
+from urllib3 import encode_multipart_formdata
+
+from clients.cancellable import CancellableClient
+from clients.warmup import WARM_UP_TIMEOUT
+
+MODEL = "whisper-1"
+BASE_URL = "https://api.openai.com/v1"
+TIMEOUT = 6  # seconds
+UPLOAD_BLOCK = 8192  # bytes sent between checks for a cancel()
+
+load_dotenv()
+
+
+class UploadCancelled(Exception):
+    pass
+
+
+class CancellableUpload(io.BytesIO):
+    """
+    Request body that stops the upload once its request is cancelled. urllib3 sends a file-like body in blocks read
+    from here, so a cancel() takes effect within one block and the connection is dropped.
+    """
+
+    def __init__(self, data, token):
+        super().__init__(data)
+        self.token = token
+
+    def read(self, size=-1):
+        if self.token.cancelled:
+            raise UploadCancelled()
+        return super().read(UPLOAD_BLOCK if size is None or size < 0 else min(size, UPLOAD_BLOCK))
+
+
+class OpenAiStt(CancellableClient):
+    """
+    Transcribes recordings with OpenAI's transcription endpoint over a kept-alive connection. Unlike the openai
+    module's client, a request can be cancelled from another thread: the upload stops right away, and a transcript
+    still on its way is dropped.
+    """
+
+    def __init__(self, url=None, model=MODEL, timeout=TIMEOUT):
+        super().__init__()
+        self.url = url if url else os.getenv("OPENAI_BASE_URL", BASE_URL)
+        self.model = model
+        self.timeout = timeout
+        self.session = requests.Session()  # keeps the connection alive between requests
+
+    def warm_up(self):
+        # the status doesn't matter, only that the connection is open
+        self.session.head(self.url, timeout=WARM_UP_TIMEOUT)
+
+    def transcribe(self, file_path, token=None):
+        """
+        Transcribes and removes an audio file.
+        :param token: RequestToken from new_request(), so the request can be cancelled before it has started.
+        :return: The transcript, or None if the request was cancelled.
+        """
+        token = self._begin_request(token)
+        try:
+            with open(file_path, "rb") as f:
+                data = f.read()
+        finally:
+            os.remove(file_path)
+        if token.cancelled:
+            return None
+
+        body, content_type = encode_multipart_formdata({
+            "file": (os.path.basename(file_path), data),
+            "model": self.model,
+            "response_format": "text",
+            "language": "en",
+        })
+        headers = {"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}", "Content-Type": content_type}
+        try:
+            response = self.session.post(f"{self.url}/audio/transcriptions", data=CancellableUpload(body, token),
+                                         headers=headers, stream=True, timeout=self.timeout)
+        except UploadCancelled:
+            logging.debug(f"Upload of {file_path} cancelled")
+            return None
+        if not self._attach_stream(token, response):
+            return None
+
+        try:
+            if response.status_code != 200:
+                raise requests.exceptions.HTTPError(f"Received status code {response.status_code} from STT")
+            text = response.text
+            return None if token.cancelled else text
+        except Exception:
+            if not token.cancelled:
+                raise
+            return None
+        finally:
+            self._detach_stream(token)
+            response.close()
@@ -7,10 +7,12 @@ from openai import OpenAI
 from timeout_function_decorator.timeout_decorator import timeout
 
 from clients.tts.tts_interface import TTSClient
+from clients.warmup import WARM_UP_TIMEOUT
 
 MODEL = 'tts-1'
 VOICE = 'shimmer'
 SAMPLE_RATE = 48000
+SPEECH_URL = "https://api.openai.com/v1/audio/speech"
 
 
 def decode_opus_to_pcm(opus_data):
@@ -41,9 +43,14 @@ class OpenAITTS(TTSClient):
         super().__init__(persona)
         self.openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         self.sample_rate = SAMPLE_RATE
+        self.session = requests.Session()  # keeps the connection alive between requests
+
+    def warm_up(self):
+        # the status doesn't matter, only that the connection is open
+        self.session.head(SPEECH_URL, timeout=WARM_UP_TIMEOUT)
 
     @timeout(8)
-    def get_audio_generator(self, text, model=MODEL, voice=VOICE):
+    def get_audio_generator(self, text, token=None, model=MODEL, voice=VOICE):
         # response = self.openai_client.audio.speech.create(
         #     model='tts-1',
         #     voice='alloy',
@@ -55,8 +62,6 @@ class OpenAITTS(TTSClient):
         #     yield resample_audio(audio_chunk, 24000, 16000)
         #     # yield resample_audio(audio_chunk, 46800, 16000)
 
-        url = "https://api.openai.com/v1/audio/speech"
-
         headers = {
             "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
         }
@@ -70,10 +75,19 @@ class OpenAITTS(TTSClient):
 
         # TODO figure out why this isn't actually streaming. I think the api is messed up.
         # TODO If there is only one chunk, it works. It seems that the data is being produced incorrectly and thus won't play in parts.
-        with requests.post(url, headers=headers, json=data, stream=True) as response:
-            for chunk in response.iter_content(chunk_size=4096):
-                # audio_segment = AudioSegment.from_file(BytesIO(chunk), format="opus")
-                # pcm_data = audio_segment.raw_data
-                if chunk:
-                    yield decode_opus_to_pcm(chunk)
+        token = self._begin_request(token)
+        with self.session.post(SPEECH_URL, headers=headers, json=data, stream=True) as response:
+            if not self._attach_stream(token, response):
+                return
+            try:
+                for chunk in response.iter_content(chunk_size=4096):
+                    # audio_segment = AudioSegment.from_file(BytesIO(chunk), format="opus")
+                    # pcm_data = audio_segment.raw_data
+                    if chunk:
+                        yield decode_opus_to_pcm(chunk)
+            except Exception:
+                if not token.cancelled:
+                    raise
+            finally:
+                self._detach_stream(token)
             # yield resample_audio(audio_chunk, 46800, 16000)
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 from contextlib import closing
@@ -10,26 +11,41 @@ from clients.tts.tts_interface import TTSClient
 
 SAMPLE_RATE = 16000
 
+_polly_client = None
+
+
+def get_polly_client():
+    """
+    :return: The Polly client shared by every PollyTTS in the process, so all personas use one connection pool.
+    """
+    global _polly_client
+    if _polly_client is None:
+        session = Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+                          aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'), region_name='us-east-1')
+        _polly_client = session.client("polly")
+    return _polly_client
+
 
 class PollyTTS(TTSClient):
 
     def __init__(self, persona):
         super().__init__(persona)
         self.sample_rate = SAMPLE_RATE
+        # created once so its connection pool is reused across requests (and personas)
+        self.polly = get_polly_client()
 
-    @timeout(8)
-    def get_audio_generator(self, text):
-
-        session = Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
-                          aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'), region_name='us-east-1')
-        polly = session.client("polly")
+    def warm_up(self):
+        self.polly.describe_voices(Engine=self.persona.voice_engine, LanguageCode="en-US")
 
+    @timeout(8)
+    def get_audio_generator(self, text, token=None):
+        token = self._begin_request(token)
         try:
             # Request speech synthesis
             text = self.apply_ssml(text)
-            response = polly.synthesize_speech(Text=text, TextType="ssml", OutputFormat="pcm",
-                                               SampleRate=str(self.sample_rate),
-                                               VoiceId=self.persona.voice_id, Engine=self.persona.voice_engine)
+            response = self.polly.synthesize_speech(Text=text, TextType="ssml", OutputFormat="pcm",
+                                                    SampleRate=str(self.sample_rate),
+                                                    VoiceId=self.persona.voice_id, Engine=self.persona.voice_engine)
         except (BotoCoreError, ClientError) as error:
             logging.error(error)
             return None
@@ -38,11 +54,41 @@ class PollyTTS(TTSClient):
             chunk_size = 131072
             # closing is important here because the service will throttle based on parallel connections.
             with closing(response["AudioStream"]) as stream:
-                while True:
-                    audio_chunk = stream.read(chunk_size)
-                    if not audio_chunk:
-                        break
-                    yield audio_chunk
+                if not self._attach_stream(token, stream):
+                    return
+                try:
+                    while True:
+                        audio_chunk = stream.read(chunk_size)
+                        if not audio_chunk:
+                            break
+                        yield audio_chunk
+                except Exception:
+                    if not token.cancelled:
+                        raise
+                finally:
+                    self._detach_stream(token)
         else:
             logging.warning("Could not stream audio")
             yield None
+
+    def word_marks(self, text):
+        ssml = self.apply_ssml(text)
+        try:
+            response = self.polly.synthesize_speech(Text=ssml, TextType="ssml", OutputFormat="json",
+                                                    SpeechMarkTypes=["word"], VoiceId=self.persona.voice_id,
+                                                    Engine=self.persona.voice_engine)
+            with closing(response["AudioStream"]) as stream:
+                lines = stream.read().decode("utf-8").splitlines()
+        except (BotoCoreError, ClientError, KeyError) as error:
+            logging.error(f"Could not get speech marks: {error}")
+            return None
+
+        # offsets are in bytes of the ssml
+        encoded = ssml.encode("utf-8")
+        prefix = len(encoded[:encoded.find(text.encode("utf-8"))])
+        marks = []
+        for line in lines:
+            mark = json.loads(line)
+            end = len(encoded[prefix:mark['end']].decode("utf-8", errors="ignore"))
+            marks.append((mark['time'] / 1000, end))
+        return marks
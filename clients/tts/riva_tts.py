@@ -2,12 +2,14 @@ import logging
 import os
 import time
 
+import grpc
 import numpy as np
 import riva.client
 import riva.client.audio_io
 from timeout_function_decorator.timeout_decorator import timeout
 
 from clients.tts.tts_interface import TTSClient
+from clients.warmup import WARM_UP_TIMEOUT
 
 SAMPLE_RATE = 16000
 
@@ -36,8 +38,11 @@ class RivaTTS(TTSClient):
 
         self.interrupted = False
 
+    def warm_up(self):
+        grpc.channel_ready_future(self.auth.channel).result(timeout=WARM_UP_TIMEOUT)
+
     @timeout(8)
-    def get_audio_generator(self, text):
+    def get_audio_generator(self, text, token=None):
         # text = self.buffer_text(text)
         text = self.filter_text(text)
         text = self.apply_ssml(text)
@@ -47,23 +52,32 @@ class RivaTTS(TTSClient):
 
         # logging.info(f"generating TTS for '{text}'")
 
+        token = self._begin_request(token)
         responses = self.tts_service.synthesize_online(
             text, self.persona.voice_id, self.language_code, sample_rate_hz=self.sample_rate
         )
+        if not self._attach_stream(token, responses):
+            return
 
-        for response in responses:
-            if self.interrupted:
-                logging.debug(f"TTS interrupted, terminating request early:  {text}")
-                break
-
-            samples = np.frombuffer(response.audio, dtype=np.int16)
-
-            current_time = time.perf_counter()
-            if current_time > self.needs_text_by:
-                self.needs_text_by = current_time
-            self.needs_text_by += len(samples) / self.sample_rate
-
-            yield samples
+        try:
+            for response in responses:
+                if self.interrupted:
+                    logging.debug(f"TTS interrupted, terminating request early:  {text}")
+                    break
+
+                samples = np.frombuffer(response.audio, dtype=np.int16)
+
+                current_time = time.perf_counter()
+                if current_time > self.needs_text_by:
+                    self.needs_text_by = current_time
+                self.needs_text_by += len(samples) / self.sample_rate
+
+                yield samples
+        except Exception:
+            if not token.cancelled:
+                raise
+        finally:
+            self._detach_stream(token)
 
     def buffer_text(self, text):
         """
@@ -1,17 +1,39 @@
 from abc import ABC, abstractmethod
 
+from clients.cancellable import CancellableClient
+
 SAMPLE_RATE = 1600
 
-class TTSClient(ABC):
+class TTSClient(ABC, CancellableClient):
 
     def __init__(self, persona):
+        CancellableClient.__init__(self)
         self.persona = persona
         self.sample_rate = SAMPLE_RATE
 
+    def warm_up(self):
+        """
+        Opens the connection to the TTS service ahead of a request. Called on wake word while the user is still
+        speaking. Does nothing by default.
+        """
+        pass
+
     @abstractmethod
-    def get_audio_generator(self, text):
+    def get_audio_generator(self, text, token=None):
+        """
+        :param token: RequestToken from new_request(), so the request can be cancelled before it has started.
+        """
         raise NotImplementedError(f"TTS Client {type(self)} has not implemented audio_chunk_generator()")
 
+    def word_marks(self, text):
+        """
+        When each word of a text starts in its synthesized audio, so an interrupted sentence can be cut at the last
+        word that was actually heard.
+        :return: List of (seconds from the start of the audio, offset in text after the word), or None if the
+        service doesn't provide them.
+        """
+        return None
+
     def filter_text(self, text):
         if not text:
             return None
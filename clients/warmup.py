@@ -0,0 +1,45 @@
+import logging
+import threading
+import time
+
+WARM_UP_TIMEOUT = 3  # seconds before a warm-up is given up on
+
+
+def warm_up_all(warm_ups):
+    """
+    Runs warm-up functions in parallel and waits for them to finish.
+    :param warm_ups: Dictionary of name to warm-up function.
+    :return: Dictionary of name to the seconds the warm-up took, or None if it failed or timed out.
+    """
+    results = {}
+
+    def run(name, warm_up):
+        start_time = time.perf_counter()
+        try:
+            warm_up()
+            results[name] = time.perf_counter() - start_time
+        except Exception as e:
+            logging.debug(f"Warm-up of {name} failed: {e}")
+
+    threads = [threading.Thread(target=run, args=item, daemon=True) for item in warm_ups.items()]
+    for thread in threads:
+        thread.start()
+    deadline = time.perf_counter() + WARM_UP_TIMEOUT
+    for thread in threads:
+        thread.join(max(0, deadline - time.perf_counter()))
+    return {name: results.get(name) for name in warm_ups}
+
+
+def warm_up_in_background(warm_ups):
+    """
+    Starts warm_up_all() without waiting for it and logs how long each connection took to open.
+    """
+
+    def run():
+        results = warm_up_all(warm_ups)
+        logging.info("Connections warmed up: " + ", ".join(
+            f"{name} {seconds:.2f}s" if seconds is not None else f"{name} failed" for name, seconds in results.items()))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
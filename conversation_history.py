@@ -0,0 +1,117 @@
+import threading
+
+CHUNK_SIZE = 64  # messages per chunk
+
+
+class HistorySnapshot:
+    """
+    Read-only view of the conversation at one version. It is never affected by later appends or pruning, so it can
+    be read from any thread without locking.
+    """
+
+    __slots__ = ("_chunks", "_base", "_start", "_stop", "version")
+
+    def __init__(self, chunks, base, start, stop, version):
+        self._chunks = chunks
+        self._base = base
+        self._start = start
+        self._stop = stop
+        self.version = version
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def _get(self, position):
+        return self._chunks[position // CHUNK_SIZE - self._base][position % CHUNK_SIZE]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(self._start + i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self._get(self._start + index)
+
+    def __iter__(self):
+        position = self._start
+        while position < self._stop:
+            chunk = self._chunks[position // CHUNK_SIZE - self._base]
+            end = min(len(chunk), self._stop - (position // CHUNK_SIZE) * CHUNK_SIZE)
+            for message in chunk[position % CHUNK_SIZE:end]:
+                yield message
+            position += end - position % CHUNK_SIZE
+
+    def __reversed__(self):
+        for position in range(self._stop - 1, self._start - 1, -1):
+            yield self._get(position)
+
+
+class ConversationHistory:
+    """
+    The in-memory conversation as an append-only array of fixed-size chunks. Appending and pruning from the front
+    are O(1) and never change what an existing snapshot sees:
+    - an append only writes past the end of every snapshot,
+    - pruning only moves the start, and the chunk directory is copied (not edited) when pruned chunks are released,
+    - removing the last message copies the last chunk first, so a snapshot never sees a replaced message.
+    The current version is published as a single tuple, so snapshot() needs no lock. Writers are serialized by a
+    lock.
+    """
+
+    def __init__(self, messages=()):
+        self._write_lock = threading.Lock()
+        self._state = ([], 0, 0, 0, 0)  # (chunks, index of the first chunk, start, stop, version)
+        for message in messages:
+            self.append(message)
+
+    def snapshot(self):
+        return HistorySnapshot(*self._state)
+
+    def __len__(self):
+        _, _, start, stop, _ = self._state
+        return stop - start
+
+    def append(self, message):
+        with self._write_lock:
+            chunks, base, start, stop, version = self._state
+            if stop // CHUNK_SIZE - base == len(chunks):
+                chunks.append([])
+            chunks[-1].append(message)
+            self._state = (chunks, base, start, stop + 1, version + 1)
+
+    def popleft(self):
+        """
+        :return: The oldest message.
+        """
+        with self._write_lock:
+            chunks, base, start, stop, version = self._state
+            if start == stop:
+                raise IndexError("pop from an empty history")
+            message = chunks[start // CHUNK_SIZE - base][start % CHUNK_SIZE]
+            start += 1
+            # release chunks that are fully pruned once they make up half of the directory; copying the directory
+            # keeps older snapshots valid and costs O(1) per pruned message on average
+            pruned = start // CHUNK_SIZE - base
+            if pruned and pruned * 2 >= len(chunks):
+                chunks = chunks[pruned:]
+                base += pruned
+            self._state = (chunks, base, start, stop, version + 1)
+            return message
+
+    def pop(self):
+        """
+        :return: The newest message.
+        """
+        with self._write_lock:
+            chunks, base, start, stop, version = self._state
+            if start == stop:
+                raise IndexError("pop from an empty history")
+            stop -= 1
+            message = chunks[-1][-1]
+            chunks = list(chunks)
+            if stop % CHUNK_SIZE == 0:
+                chunks.pop()
+            else:
+                chunks[-1] = chunks[-1][:-1]
+            self._state = (chunks, base, start, stop, version + 1)
+            return message
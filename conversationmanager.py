@@ -2,26 +2,29 @@ import json
 import logging
 import os
 import pickle
-import re
 import shutil
+import threading
 import time
+import zlib
+from array import array
 from datetime import datetime
 
 import requests.exceptions
 from termcolor import cprint
 from tiktoken import encoding_for_model
 
-from clients.llm.gpt_llm import GptLlm as llm_client
-# from clients.llm.google_llm import GoogleLlm as llm_client
+from clients.llm.llm_factory import create_llm_client
+from clients.llm.prompt_builder import Prompt, new_generation
+from conversation_history import ConversationHistory
 # TODO pay attention to short replies that occur due to long conversations: https://platform.openai.com/docs/guides/gpt/managing-tokens
-# TODO set a token threshold where it will switch from gpt4 to gpt3 after using too many tokens
 from enums.role_enum import Role
+from message import Message, remove_timestamp
 
-# from clients.local_llm import LocalLlm as llm_client
 # from web.web_service import WebService
 
 HISTORY_DIR = "personas"
 DIRECTIVES_PATH = "config/llm_directives.json"
+TIME_GAP_MINUTES = 30  # a user message this long after the previous message is prefixed with the time that passed
 
 
 # TODO update this to handle more models
@@ -34,13 +37,111 @@ def count_tokens(text, model=None) -> int:
     return len(encoding.encode(text))
 
 
+def message_tokens(message, model=None) -> int:
+    """
+    count_tokens() of a message's content. Message records cache the count, so a message is only tokenized once.
+    """
+    if isinstance(message, Message):
+        return message.tokens(model, count_tokens)
+    return count_tokens(message['content'], model)
+
+
 def add_timestamp(text) -> str:
+    """
+    The prefix user messages used to be stored with, before timestamps were kept as metadata (see timestamp_header()).
+    """
     timestamp = datetime.now().strftime("[%B %-d, %Y %-I:%M:%S%p]")
     return f"{timestamp} {text}"
 
 
-def remove_timestamp(text) -> str:
-    return re.sub(r"^\[.+\] ", '', text)
+def timestamp_header(timestamp, previous_timestamp=None):
+    """
+    Time context for a user message in the prompt: the full date and time for the first message and the first
+    message of each day, how much time passed for a message that follows a long pause, and nothing otherwise.
+    :return: The header, e.g. "[Tuesday, October 17, 2026 3:04PM]" or "[2 hours later]", or None.
+    """
+    if timestamp is None:
+        return None
+    moment = datetime.fromtimestamp(timestamp)
+    if previous_timestamp is None or datetime.fromtimestamp(previous_timestamp).date() != moment.date():
+        return moment.strftime("[%A, %B %-d, %Y %-I:%M%p]")
+    minutes = int((timestamp - previous_timestamp) / 60)
+    if minutes < TIME_GAP_MINUTES:
+        return None
+    if minutes < 120:
+        return f"[{minutes} minutes later]"
+    return f"[{minutes // 60} hours later]"
+
+
+def render_message(message, previous=None, anchored=False):
+    """
+    :param previous: The message before it in the conversation.
+    :param anchored: Whether an earlier user message has the full date.
+    :return: The message as it appears in the prompt, with its timestamp header if it needs one.
+    """
+    if message['role'] != Role.USER:
+        return message
+    header = timestamp_header(message['timestamp'], previous['timestamp'] if anchored else None)
+    if header is None:
+        return message
+    return Message(message['role'], f"{header} {message['content']}", origin=message['origin'],
+                   timestamp=message['timestamp'])
+
+
+class RenderedHistory:
+    """
+    The in-memory conversation as it appears in the prompt, kept up to date as messages are appended, popped and
+    pruned, so a turn only renders the messages that changed. A user message's timestamp header only depends on the
+    message and the one before it, except for the first user message, which always gets the full date; pruning
+    renders the new first user message again.
+    """
+
+    def __init__(self, messages=()):
+        self.lock = threading.Lock()
+        self.generation = new_generation()  # see Prompt
+        self.start = 0  # messages pruned since the history was rendered
+        self.originals = []  # the conversation's messages
+        self.rendered = []  # the same messages as they appear in the prompt
+        self.user_count = 0  # user messages in the conversation
+        for message in messages:
+            self.append(message)
+
+    def __len__(self):
+        return len(self.originals)
+
+    def append(self, message):
+        with self.lock:
+            previous = self.originals[-1] if self.originals else None
+            self.rendered.append(render_message(message, previous, anchored=self.user_count > 0))
+            self.originals.append(message)
+            if message['role'] == Role.USER:
+                self.user_count += 1
+
+    def pop(self):
+        with self.lock:
+            self.rendered.pop()
+            if self.originals.pop()['role'] == Role.USER:
+                self.user_count -= 1
+
+    def popleft(self):
+        with self.lock:
+            del self.rendered[0]
+            removed = self.originals.pop(0)
+            self.start += 1
+            if removed['role'] != Role.USER:
+                return
+            self.user_count -= 1
+            for i, message in enumerate(self.originals):
+                if message['role'] == Role.USER:
+                    self.rendered[i] = render_message(message)
+                    break
+
+    def prompt(self, system_msg):
+        """
+        :return: Prompt with the system message followed by the rendered conversation.
+        """
+        with self.lock:
+            return Prompt(system_msg, self.rendered, self.generation, self.start)
 
 
 def get_system_directives():
@@ -60,7 +161,7 @@ class ConversationManager:
     def __init__(self, persona, web_service):
         self.persona = persona
         self.web_service = web_service
-        self.llm_client = llm_client(self.persona)
+        self.llm_client = create_llm_client(self.persona, count_tokens=count_tokens)
         # load from disk
         dir_path = os.path.dirname(os.path.realpath(__file__))
         conv_file = f"{self.persona.name}_DEBUG.pkl" if os.getenv("APP_ENV") == "LOCAL" else f"{self.persona.name}.pkl"
@@ -69,21 +170,79 @@ class ConversationManager:
             "role": Role.SYSTEM,
             "content": " ".join(persona.personality_rules) + "\n\n" + " ".join(get_system_directives())
         }
-        self.total_tokens = count_tokens(self.system_msg['content'], self.llm_client.model)
+        self.total_tokens = count_tokens(self.system_msg['content'], self.llm_client.token_model)
         self.pkl_file = os.path.join(dir_path, HISTORY_DIR, conv_file)
-        self.conversation = []
+        self._history = ConversationHistory()  # in-memory conversation; read it through self.conversation
+        self.suspended = None  # compressed conversation while the persona is inactive, see suspend()
+        self.suspend_lock = threading.Lock()
+        self.history_offsets = []  # file offset of every message in the pkl file, which has the full history
+        self.prompt_history = None  # RenderedHistory of the in-memory conversation, built by get_conversation()
+        self.last_reply = None  # (tag, message) of the last response stored by get_response()
         self.load_conversation()
 
+    @property
+    def history(self):
+        """
+        :return: The in-memory ConversationHistory, rehydrated first if the conversation is suspended.
+        """
+        if self.suspended is not None:
+            self.resume()
+        return self._history
+
+    def suspend(self):
+        """
+        Keeps the in-memory conversation compressed while the persona is inactive, with the messages' token counts,
+        and drops the prompt caches built from it. It is rehydrated by resume(), or as soon as it is used. The caller
+        makes sure no request is using the conversation (see RequestScheduler.run_if_idle()).
+        """
+        with self.suspend_lock:
+            if self.suspended is not None:
+                return
+            records = [message.record() for message in self._history.snapshot()]
+            self.suspended = zlib.compress(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL))
+            self._history = ConversationHistory()
+            self.prompt_history = None
+            self.history_offsets = array('q', self.history_offsets)
+            self.llm_client.release_caches()
+        logging.info(f"{self.persona.name}'s conversation suspended: {len(records)} messages in "
+                     f"{len(self.suspended) / 1024:.1f} KiB")
+
+    def resume(self):
+        """
+        Rehydrates a suspended conversation. Token counts are restored, not counted again.
+        """
+        with self.suspend_lock:
+            if self.suspended is None:
+                return
+            start_time = time.perf_counter()
+            records = pickle.loads(zlib.decompress(self.suspended))
+            self._history = ConversationHistory(Message.restore(record) for record in records)
+            self.suspended = None
+        logging.info(f"{self.persona.name}'s conversation resumed: {len(records)} messages in "
+                     f"{(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    @property
+    def conversation(self):
+        """
+        :return: Snapshot of the in-memory conversation. Later appends and pruning don't change it, so it can be read
+        from any thread without locking.
+        """
+        return self.history.snapshot()
+
     def load_conversation(self):
+        self.history_offsets = []
         try:
             with open(self.pkl_file, "rb") as f:
                 while True:
                     try:
+                        offset = f.tell()
                         msg = pickle.load(f)
+                        self.history_offsets.append(offset)
                         # pprint(msg)
+                        # older user messages have the timestamp baked into the content
                         self.append_message(
                             msg['role'],
-                            msg['content'],
+                            remove_timestamp(msg['content']) if msg['role'] == Role.USER else msg['content'],
                             origin=msg['origin'],
                             timestamp=msg['timestamp'],
                             silent=True
@@ -113,10 +272,10 @@ class ConversationManager:
             logging.warning("The conversation was not loaded. A new conversation has been created.")
 
     def get_total_token_count(self):
-        total = count_tokens(self.system_msg['content'], self.llm_client.model)
+        total = count_tokens(self.system_msg['content'], self.llm_client.token_model)
         for message in self.conversation:
             if 'content' in message:
-                total += count_tokens(message['content'], self.llm_client.model)
+                total += message_tokens(message, self.llm_client.token_model)
         return total
 
     def fix_dangling_users(self):
@@ -131,23 +290,28 @@ class ConversationManager:
         response from the LLM.
         :return: Returns the user messages that did not receive a response, None otherwise.
         """
-        if len(self.conversation) and self.conversation[-1]['role'] == Role.USER:
+        conversation = self.conversation
+        if len(conversation) and conversation[-1]['role'] == Role.USER:
             return self.pop_message()
         return None
 
-    def get_response(self, user_message, origin="server"):
+    def get_response(self, user_message, origin="server", tag=None):
+        """
+        :param tag: Identifies the request (e.g. a voice turn), so append_interrupted_response() can tell whether the
+        full response was stored for it.
+        """
         # TODO make modifications directly to the message to reinforce certain rules
 
         cprint(f"User: {user_message}", "green")
         self.fix_dangling_users()
-        self.append_message(Role.USER, add_timestamp(user_message), origin=origin, to_disk=True)
+        self.append_message(Role.USER, user_message, origin=origin, to_disk=True)
         self.web_service.send_new_user_msg(user_message, origin)
         self.make_room()
         response = ""
         first_chunk = True
+        token = self.llm_client.new_request()
         try:
-            for chunk in self.llm_client.response_generator(
-                    self.get_conversation(bump_system_msg=self.llm_client.bump_system_message)):
+            for chunk in self.llm_client.response_generator(self.get_conversation(), token=token):
                 if chunk:
 
                     # '-1' response (invalid input) can be sent across two chunks
@@ -175,11 +339,36 @@ class ConversationManager:
             # TODO if the choices[0].get("finish_reason") is "length", have the system let the user know they've reached
             # TODO the directed maximum token limit and ask if they'd like the system to continue. (will have to allow "yes" and "no" through preprocessing)
             print()  # newline
-            self.append_message(Role.ASSISTANT, response, origin=self.llm_client.model, to_disk=True)
+            if token.cancelled:
+                # the response was interrupted; the listener stores the part that was actually spoken
+                # (see append_interrupted_response)
+                return
+            reply = self.append_message(Role.ASSISTANT, response, origin=self.llm_client.model, to_disk=True)
+            self.last_reply = (tag, reply)
             yield None
         except requests.exceptions.HTTPError as e:
             logging.error(f"Error retrieving response from LLM: {e}")
 
+    def append_interrupted_response(self, spoken_text, tag=None):
+        """
+        Stores the portion of an interrupted response that the user actually heard so later prompts don't pay for
+        text that was never spoken. If nothing was heard, the user message is left dangling and will be trimmed.
+        :param spoken_text: Text that was played before the response was cut off.
+        :param tag: The tag the response was requested with (see get_response()). If the full response was stored
+        for it and is still the last message, it is replaced.
+        """
+        conversation = self.conversation
+        last_reply = self.last_reply
+        if tag is not None and last_reply is not None and last_reply[0] is tag and conversation and \
+                conversation[-1] is last_reply[1]:
+            removed = self.pop_message()
+            self.total_tokens -= message_tokens(removed, self.llm_client.token_model)
+        if not spoken_text:
+            logging.info("Response interrupted before anything was spoken.")
+            return
+        logging.info(f"Response interrupted. Storing the spoken portion: '{spoken_text}'")
+        self.append_message(Role.ASSISTANT, f"{spoken_text}...", origin=self.llm_client.model, to_disk=True)
+
     def make_room(self, silent=False):
         """
         Removes older messages from conversation to make room for max token count.
@@ -188,37 +377,38 @@ class ConversationManager:
         # TODO at fixed intervals, make a separate request to summarize the important parts of the history for long term
         # self.total_tokens includes the system token count
         while len(
-                self.conversation) > 1 and self.total_tokens > self.llm_client.max_context_tokens - self.llm_client.max_response_tokens:
-            # TODO instead of popping one at a time, keep a token count with each message so the messages can be more easily pruned
-            removed_message = self.conversation.pop(0)
-            removed_token_count = count_tokens(removed_message['content'], self.llm_client.model)
+                self.history) > 1 and self.total_tokens > self.llm_client.max_context_tokens - self.llm_client.max_response_tokens:
+            removed_message = self.history.popleft()
+            if self.prompt_history is not None:
+                self.prompt_history.popleft()
+            removed_token_count = message_tokens(removed_message, self.llm_client.token_model)
             self.total_tokens -= removed_token_count
             if not silent:
                 logging.info(f"Pruning history to make room... {removed_token_count} tokens freed.")
 
     def append_message(self, role, message, origin=None, to_disk=False, silent=False, timestamp=None):
-        message_tokens = count_tokens(message, self.llm_client.model)
-        if not silent:
-            logging.info(f"Message tokens: {message_tokens}")
-        self.total_tokens += message_tokens
-        if not silent:
-            logging.info(f"Total tokens: {self.total_tokens} / {self.llm_client.max_context_tokens}")
         if not timestamp:
             timestamp = time.time()
+        message = Message(role, message, origin=origin, timestamp=timestamp)
 
-        message = {
-            "role": role,
-            "content": message,
-            "origin": origin,
-            "timestamp": timestamp,
-        }
+        token_count = message.tokens(self.llm_client.token_model, count_tokens)
+        if not silent:
+            logging.info(f"Message tokens: {token_count}")
+        self.total_tokens += token_count
+        if not silent:
+            logging.info(f"Total tokens: {self.total_tokens} / {self.llm_client.max_context_tokens}")
 
-        self.conversation.append(message)
+        self.history.append(message)
+        if self.prompt_history is not None:
+            self.prompt_history.append(message)
         if to_disk:
             try:
                 # store in a tmp file in case the file terminates while writing. This mitigates corruptions.
                 with open(self.pkl_file, "ab+") as f:
-                    pickle.dump(message, f)
+                    offset = f.tell()
+                    # plain dictionaries, as always, so the file doesn't depend on the Message class
+                    pickle.dump(message.as_dict(), f)
+                self.history_offsets.append(offset)
                 shutil.copy(self.pkl_file, f"{self.pkl_file}.tmp")
             except Exception as e:
                 logging.warning(f"Error updating {self.pkl_file}: {e}")
@@ -231,16 +421,19 @@ class ConversationManager:
                         logging.error("Backup not found. Unable to recover.")
                 except FileNotFoundError:
                     logging.error("Backup not found. Unable to recover.")
+                self.index_history()
         return message
 
     def pop_message(self):
         # TODO test this and add it to get_response where '-1' is returned (in the exception)
-        if not self.conversation:
+        if not self.history:
             logging.info("No messages to pop.")
             return
 
         # Remove the last message from the in-memory conversation
-        popped_message = self.conversation.pop()
+        popped_message = self.history.pop()
+        if self.prompt_history is not None:
+            self.prompt_history.pop()
 
         # Handle the pkl file
         if os.path.exists(self.pkl_file):
@@ -259,10 +452,11 @@ class ConversationManager:
                 # Write the updated messages back to the pkl file
                 with open(f"{self.pkl_file}.tmp", "wb") as f:
                     for message in temp_messages:
-                        pickle.dump(message, f)
+                        pickle.dump(dict(message), f)
 
                 # Replace the original pkl file with the updated temporary file
                 os.replace(f"{self.pkl_file}.tmp", self.pkl_file)
+                del self.history_offsets[len(temp_messages):]
             except Exception as e:
                 logging.warning(f"Error updating {self.pkl_file}: {e}")
                 logging.warning("Attempting to recover from backup...")
@@ -271,19 +465,62 @@ class ConversationManager:
                     logging.success("Successfully recovered backup.")
                 else:
                     logging.error("Backup not found. Unable to recover.")
+                self.index_history()
         else:
             logging.info(f"No persistent storage found at {self.pkl_file}.")
 
         return popped_message
 
-    def get_conversation(self, bump_system_msg=True):
-        if bump_system_msg and len(self.conversation) > 4:
-            # don't place system message after a user message as some models don't like this
-            insert_position = -3 if self.conversation[-4]["role"] == Role.ASSISTANT else -4
-            conversation = self.conversation[:insert_position] + [self.system_msg] + self.conversation[insert_position:]
-        else:
-            conversation = [self.system_msg] + self.conversation
-        return conversation
+    def index_history(self):
+        """
+        Rebuilds the file offset of every message in the pkl file.
+        """
+        self.history_offsets = []
+        try:
+            with open(self.pkl_file, "rb") as f:
+                while True:
+                    offset = f.tell()
+                    try:
+                        pickle.load(f)
+                    except EOFError:
+                        break
+                    self.history_offsets.append(offset)
+        except Exception as e:
+            logging.warning(f"Error indexing {self.pkl_file}: {e}")
+
+    def history_length(self):
+        """
+        :return: Number of messages in the full history, including those pruned from the conversation.
+        """
+        return len(self.history_offsets)
+
+    def load_history(self, start, end):
+        """
+        Reads messages from the full on-disk history without loading the rest of it.
+        :param start: Index of the first message.
+        :param end: Index after the last message.
+        :return: List of Message.
+        """
+        offsets = self.history_offsets[max(0, start):max(0, end)]
+        if not offsets:
+            return []
+        messages = []
+        with open(self.pkl_file, "rb") as f:
+            f.seek(offsets[0])
+            for _ in offsets:
+                messages.append(Message.from_dict(pickle.load(f)))
+        return messages
+
+    def get_conversation(self):
+        """
+        :return: Prompt with the system message and the conversation as it appears in the prompt. The LLM client
+        moves the system message if it needs to (see LlmClient.bump_system_message).
+        """
+        prompt_history = self.prompt_history
+        if prompt_history is None or len(prompt_history) != len(self.history):
+            # first turn since loading or resuming the conversation
+            prompt_history = self.prompt_history = RenderedHistory(self.conversation)
+        return prompt_history.prompt(self.system_msg)
 
 
 class InvalidInputError(Exception):
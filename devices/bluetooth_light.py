@@ -1,36 +1,55 @@
 import serial
-import time
+
+from devices.controller import DeviceController
+from enums.light_state_enum import LightState
 
 BT_COMMANDS = [
     "PULSE_LED",
     "STOP_LED",
     "START_LED"
 ]
+STATE_COMMANDS = {
+    LightState.PULSE: "PULSE_LED",
+    LightState.OFF: "STOP_LED",
+    LightState.ON: "START_LED",
+}
+WRITE_TIMEOUT = 1  # seconds
+
+
+class SerialDriver:
+    """
+    Sends light commands as single bytes over a serial connection. The remote light pulses on its own.
+    """
+
+    def __init__(self, serial_port, baud_rate):
+        self.serial = serial.Serial(serial_port, baud_rate, timeout=1, write_timeout=WRITE_TIMEOUT)
+
+    def apply(self, state):
+        self.serial.write(BT_COMMANDS.index(STATE_COMMANDS[state]).to_bytes(1, 'big'))
 
 
 class BTLight:
+    """
+    Light controlled over serial. The methods only queue a command for the light's DeviceController and return
+    immediately.
+    """
+
     def __init__(self, serial_port='/dev/serial0', baud_rate=115200):
-        self.serial = serial.Serial(serial_port, baud_rate, timeout=1)
+        self.controller = DeviceController("Bluetooth", SerialDriver(serial_port, baud_rate))
 
     def send_command(self, command):
         if command in BT_COMMANDS:
-            # command_int = BT_COMMANDS.index(command)
-            # data = command_int.to_bytes(1, 'big')
-            # print(f"Sending: {data}")  # Debugging line
-            self.serial.write(BT_COMMANDS.index(command).to_bytes(1, 'big'))
+            state = next(state for state, name in STATE_COMMANDS.items() if name == command)
+            self.controller.set_state(state)
 
     def begin_pulse(self):
-        self.send_command("PULSE_LED")
+        self.controller.set_state(LightState.PULSE)
 
     def turn_off(self):
-        self.send_command("STOP_LED")
+        self.controller.set_state(LightState.OFF)
 
     def turn_on(self):
-        self.send_command("START_LED")
+        self.controller.set_state(LightState.ON)
 
     def blink(self, times, pause=0.5):
-        for _ in range(times):
-            self.send_command("START_LED")
-            time.sleep(pause)
-            self.send_command("STOP_LED")
-            time.sleep(pause)
+        self.controller.blink(times, pause)
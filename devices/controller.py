@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from enums.light_state_enum import LightState
+
+
+class Blink:
+    def __init__(self, times, pause):
+        self.times = times
+        self.pause = pause
+
+
+class DeviceController:
+    """
+    Owns a light on a thread of its own, so callers (e.g., the playback loop) never wait for GPIO or serial I/O.
+    Commands are queued and only the final state of a run of state changes is applied; a change to the state the light
+    will already be in is dropped. While pulsing, the driver is stepped every driver.step_interval seconds. Blinks are
+    stepped the same way, so a state change stops a blink right away instead of waiting for it to finish.
+
+    A driver has apply(state) and, if pulsing has to be driven from here, step() and step_interval.
+    """
+
+    def __init__(self, name, driver):
+        self.name = name
+        self.driver = driver
+        self.cond = threading.Condition()
+        self.commands = deque()
+        self.state = LightState.OFF  # last state applied to the device
+        self.target = LightState.OFF  # state the device will be in once the queued commands are applied
+
+        # time callers spent queuing commands, and what happened to them
+        self.calls = 0
+        self.call_time = 0
+        self.max_call_time = 0
+        self.dropped = 0
+        self.applied = 0
+        self.apply_time = 0  # time the controller thread spent in the driver
+
+        thread = threading.Thread(target=self._run, name=f"device-{name}")
+        thread.daemon = True
+        thread.start()
+
+    def set_state(self, state):
+        start_time = time.perf_counter()
+        with self.cond:
+            if state == self.target:
+                self.dropped += 1
+            else:
+                # only the last of several queued state changes matters
+                while self.commands and isinstance(self.commands[-1], LightState):
+                    self.commands.pop()
+                    self.dropped += 1
+                self.commands.append(state)
+                self.target = state
+                self.cond.notify()
+            self._record_call(start_time)
+
+    def blink(self, times, pause=0.5):
+        start_time = time.perf_counter()
+        with self.cond:
+            self.commands.append(Blink(times, pause))
+            self.target = None  # any state change stops the blink, see _run()
+            self.cond.notify()
+            self._record_call(start_time)
+
+    def _record_call(self, start_time):
+        elapsed = time.perf_counter() - start_time
+        self.calls += 1
+        self.call_time += elapsed
+        self.max_call_time = max(self.max_call_time, elapsed)
+
+    def stats(self):
+        """
+        :return: Dictionary with the number of commands, how many were dropped as redundant, and the time callers
+        and the controller thread spent on them (seconds).
+        """
+        return {
+            "calls": self.calls,
+            "dropped": self.dropped,
+            "applied": self.applied,
+            "avg_call_time": self.call_time / self.calls if self.calls else 0,
+            "max_call_time": self.max_call_time,
+            "apply_time": self.apply_time,
+        }
+
+    def _run(self):
+        blink_steps = deque()  # (state, seconds to hold it) left of the blinks in progress
+        next_tick = None  # time.monotonic() of the next blink step or pulse step
+        while True:
+            with self.cond:
+                while not self.commands:
+                    if next_tick is None:
+                        self.cond.wait()
+                        continue
+                    remaining = next_tick - time.monotonic()
+                    if remaining <= 0:
+                        break  # time for the next step of the blink or of the waveform
+                    self.cond.wait(remaining)
+                commands = list(self.commands)
+                self.commands.clear()
+
+            for command in commands:
+                if isinstance(command, Blink):
+                    if not blink_steps:
+                        next_tick = None  # start right away
+                    blink_steps.extend([(LightState.ON, command.pause),
+                                        (LightState.OFF, command.pause)] * command.times)
+                else:
+                    # a new state stops a blink instead of waiting for it
+                    blink_steps.clear()
+                    next_tick = None
+                    if command != self.state:
+                        self._apply(command)
+
+            now = time.monotonic()
+            if blink_steps:
+                if next_tick is None or now >= next_tick:
+                    state, pause = blink_steps.popleft()
+                    self._apply(state)
+                    next_tick = now + pause
+            elif self.state == LightState.PULSE and hasattr(self.driver, "step"):
+                if next_tick is not None and now >= next_tick:
+                    self._call(self.driver.step)
+                    next_tick = None
+                if next_tick is None:
+                    next_tick = now + self.driver.step_interval
+            else:
+                next_tick = None
+
+    def _apply(self, state):
+        self._call(self.driver.apply, state)
+        self.state = state
+        self.applied += 1
+
+    def _call(self, function, *args):
+        start_time = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            logging.warning(f"{self.name} light command failed: {e}")
+        self.apply_time += time.perf_counter() - start_time
@@ -1,57 +1,69 @@
-import threading
-import time
+import math
 
 import RPi.GPIO as GPIO
 
+from devices.controller import DeviceController
+from enums.light_state_enum import LightState
+
 MAX_PULSE_BRIGHTNESS = 75
 MIN_PULSE_BRIGHTNESS = 5
+PULSE_PERIOD = 1.4  # seconds per pulse
+PULSE_STEPS = 35  # duty cycle changes per pulse
 
-
-def pulse_led(p, stop_event):
-    p.start(0)
-    while not stop_event.is_set():
-        for i in range(MAX_PULSE_BRIGHTNESS, MIN_PULSE_BRIGHTNESS - 1, -1):
-            if stop_event.is_set():
-                break
-            p.ChangeDutyCycle(i)
-            time.sleep(0.01)
-        for i in range(MIN_PULSE_BRIGHTNESS, MAX_PULSE_BRIGHTNESS + 1):
-            if stop_event.is_set():
-                break
-            p.ChangeDutyCycle(i)
-            time.sleep(0.01)
+# duty cycle for every step of a pulse: a raised cosine from the maximum down to the minimum and back
+PULSE_WAVEFORM = tuple(
+    round(MIN_PULSE_BRIGHTNESS + (MAX_PULSE_BRIGHTNESS - MIN_PULSE_BRIGHTNESS) * (1 + math.cos(2 * math.pi * i /
+                                                                                            PULSE_STEPS)) / 2, 1)
+    for i in range(PULSE_STEPS))
 
 
-class Light:
+class GpioDriver:
+    """
+    Drives the LED on a GPIO pin. Pulsing steps the software PWM through PULSE_WAVEFORM.
+    """
+    step_interval = PULSE_PERIOD / PULSE_STEPS
 
     def __init__(self, pin):
         self.pin = pin
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(self.pin, GPIO.OUT)
         self.p = GPIO.PWM(pin, 50)
-        self.pulse_thread = None
-        self.stop_event = threading.Event()
+        self.pwm_running = False
+        self.step_index = 0
+
+    def apply(self, state):
+        if state == LightState.PULSE:
+            self.step_index = 0
+            self.p.start(PULSE_WAVEFORM[0])
+            self.pwm_running = True
+            return
+        if self.pwm_running:
+            self.p.stop()
+            self.pwm_running = False
+        GPIO.output(self.pin, state == LightState.ON)
+
+    def step(self):
+        self.step_index = (self.step_index + 1) % len(PULSE_WAVEFORM)
+        self.p.ChangeDutyCycle(PULSE_WAVEFORM[self.step_index])
+
+
+class Light:
+    """
+    LED on a GPIO pin. The methods only queue a command for the light's DeviceController and return immediately.
+    """
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.controller = DeviceController("LED", GpioDriver(pin))
 
     def blink(self, how_many, pause=0.5):
-        for i in range(how_many):
-            self.turn_on()
-            time.sleep(pause)
-            self.turn_off()
-            time.sleep(pause)
+        self.controller.blink(how_many, pause)
 
     def turn_on(self):
-        GPIO.output(self.pin, True)
+        self.controller.set_state(LightState.ON)
 
     def turn_off(self):
-        self.stop_event.set()
-        if self.pulse_thread is not None:
-            self.pulse_thread.join()
-        self.p.stop()
-        GPIO.output(self.pin, False)
+        self.controller.set_state(LightState.OFF)
 
     def begin_pulse(self):
-        # Turn on LED and start pulsing in a separate thread
-        self.stop_event.clear()
-        self.pulse_thread = threading.Thread(target=pulse_led, args=(self.p, self.stop_event))
-        self.pulse_thread.daemon = True
-        self.pulse_thread.start()
+        self.controller.set_state(LightState.PULSE)
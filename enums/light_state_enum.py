@@ -0,0 +1,10 @@
+from enum import Enum
+
+
+class LightState(Enum):
+    OFF = 0
+    ON = 1
+    PULSE = 2
+
+    def __str__(self):
+        return self.name.lower()
@@ -0,0 +1,9 @@
+from enum import Enum
+
+
+class StateEvent(Enum):
+    WAKE_WORD = 0
+    CONVERSATION_ENDED = 1
+
+    def __str__(self):
+        return self.name.lower()
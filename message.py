@@ -0,0 +1,92 @@
+import re
+import sys
+from collections.abc import Mapping
+
+from enums.role_enum import Role
+
+FIELDS = ("role", "content", "origin", "timestamp")
+# "[October 17, 2026 3:04:05PM] " baked into older messages, "[Tuesday, October 17, 2026 3:04PM] " date headers and
+# "[45 minutes later] " time gaps
+TIMESTAMP_REGEX = re.compile(r"^\[(([A-Z][a-z]+, )?[A-Z][a-z]+ \d{1,2}, \d{4} \d{1,2}:\d{2}(:\d{2})?[AP]M|"
+                             r"\d+ (minutes|hours) later)\] ")
+
+
+def remove_timestamp(text) -> str:
+    """
+    Removes the timestamp older versions stored in user messages, or the header a message has in the prompt (see
+    ConversationManager.get_conversation()).
+    """
+    return TIMESTAMP_REGEX.sub('', text, count=1)
+
+
+class Message(Mapping):
+    """
+    One conversation message. Uses __slots__ instead of a dict per message, keeps the role as the Role singleton,
+    interns the origin (there are only a few: "voice", "web", model names) and caches the content's token count.
+    It is a read-only mapping with the keys in FIELDS, so code written for the old message dictionaries, e.g.
+    message['content'], keeps working. The pkl history files store as_dict() of each message, the format they have
+    always had, so they don't depend on this class; see ConversationManager.append_message().
+    """
+
+    __slots__ = ("role", "content", "origin", "timestamp", "_token_model", "_token_count")
+
+    def __init__(self, role, content, origin=None, timestamp=None):
+        self.role = role if isinstance(role, Role) else Role(role)
+        self.content = content
+        self.origin = sys.intern(origin) if isinstance(origin, str) else origin
+        self.timestamp = float(timestamp) if timestamp is not None else None
+        self._token_model = None
+        self._token_count = None
+
+    @classmethod
+    def from_dict(cls, message):
+        return cls(message['role'], message['content'], origin=message.get('origin'),
+                   timestamp=message.get('timestamp'))
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def record(self):
+        """
+        :return: The message as a plain tuple, including the cached token count, for compact storage. See restore().
+        """
+        return self.role.value, self.content, self.origin, self.timestamp, self._token_model, self._token_count
+
+    @classmethod
+    def restore(cls, record):
+        """
+        Rebuilds a message from record() without counting its tokens again.
+        """
+        role, content, origin, timestamp, token_model, token_count = record
+        message = cls(role, content, origin=origin, timestamp=timestamp)
+        message._token_model = token_model
+        message._token_count = token_count
+        return message
+
+    def tokens(self, model, count_tokens):
+        """
+        :param count_tokens: Function(text, model) used if the count for this model isn't cached yet.
+        :return: Number of tokens in the content for the model.
+        """
+        if self._token_count is None or self._token_model != model:
+            self._token_count = count_tokens(self.content, model)
+            self._token_model = model
+        return self._token_count
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+    def __reduce__(self):
+        # only the fields, not the cached token count; the pickle still refers to this class
+        return Message, (self.role.value, self.content, self.origin, self.timestamp)
+
+    def __repr__(self):
+        return f"Message({self.as_dict()})"
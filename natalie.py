@@ -2,7 +2,6 @@
 import json
 import logging
 import os
-import subprocess
 from sys import argv
 
 import RPi.GPIO as GPIO
@@ -10,9 +9,12 @@ from dotenv import load_dotenv
 
 from devices.light import Light
 from devices.bluetooth_light import BTLight
+from enums.state_event_enum import StateEvent
 from persona import Persona
+from pipeline.scheduler import RequestScheduler
 from states.asleep import Asleep
 from states.listening import Listening
+from utils import audio
 from web.web_service import WebService
 from utils.log import LogFormatter
 
@@ -22,6 +24,34 @@ LED_PIN = 20
 SOUND_CONFIG_PATH = "config/sound.json"
 
 
+def rss_mib():
+    """
+    :return: Resident memory of the process in MiB, or 0 where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
+
+def report_memory(memory):
+    """
+    Logs the memory the personas take in this process against running each one in its own process.
+    :param memory: RSS before loading the personas and after each one.
+    """
+    personas = len(memory) - 1
+    if personas < 2 or not memory[0]:
+        return
+    extra = (memory[-1] - memory[1]) / (personas - 1)
+    logging.info(f"{personas} personas loaded: {memory[-1]:.0f} MiB resident, the first took "
+                 f"{memory[1] - memory[0]:.0f} MiB (with the shared audio and pipeline), each other one {extra:.0f} "
+                 f"MiB. {personas} separate processes would take about {personas * memory[1]:.0f} MiB.")
+
+
 class Natalie:
     def __init__(self):
         log_level = "debug2" if os.getenv("APP_ENV", "PROD") == "LOCAL" else "info"
@@ -37,10 +67,10 @@ class Natalie:
                 logging.error(f"Error in sound config file (extra comma?): {file_path}")
                 exit(1)
 
-        persona_name = argv[1] if len(argv) > 1 else "natalie"
-        persona_name = persona_name.rstrip(".json")
+        # every persona named on the command line is loaded; each answers to its own wake words
+        persona_names = argv[1:] if len(argv) > 1 else ["natalie"]
         try:
-            self.persona = Persona(persona_name)
+            self.personas = [Persona(persona_name.rstrip(".json")) for persona_name in persona_names]
         except FileNotFoundError as e:
             logging.error(f"'{e.filename}' does not exist.")
             exit(-1)
@@ -48,31 +78,50 @@ class Natalie:
             logging.error(f"'{e.args[0]}' key missing from sound config file.")
             exit(-1)
 
-        if self.persona.startup_sound and os.getenv('APP_ENV') != "LOCAL":
-            file_path = os.path.join(dir_path, f"assets/{self.persona.startup_sound}")
-            subprocess.call(["xdg-open", file_path])
-
         logging.info("Starting web service")
         self.web_service = WebService()
+        # voice and web requests for the conversation go through one scheduler so they can't interleave
+        scheduler = RequestScheduler()
+        self.web_service.scheduler = scheduler
         self.web_service.run_threaded()
 
         self.light = Light(LED_PIN)
         self.bt_light = BTLight()
 
-        self.states = [
-            Asleep(self.persona.wake_words, self.sound_config['microphone']['rate']),
-            Listening(self.light, self.bt_light, self.persona, self.sound_config, self.web_service)
-        ]
+        memory = [rss_mib()]
+        listening = Listening(self.light, self.bt_light, self.personas, self.sound_config, self.web_service,
+                              scheduler, on_persona_loaded=lambda context: memory.append(rss_mib()))
+        report_memory(memory)
+        self.web_service.persona_switcher = listening.switch_persona
+        if os.getenv('APP_ENV') != "LOCAL":
+            listening.response_pipeline.cues.play("startup")
+
+        # one Porcupine instance listens for the wake words of all personas; the index of the detected one tells
+        # which persona to wake
+        wake_words = []
+        wake_word_contexts = []
+        for context in listening.contexts:
+            wake_words += context.persona.wake_words
+            wake_word_contexts += [context] * len(context.persona.wake_words)
+        asleep = Asleep(wake_words, on_wake=lambda keyword_index: listening.wake(wake_word_contexts[keyword_index]))
+        # next state for every state and the event that ended it
+        self.transitions = {
+            (asleep, StateEvent.WAKE_WORD): listening,
+            (listening, StateEvent.CONVERSATION_ENDED): asleep,
+        }
         self.light.blink(2)
         self.bt_light.blink(2)
-        self.current_state = 0
+        self.current_state = asleep
+        # the microphone stays open from here on; the states hand one reader on to each other
+        self.capture = audio.get_capture(self.sound_config['microphone']['rate'])
         logging.success("System ready")
 
     def run(self):
         try:
+            reader = self.capture.open_reader()
             while True:
-                self.states[self.current_state].run()
-                self.current_state = (self.current_state + 1) % len(self.states)
+                event = self.current_state.run(reader)
+                self.current_state = self.transitions[(self.current_state, event)]
         except KeyboardInterrupt:
             logging.info("Cleaning up and exiting...")
             GPIO.cleanup()
@@ -12,7 +12,6 @@ def add_wake_word_paths(wake_word_tuple, dir_path):
     return [[w, s] for w, s in zip(file_paths, sensitivities)]
 
 
-# TODO load a different persona depending on the wake word
 class Persona:
     """
     Represents a persona for the AI. Persona json files should be placed in the 'personas'
@@ -41,6 +40,8 @@ class Persona:
         self.voice_engine = data['voice']['engine']
         self.personality_rules = data['personality_rules']
         self.startup_sound = data['startup_sound'] if 'startup_sound' in data else None
+        self.cues = data['cues'] if 'cues' in data else {}
+        self.greeting = data['greeting'] if 'greeting' in data else f"Hi, it's {self.name}."  # said when switched to
         self.wake_words = add_wake_word_paths(data['wake_words'], dir_path)
         self.stop_words = add_wake_word_paths(data['stop_words'], dir_path)
         self.temperature = int(data['temperature']) if 'temperature' in data and isinstance(data['temperature'], (
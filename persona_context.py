@@ -0,0 +1,24 @@
+# from clients.tts.riva_tts import RivaTTS as tts_client
+# from clients.tts.openai_tts import OpenAITTS as tts_client
+from clients.tts.polly_tts import PollyTTS as tts_client
+from conversationmanager import ConversationManager
+from pipeline.cues import AudioCues
+
+
+class PersonaContext:
+    """
+    Everything that belongs to one persona: its conversation (and LLM client), its voice and its audio cues. The
+    microphone capture, voice detection, wake word engine, response pipeline and network connections are shared by all
+    personas loaded in the process.
+    """
+
+    def __init__(self, persona, web_service, player, sound_config):
+        self.persona = persona
+        self.conversation_manager = ConversationManager(persona, web_service)
+        # self.tts_client = RivaTTS(persona, sample_rate=sound_config['tts']['rate'])
+        self.tts_client = tts_client(persona)
+        self.cues = AudioCues(persona, player, sound_config, self.tts_client)
+
+    @property
+    def name(self):
+        return self.persona.name
@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    """
+    One-shot cancellation signal shared by every stage of a turn. Blocking waits register a callback so they are
+    woken up as soon as the token is cancelled instead of noticing a flag on their next poll.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.cancelled_at = None  # time.perf_counter() when cancel() was first called
+        self.reason = None
+
+    def cancel(self, reason=None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.cancelled_at = time.perf_counter()
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning(f"Cancellation callback {callback} failed: {e}")
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def register(self, callback):
+        """
+        Calls callback when the token is cancelled, or immediately if it already has been.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import deque
+
+from pipeline.cancellation import Cancelled
+
+
+class Channel:
+    """
+    Unbounded FIFO between two pipeline stages. Unlike queue.Queue, a blocked get() is woken up immediately when the
+    cancellation token it was given is cancelled.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, token=None, timeout=None):
+        """
+        Blocks until an item is available.
+        :param token: Optional CancellationToken. If it is cancelled while waiting, Cancelled is raised.
+        :param timeout: Optional number of seconds after which None is returned if nothing has arrived.
+        """
+
+        def wake():
+            with self._cond:
+                self._cond.notify_all()
+
+        if token is not None:
+            token.register(wake)
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self._cond:
+                while not self._items:
+                    if token is not None and token.is_cancelled():
+                        raise Cancelled(token.reason)
+                    if deadline is None:
+                        self._cond.wait()
+                    elif not self._cond.wait(max(0, deadline - time.monotonic())) and not self._items:
+                        return None
+                return self._items.popleft()
+        finally:
+            if token is not None:
+                token.unregister(wake)
+
+    def clear(self):
+        """
+        Drops everything that is queued.
+        :return: The dropped items.
+        """
+        with self._cond:
+            dropped = list(self._items)
+            self._items.clear()
+        return dropped
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+
+import numpy as np
+from pydub import AudioSegment
+
+from pipeline.channel import Channel
+from utils import audio
+
+AUDIO_FILE_EXTENSIONS = (".wav", ".mp3", ".ogg", ".flac")
+TONE_DURATION = 0.09  # seconds per note of a synthesized earcon
+TONE_VOLUME = 0.3  # share of full scale
+FILLER_DELAY = 1.5  # seconds after the query is transcribed without response audio before a filler is played
+
+
+def decode_clip(file_path, rate):
+    """
+    :return: The file's audio as mono int16 samples at the given rate.
+    """
+    segment = AudioSegment.from_file(file_path).set_channels(1).set_frame_rate(rate).set_sample_width(2)
+    return np.frombuffer(segment.raw_data, dtype=np.int16)
+
+
+def tone_clip(frequencies, rate):
+    """
+    :return: Notes of the given frequencies, one after the other, each with a short fade in and out.
+    """
+    t = np.arange(int(TONE_DURATION * rate)) / rate
+    envelope = np.minimum(1, np.minimum(t, TONE_DURATION - t) / 0.01)
+    notes = [np.sin(2 * np.pi * frequency * t) * envelope for frequency in frequencies]
+    return np.int16(np.concatenate(notes) * TONE_VOLUME * 32767)
+
+
+class AudioCues:
+    """
+    Short clips played through the pipeline's AudioPlayer: earcons (e.g. acknowledging the end of a query) and fillers
+    that cover a slow response. Clips are decoded once, at the speaker's rate, and kept in memory. The persona declares
+    them in its json:
+
+        "cues": {"earcons": {"acknowledge": [660, 990], "done": "done.wav"}, "fillers": ["Hmm.", "filler.mp3"]}
+
+    An earcon is a file in the assets directory or a list of tone frequencies. A filler is a file or a phrase, which
+    is synthesized once in the persona's voice. The persona's startup sound is available as the "startup" earcon.
+    """
+
+    def __init__(self, persona, player, sound_config, tts_client=None):
+        self.player = player
+        self.sound_config = sound_config
+        self.rate = player.speaker_rate
+        self.clips = {}
+        self.fillers = []
+        self.next_filler = 0
+        dir_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "assets")
+
+        declared = dict(persona.cues.get('earcons', {}))
+        if persona.startup_sound:
+            declared['startup'] = persona.startup_sound
+        for name, clip in declared.items():
+            try:
+                self.clips[name] = tone_clip(clip, self.rate) if isinstance(clip, list) else \
+                    decode_clip(os.path.join(dir_path, clip), self.rate)
+            except Exception as e:
+                logging.warning(f"Unable to load the '{name}' earcon: {e}")
+
+        phrases = []
+        for filler in persona.cues.get('fillers', []):
+            if filler.lower().endswith(AUDIO_FILE_EXTENSIONS):
+                try:
+                    self.fillers.append(decode_clip(os.path.join(dir_path, filler), self.rate))
+                except Exception as e:
+                    logging.warning(f"Unable to load the filler '{filler}': {e}")
+            else:
+                phrases.append(filler)
+        if phrases and tts_client is not None:
+            # synthesized in the background so startup doesn't wait for the TTS service
+            thread = threading.Thread(target=self._synthesize_fillers, args=(phrases, tts_client),
+                                      name="cue-fillers")
+            thread.daemon = True
+            thread.start()
+
+        self.requests = Channel("cues")
+        thread = threading.Thread(target=self._run, name="cues")
+        thread.daemon = True
+        thread.start()
+
+    def _synthesize_fillers(self, phrases, tts_client):
+        for phrase in phrases:
+            try:
+                data = b''.join(chunk for chunk in tts_client.get_audio_generator(phrase) if chunk)
+                samples = np.frombuffer(data[:len(data) // 2 * 2], dtype=np.int16)
+                self.fillers.append(audio.resample_audio(samples, tts_client.sample_rate, self.rate))
+            except Exception as e:
+                logging.warning(f"Unable to synthesize the filler '{phrase}': {e}")
+        logging.debug(f"{len(self.fillers)} fillers ready")
+
+    def play(self, name):
+        """
+        Plays an earcon without waiting for it. Unknown names are ignored.
+        """
+        if name in self.clips:
+            self.requests.put(name)
+
+    def _run(self):
+        while True:
+            name = self.requests.get()
+            try:
+                self.player.play(self.clips[name], self.rate, volume=self.sound_config['speaker']['volume'])
+            except Exception as e:
+                logging.warning(f"Unable to play the '{name}' earcon: {e}")
+
+    def play_filler(self, duck, is_cancelled=None):
+        """
+        Plays the next filler, blocking until it is over, it has ducked out or playback was cancelled.
+        :param duck: Callable that returns True once the response audio has arrived; the filler then fades out.
+        :return: True if a filler was played.
+        """
+        if not self.fillers:
+            return False
+        filler = self.fillers[self.next_filler % len(self.fillers)]
+        self.next_filler += 1
+        self.player.play(filler, self.rate, volume=self.sound_config['speaker']['volume'], is_cancelled=is_cancelled,
+                         duck=duck)
+        return True
@@ -0,0 +1,61 @@
+"""
+Typed messages passed between the stages of the response pipeline (LLM -> segmenter -> TTS -> playback). Every
+message carries the Turn it belongs to so stages can drop leftovers from a cancelled turn.
+"""
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from pipeline.cancellation import CancellationToken
+
+
+@dataclass
+class Turn:
+    question_text: str
+    response: Optional[str] = None  # local response that skips the LLM (e.g. preprocessing answered the query)
+    proc_start_time: float = 0.0  # time.time() when processing of the query started
+    token: CancellationToken = field(default_factory=CancellationToken)
+    finished: threading.Event = field(default_factory=threading.Event)  # playback is over
+    llm_done: threading.Event = field(default_factory=threading.Event)  # the LLM stage has returned
+    llm_completed: bool = False  # the whole response was received (and stored) before any cancellation
+    timeout_flag: bool = False
+    continue_conversation: bool = True
+    metrics: dict = field(default_factory=dict)
+    created_at: float = field(default_factory=time.perf_counter)  # when the transcribed query was dispatched
+    received_text: str = ""  # everything the LLM stage received
+    text_after_cancel: str = ""  # text that arrived after the turn was cancelled
+    sentences: list = field(default_factory=list)  # Sentence messages produced by the segmenter
+    played_samples: dict = field(default_factory=dict)  # sentence index -> samples that reached the speaker
+    sentence_samples: dict = field(default_factory=dict)  # sentence index -> total samples, once fully synthesized
+    sample_rate: int = 0  # sample rate of the tts audio
+    tts_request: object = None  # RequestToken of the turn's TTS requests, so a barge-in also stops one not yet sent
+
+
+@dataclass
+class TextChunk:
+    turn: Turn
+    text: str
+
+
+@dataclass
+class Sentence:
+    turn: Turn
+    text: str
+    index: int
+
+
+@dataclass
+class AudioChunk:
+    turn: Turn
+    data: bytes
+    sample_rate: int
+    sentence_index: int
+
+
+@dataclass
+class EndOfStream:
+    """
+    Sent by a stage after the last message of a turn, whether the turn completed, failed or was cancelled.
+    """
+    turn: Turn
@@ -0,0 +1,356 @@
+import logging
+import threading
+import time
+import traceback
+
+import requests.exceptions
+
+import conversationmanager
+from conversationmanager import InvalidInputError
+from pipeline.cancellation import Cancelled
+from pipeline.channel import Channel
+from pipeline.cues import FILLER_DELAY
+from pipeline.messages import AudioChunk, EndOfStream, Sentence, TextChunk, Turn
+from pipeline.segmenter import SentenceSegmenter, spoken_text
+from utils import audio as audio
+
+MAX_LLM_RETRIES = 2  # max llm timeouts
+MAX_TTS_RETRIES = 2  # max tts timeouts
+LLM_ABORT_TIMEOUT = 2  # how long to wait for an aborted LLM request to return before storing the spoken response
+
+
+class ResponsePipeline:
+    """
+    Long-lived staged pipeline that turns a query into spoken audio: LLM -> segmenter -> TTS -> playback, with a stop
+    word monitor running alongside. Each stage is a persistent worker thread fed by a Channel, so starting a turn
+    only costs a few queue puts. A turn is cancelled through its CancellationToken, which wakes every blocked stage
+    and stops playback immediately.
+    """
+
+    def __init__(self, scheduler, light, bt_light, sound_config, web_service):
+        self.scheduler = scheduler
+        self.light = light
+        self.bt_light = bt_light
+        self.sound_config = sound_config
+        # the active persona's, see use()
+        self.conversation_manager = None
+        self.tts_client = None
+        self.persona = None
+        self.cues = None
+        self.turn_lock = threading.Lock()
+        self.web_service = web_service
+
+        self.text = Channel("text")
+        self.sentences = Channel("sentences")
+        self.audio = Channel("audio")
+        self.player = audio.AudioPlayer(self.sound_config['speaker']['rate'],
+                                        device_name=self.sound_config['speaker']['device_name'])
+        self.last_metrics = {}
+
+        self.stages = {}
+        for name, handler in (("llm", self._llm_stage),
+                              ("segmenter", self._segmenter_stage),
+                              ("tts", self._tts_stage),
+                              ("playback", self._playback_stage),
+                              ("stop_word", self._stop_word_stage)):
+            turns = Channel(f"{name}_turns")
+            worker = threading.Thread(target=self._run_stage, args=(name, turns, handler), name=f"pipeline-{name}")
+            worker.daemon = True
+            worker.start()
+            self.stages[name] = turns
+
+    def use(self, context):
+        """
+        Speaks for the given PersonaContext from the next turn on. Waits for the current turn to finish.
+        """
+        with self.turn_lock:
+            self.conversation_manager = context.conversation_manager
+            self.tts_client = context.tts_client
+            self.persona = context.persona
+            self.cues = context.cues
+
+    def run_turn(self, response, question_text, proc_start_time, on_playback_finished=None):
+        """
+        Speaks the response to a query and blocks until playback has finished or the turn was cancelled.
+        :param response: Local response to speak instead of asking the LLM, or None.
+        :param question_text: The transcribed query.
+        :param proc_start_time: time.time() when processing of the query started.
+        :param on_playback_finished: Called as soon as playback ends, before the turn is wrapped up (e.g. to start
+        listening for a follow-up).
+        :return: Tuple of (timeout_flag, continue_conversation)
+        """
+        # the persona can't be switched mid-turn, see use()
+        with self.turn_lock:
+            turn = Turn(question_text=question_text, response=response, proc_start_time=proc_start_time)
+            # barge-in: abort the network streams and drop everything that is buffered
+            turn.token.register(self.conversation_manager.llm_client.cancel)
+            turn.tts_request = self.tts_client.new_request()
+            turn.token.register(lambda tts_client=self.tts_client: tts_client.cancel(turn.tts_request))
+            turn.token.register(self._flush)
+            for turns in self.stages.values():
+                turns.put(turn)
+            turn.metrics['setup_time'] = time.perf_counter() - turn.created_at
+            logging.debug(f"Pipeline turn dispatched in {turn.metrics['setup_time'] * 1000:.3f} ms")
+
+            try:
+                turn.finished.wait()
+                if on_playback_finished:
+                    on_playback_finished()
+                if turn.token.is_cancelled() and turn.response is None:
+                    self._store_spoken_response(turn)
+            finally:
+                # the turn keeps the conversation until the spoken part of an interrupted response is stored
+                self.scheduler.release(self.conversation_manager, turn)
+            self.last_metrics = turn.metrics
+            return turn.timeout_flag, turn.continue_conversation
+
+    def cancel(self, turn, reason):
+        logging.info(f"Cancelling response: {reason}")
+        turn.token.cancel(reason)
+
+    def _flush(self):
+        dropped = len(self.text.clear()) + len(self.sentences.clear()) + len(self.audio.clear())
+        logging.debug(f"Flushed {dropped} buffered pipeline messages")
+
+    def _store_spoken_response(self, turn):
+        """
+        Stores the part of an interrupted response that was actually played.
+        """
+        if not turn.llm_done.wait(LLM_ABORT_TIMEOUT):
+            logging.warning("Aborted LLM request has not returned yet.")
+        spoken = spoken_text(turn.sentences, turn.played_samples, turn.sentence_samples, turn.sample_rate,
+                             word_marks=self.tts_client.word_marks)
+        # if the whole response arrived before the stop word, it has already been stored in full and is replaced
+        self.conversation_manager.append_interrupted_response(spoken, tag=turn)
+        self._report_barge_in(turn, spoken)
+
+    def _report_barge_in(self, turn, spoken):
+        model = self.conversation_manager.llm_client.model
+        turn.metrics['tokens_after_cancel'] = conversationmanager.count_tokens(turn.text_after_cancel, model)
+        turn.metrics['unspoken_tokens'] = max(0, conversationmanager.count_tokens(turn.received_text, model) -
+                                              conversationmanager.count_tokens(spoken, model))
+        if 'llm_abort_time' in turn.metrics:
+            logging.info(f"Barge-in: LLM stream closed {turn.metrics['llm_abort_time'] * 1000:.0f} ms after "
+                         f"cancellation.")
+        logging.info(f"Barge-in: {turn.metrics['tokens_after_cancel']} tokens received after cancellation, "
+                     f"{turn.metrics['unspoken_tokens']} generated tokens never spoken.")
+
+    @staticmethod
+    def _run_stage(name, turns, handler):
+        while True:
+            turn = turns.get()
+            try:
+                handler(turn)
+            except Cancelled:
+                logging.debug(f"Pipeline stage '{name}' cancelled")
+            except Exception as e:
+                logging.error(f"Pipeline stage '{name}' failed: {e}")
+                traceback.print_exc()
+                turn.timeout_flag = True
+                turn.token.cancel(f"{name} failed")
+
+    @staticmethod
+    def _receive(channel, turn, timeout=None):
+        """
+        Returns the next message for this turn, silently dropping leftovers from earlier (cancelled) turns.
+        :param timeout: Optional number of seconds after which None is returned if no message has arrived.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            message = channel.get(turn.token, None if deadline is None else max(0, deadline - time.monotonic()))
+            if message is None or message.turn is turn:
+                return message
+
+    def _llm_stage(self, turn):
+        response_generator = None
+        try:
+            if turn.response is not None:
+                self.text.put(TextChunk(turn, turn.response))
+                return
+
+            retries = 0
+            while retries < MAX_LLM_RETRIES:
+                response_generator = self.scheduler.submit(self.conversation_manager, turn.question_text,
+                                                           origin="voice", owner=turn, token=turn.token)
+                try:
+                    for response_chunk in response_generator:
+                        if turn.token.is_cancelled():
+                            # stop word detected
+                            turn.text_after_cancel += response_chunk or ""
+                            break
+                        if response_chunk is None:
+                            turn.llm_completed = True
+                            break
+                        turn.received_text += response_chunk
+                        self.text.put(TextChunk(turn, response_chunk))
+                    break  # generator has been fully consumed, so exit the loop
+                except requests.exceptions.HTTPError as e:
+                    self.web_service.send_new_assistant_msg("<Error processing request>",
+                                                            self.conversation_manager.llm_client.model)
+                    logging.error(f"Error retrieving response from LLM: {e}")
+                    break
+                except InvalidInputError:
+                    self.web_service.send_new_assistant_msg("<Nonsense detected>",
+                                                            self.conversation_manager.llm_client.model)
+                    logging.warning("Nonsense detected!")
+                    turn.continue_conversation = False
+                    break
+                except TimeoutError:
+                    logging.warning(f"LLM timeout. Retrying {MAX_LLM_RETRIES - retries - 1} more times...")
+                    retries += 1
+                except Exception as e:
+                    logging.error(
+                        f"Unknown error when attempting LLM request - retrying {MAX_LLM_RETRIES - retries - 1} more "
+                        f"times: {e}")
+                    traceback.print_exc()
+                    retries += 1
+                finally:
+                    response_generator.close()
+            if retries >= MAX_LLM_RETRIES:
+                turn.timeout_flag = True
+        finally:
+            # iteration stops as soon as the turn is cancelled; wait for the scheduled request to return
+            if response_generator is not None and not response_generator.done.wait(LLM_ABORT_TIMEOUT):
+                logging.warning("Scheduled LLM request has not returned yet.")
+            if turn.token.is_cancelled() and not turn.llm_completed:
+                turn.metrics['llm_abort_time'] = time.perf_counter() - turn.token.cancelled_at
+            turn.llm_done.set()
+            self.text.put(EndOfStream(turn))
+
+    def _segmenter_stage(self, turn):
+        segmenter = SentenceSegmenter()
+        index = 0
+        first_chunk = True
+        while True:
+            message = self._receive(self.text, turn)
+            if isinstance(message, EndOfStream):
+                remaining = segmenter.flush()
+                if remaining:
+                    self._emit_sentence(turn, remaining, index)
+                self.sentences.put(message)
+                return
+
+            if first_chunk:
+                turn.metrics['text_received_time'] = time.time()
+                logging.info(
+                    f"First text chunk received ({time.perf_counter() - turn.created_at:.2f} seconds)")
+                first_chunk = False
+
+            # check if the buffer contains a full sentence to send to the tts stage
+            sentence = segmenter.feed(message.text)
+            if sentence:
+                self._emit_sentence(turn, sentence, index)
+                index += 1
+
+    def _emit_sentence(self, turn, text, index):
+        sentence = Sentence(turn, text, index)
+        turn.sentences.append(sentence)
+        self.sentences.put(sentence)
+
+    def _tts_stage(self, turn):
+        try:
+            while True:
+                message = self._receive(self.sentences, turn)
+                if isinstance(message, EndOfStream):
+                    return
+                if turn.timeout_flag:
+                    continue
+                self._synthesize(message)
+        finally:
+            self.audio.put(EndOfStream(turn))
+
+    def _synthesize(self, sentence):
+        """
+        Sends a sentence to the tts generator and queues the output for playback.
+        """
+        turn = sentence.turn
+        text = conversationmanager.remove_timestamp(sentence.text)
+        retries = 0
+        while retries < MAX_TTS_RETRIES:
+            try:
+                total_samples = 0
+                for audio_chunk in self.tts_client.get_audio_generator(text, token=turn.tts_request):
+                    turn.token.raise_if_cancelled()
+                    if audio_chunk is not None:
+                        total_samples += audio.sample_count(audio_chunk)
+                    self.audio.put(AudioChunk(turn, audio_chunk, self.tts_client.sample_rate, sentence.index))
+                turn.token.raise_if_cancelled()
+                turn.sentence_samples[sentence.index] = total_samples
+                return
+            except TimeoutError:
+                logging.warning(f"TTS timeout. Retrying {MAX_TTS_RETRIES - retries - 1} more times...")
+                retries += 1
+            except Cancelled:
+                raise
+            except Exception as e:
+                logging.error(f"Unknown error when attempting TTS request: {e}")
+                retries += 1
+        turn.timeout_flag = True
+
+    def _playback_stage(self, turn):
+        turn.token.register(self.player.abort)  # cut off the chunk that is currently playing
+        first_chunk = True
+        filler_played = False
+        try:
+            while True:
+                if first_chunk and not filler_played:
+                    # cover a slow response with a filler, which ducks out as soon as the response audio arrives.
+                    # The delay counts from the start of the turn, after transcription, so a slow STT doesn't use it up
+                    message = self._receive(self.audio, turn,
+                                            timeout=max(0, turn.created_at + FILLER_DELAY - time.perf_counter()))
+                    if message is None:
+                        filler_played = True
+                        filler_start = time.perf_counter()
+                        if self.cues.play_filler(duck=lambda: len(self.audio) > 0,
+                                                 is_cancelled=turn.token.is_cancelled):
+                            logging.info(f"Played a filler for {time.perf_counter() - filler_start:.2f} seconds")
+                        turn.token.raise_if_cancelled()
+                        continue
+                else:
+                    message = self._receive(self.audio, turn)
+                if isinstance(message, EndOfStream):
+                    break
+                if message.data is None:
+                    continue
+                try:
+                    if first_chunk:
+                        self.light.turn_off()
+                        self.bt_light.turn_off()
+                        turn.metrics['audio_received_time'] = time.time()
+                        text_received_time = turn.metrics.get('text_received_time', turn.metrics['audio_received_time'])
+                        logging.info(
+                            f"First audio chunk received "
+                            f"({turn.metrics['audio_received_time'] - text_received_time:.2f} seconds)")
+                        logging.info(
+                            f"Total time since query: {turn.metrics['audio_received_time'] - turn.proc_start_time:.2f}"
+                            f" seconds")
+                        first_chunk = False
+                    turn.sample_rate = message.sample_rate
+                    # TODO move tts rate to tts clients
+                    played = self.player.play(message.data, message.sample_rate,
+                                              volume=self.sound_config['speaker']['volume'],
+                                              is_cancelled=turn.token.is_cancelled)
+                    turn.played_samples[message.sentence_index] = \
+                        turn.played_samples.get(message.sentence_index, 0) + played
+                    turn.token.raise_if_cancelled()
+                finally:
+                    self.light.turn_off()
+                    self.bt_light.turn_off()
+        except Cancelled:
+            turn.metrics['cancel_to_silence'] = time.perf_counter() - turn.token.cancelled_at
+            logging.info(f"Barge-in: playback stopped {turn.metrics['cancel_to_silence'] * 1000:.0f} ms after "
+                         f"cancellation ({turn.token.reason})")
+            raise
+        finally:
+            turn.token.unregister(self.player.abort)
+            turn.finished.set()
+
+    def _stop_word_stage(self, turn):
+        # TODO get wakeword sensitivities from persona
+        reader = audio.get_capture(self.sound_config['microphone']['rate']).open_reader()
+        try:
+            detected = audio.wait_for_wake_word(self.persona.stop_words, reader, stop_event=turn.finished)
+        finally:
+            reader.close()
+        if detected is not None and not turn.finished.is_set():
+            self.cancel(turn, "stop word detected")
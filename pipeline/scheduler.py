@@ -0,0 +1,247 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from pipeline.cancellation import Cancelled, CancellationToken
+from pipeline.channel import Channel
+
+WORKERS = 2  # requests that can run at the same time (one per conversation)
+CHANNEL_PRIORITY = {"voice": 0, "web": 1}  # lower runs first; other origins are treated as web
+MAX_QUEUED = 20  # per channel
+WEB_RATE = 10  # requests per minute a web client can send in the long run
+WEB_BURST = 3  # requests a web client can send back to back
+WAIT_EWMA_ALPHA = 0.2
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class _End:
+    pass
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class ScheduledRequest:
+    """
+    A get_response() call queued in the RequestScheduler. Iterating over it yields the chunks of the response as the
+    worker produces them and raises whatever get_response() raised, so it can be used like the generator itself.
+    """
+
+    def __init__(self, conversation_manager, message, origin, channel, client=None, owner=None):
+        self.conversation_manager = conversation_manager
+        self.message = message
+        self.origin = origin
+        self.channel = channel
+        self.client = client
+        self.owner = owner
+        self.tag = owner  # stored with the response, see ConversationManager.append_interrupted_response()
+        self.token = CancellationToken()
+        self.chunks = Channel(f"{channel}_response")
+        self.done = threading.Event()  # set when get_response() has returned or the request was dropped
+        self.submitted_at = time.perf_counter()
+        self.wait_time = None  # seconds spent in the queue
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self.chunks.get(self.token)
+            except Cancelled:
+                return
+            if isinstance(item, _End):
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def close(self):
+        """
+        Drops the request if it hasn't started, or stops it after the current chunk. Iteration ends immediately.
+        """
+        self.token.cancel("closed")
+
+
+class RequestScheduler:
+    """
+    Runs get_response() calls for the voice pipeline and the web UI on a bounded pool of worker threads. Requests
+    wait in a queue per channel; voice requests are always started before web requests, and web clients are rate
+    limited. Only one request per conversation runs at a time, so turns from different channels can't interleave
+    their messages in the history. A request with an owner (e.g., a voice turn) keeps the conversation until
+    release() is called, so the owner can finish updating the conversation after the response.
+    """
+
+    def __init__(self, workers=WORKERS, web_rate=WEB_RATE, web_burst=WEB_BURST, max_queued=MAX_QUEUED):
+        self.workers = workers
+        self.web_rate = web_rate / 60
+        self.web_burst = web_burst
+        self.max_queued = max_queued
+
+        self.cond = threading.Condition()
+        self.queues = {channel: deque() for channel in CHANNEL_PRIORITY}
+        self.holders = {}  # conversation manager -> the request or owner using it
+        self.buckets = {}  # web client -> (tokens, time.monotonic() of the last update)
+
+        self.running = 0
+        self.peak_running = 0
+        self.wait_stats = {channel: {"last": None, "avg": None, "max": 0} for channel in CHANNEL_PRIORITY}
+        self.completed = {channel: 0 for channel in CHANNEL_PRIORITY}
+        self.rejected = {channel: 0 for channel in CHANNEL_PRIORITY}
+
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name=f"scheduler-{i}")
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, conversation_manager, message, origin, client=None, owner=None, token=None):
+        """
+        Queues a get_response() call.
+        :param client: Identifies the web client for rate limiting.
+        :param owner: If given, the conversation stays reserved for requests of this owner until release() is called.
+        :param token: Optional CancellationToken that closes the request when cancelled, even while it is queued.
+        :return: ScheduledRequest to iterate over.
+        :raises RateLimitedError: If the web client sends too many requests or the channel's queue is full.
+        """
+        channel = "voice" if origin == "voice" else "web"
+        request = ScheduledRequest(conversation_manager, message, origin, channel, client=client, owner=owner)
+        with self.cond:
+            if len(self.queues[channel]) >= self.max_queued:
+                self.rejected[channel] += 1
+                raise RateLimitedError(f"Too many queued {channel} requests")
+            if channel == "web" and not self._take_token(client):
+                self.rejected[channel] += 1
+                raise RateLimitedError(f"Web client {client} is sending too many requests")
+            self.queues[channel].append(request)
+            self.cond.notify_all()
+        request.token.register(lambda: self._drop_if_queued(request))
+        if token is not None:
+            token.register(request.close)
+        return request
+
+    def _drop_if_queued(self, request):
+        with self.cond:
+            if request not in self.queues[request.channel]:
+                return
+            self.queues[request.channel].remove(request)
+        request.chunks.put(_End())
+        request.done.set()
+
+    def release(self, conversation_manager, owner):
+        """
+        Frees a conversation reserved by submit(owner=...). Does nothing if the owner doesn't hold it.
+        """
+        with self.cond:
+            holder = self.holders.get(conversation_manager)
+            if holder is owner:
+                del self.holders[conversation_manager]
+                self.cond.notify_all()
+            elif isinstance(holder, ScheduledRequest) and holder.owner is owner:
+                holder.owner = None  # the conversation is freed when the running request finishes
+
+    def run_if_idle(self, conversation_manager, action):
+        """
+        Calls action() if no request is using or waiting for the conversation. No request for it can start until
+        action() has returned.
+        :return: Whether action() was called.
+        """
+        with self.cond:
+            if conversation_manager in self.holders or any(request.conversation_manager is conversation_manager
+                                                           for queue in self.queues.values() for request in queue):
+                return False
+            action()
+            return True
+
+    def _take_token(self, client):
+        tokens, last = self.buckets.get(client, (self.web_burst, time.monotonic()))
+        now = time.monotonic()
+        tokens = min(self.web_burst, tokens + (now - last) * self.web_rate)
+        if tokens < 1:
+            self.buckets[client] = (tokens, now)
+            return False
+        self.buckets[client] = (tokens - 1, now)
+        return True
+
+    def _next_request(self):
+        """
+        Blocks until a request can run: the oldest request of the highest priority channel whose conversation isn't
+        in use by someone else.
+        """
+        with self.cond:
+            while True:
+                for channel in sorted(self.queues, key=CHANNEL_PRIORITY.get):
+                    queue = self.queues[channel]
+                    for request in queue:
+                        holder = self.holders.get(request.conversation_manager)
+                        if holder is None or (request.owner is not None and holder is request.owner):
+                            queue.remove(request)
+                            self.holders[request.conversation_manager] = request
+                            self.running += 1
+                            self.peak_running = max(self.peak_running, self.running)
+                            self._record_wait(request)
+                            return request
+                self.cond.wait()
+
+    def _record_wait(self, request):
+        request.wait_time = time.perf_counter() - request.submitted_at
+        stats = self.wait_stats[request.channel]
+        stats['last'] = request.wait_time
+        stats['avg'] = request.wait_time if stats['avg'] is None else \
+            WAIT_EWMA_ALPHA * request.wait_time + (1 - WAIT_EWMA_ALPHA) * stats['avg']
+        stats['max'] = max(stats['max'], request.wait_time)
+        logging.debug(f"Starting {request.channel} request after {request.wait_time * 1000:.0f} ms in the queue "
+                      f"({self.running}/{self.workers} workers busy)")
+
+    def _work(self):
+        while True:
+            request = self._next_request()
+            try:
+                self._run(request)
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    self.completed[request.channel] += 1
+                    if self.holders.get(request.conversation_manager) is request:
+                        if request.owner is None:
+                            del self.holders[request.conversation_manager]
+                        else:
+                            self.holders[request.conversation_manager] = request.owner
+                    self.cond.notify_all()
+                request.done.set()
+
+    @staticmethod
+    def _run(request):
+        if request.token.is_cancelled():  # closed just as it was picked
+            request.chunks.put(_End())
+            return
+        generator = request.conversation_manager.get_response(request.message, origin=request.origin,
+                                                              tag=request.tag)
+        try:
+            for chunk in generator:
+                if request.token.is_cancelled():
+                    break
+                request.chunks.put(chunk)
+        except Exception as e:
+            # raised again in the thread that iterates over the request
+            request.chunks.put(_Failure(e))
+        finally:
+            generator.close()
+            request.chunks.put(_End())
+
+    def metrics(self):
+        """
+        :return: Dictionary with the queue lengths, queue wait times (seconds) and worker usage.
+        """
+        with self.cond:
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "peak_running": self.peak_running,
+                "queued": {channel: len(queue) for channel, queue in self.queues.items()},
+                "wait": {channel: dict(stats) for channel, stats in self.wait_stats.items()},
+                "completed": dict(self.completed),
+                "rejected": dict(self.rejected),
+            }
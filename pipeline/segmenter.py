@@ -0,0 +1,93 @@
+import re
+
+SENTENCE_REGEX = re.compile(r"(^.*[^\s.\d]{2,}[\.\?!\n])(.+)")  # (full sentence, trailing text)
+DEFAULT_CHARS_PER_SECOND = 14  # speaking rate used when a sentence's total audio length isn't known yet
+
+
+class SentenceSegmenter:
+    """
+    Accumulates streamed text and splits off complete sentences so they can be sent to TTS as early as possible.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text):
+        """
+        :return: The completed sentence, or None if the buffer doesn't contain one yet.
+        """
+        self.buffer += text
+        match = SENTENCE_REGEX.search(self.buffer)
+        if match:
+            full_sentence, self.buffer = match.groups()  # keep the trailing text in buffer
+            return full_sentence
+        return None
+
+    def flush(self):
+        """
+        :return: Whatever is left in the buffer, or None if it is empty.
+        """
+        remaining, self.buffer = self.buffer, ""
+        return remaining if remaining else None
+
+
+def truncate_to_played(text, played_samples, total_samples):
+    """
+    Cuts a sentence at the last word that was completely spoken, assuming words are spread evenly over its audio. This
+    is only an approximation (word lengths and pauses vary), used when the TTS service has no word marks.
+    :param played_samples: Samples of the sentence's audio that were played.
+    :param total_samples: Total samples of the sentence's audio.
+    """
+    if total_samples <= 0 or played_samples >= total_samples:
+        return text
+    cut = int(len(text) * played_samples / total_samples)
+    if cut < len(text) and not text[cut].isspace():
+        # the word at the cut was only partially spoken
+        cut = text.rfind(" ", 0, cut)
+    return text[:cut].rstrip() if cut > 0 else ""
+
+
+def truncate_to_marks(text, played_seconds, marks):
+    """
+    Cuts a sentence after the last word that was completely spoken: the last word whose next word had started.
+    :param marks: List of (seconds, offset in text after the word) for every word, see TTSClient.word_marks().
+    """
+    cut = 0
+    for (_, end), (next_start, _) in zip(marks, marks[1:]):
+        if next_start > played_seconds:
+            break
+        cut = end
+    return text[:cut].rstrip()
+
+
+def spoken_text(sentences, played_samples, sentence_samples, sample_rate, word_marks=None):
+    """
+    Reconstructs the portion of a response that was actually heard.
+    :param sentences: Sentences in the order they were produced.
+    :param played_samples: Dictionary of sentence index to the number of samples that were played.
+    :param sentence_samples: Dictionary of sentence index to the total number of samples, for sentences that were
+    fully synthesized.
+    :param sample_rate: Sample rate used for both sample counts.
+    :param word_marks: Function returning the word marks of a text, or None if they aren't available (see
+    TTSClient.word_marks()). It is only called for the sentence that was cut off. Without marks, words are assumed to
+    be spread evenly over the sentence's audio.
+    """
+    spoken = ""
+    for sentence in sentences:
+        played = played_samples.get(sentence.index, 0)
+        if not played:
+            break
+        total = sentence_samples.get(sentence.index)
+        if total is None:
+            # still being synthesized when playback stopped
+            total = max(played + 1, int(len(sentence.text) / DEFAULT_CHARS_PER_SECOND * sample_rate))
+        if played >= total:
+            spoken += sentence.text
+            continue
+        marks = word_marks(sentence.text) if word_marks else None
+        if marks:
+            spoken += truncate_to_marks(sentence.text, played / sample_rate, marks)
+        else:
+            spoken += truncate_to_played(sentence.text, played, total)
+        break
+    return spoken.strip()
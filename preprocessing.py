@@ -9,6 +9,7 @@ class Action(Enum):
     CONTINUE = 0
     REPLACE = 1
     VOLUME_ADJUST = 2
+    SWITCH_PERSONA = 3
 
 
 def preprocess(query: str):
@@ -58,9 +59,24 @@ def preprocess(query: str):
     if is_volume is not None:
         return Action.VOLUME_ADJUST, is_volume
 
+    persona_name = check_for_persona_switch(query_stripped)
+    if persona_name:
+        return Action.SWITCH_PERSONA, persona_name
+
     return Action.CONTINUE, query
 
 
+def check_for_persona_switch(query):
+    """
+    :return: The name of the persona asked for, e.g. 'gandalf' for "let me talk to Gandalf", or None.
+    """
+    match = re.search(r"^(?:(?:please |can you )?(?:switch|change)(?: over)? to|(?:let me|i want to|i'd like to) "
+                      r"(?:talk|speak) (?:to|with)|put) ([a-z]+)(?: on)?,?(?: please)?$", query)
+    if match:
+        return match.group(1)
+    return None
+
+
 def check_for_volume(query):
     match = re.search(r'set(?: your| the)? volume to ([^\s%]+) ?(?:%|percent)?', query)
     if match:
@@ -1,16 +1,25 @@
 import logging
 
+from enums.state_event_enum import StateEvent
 from utils.audio import wait_for_wake_word
 from .state_interface import State
 
 
 class Asleep(State):
 
-    def __init__(self, wakewords, mic_rate):
+    def __init__(self, wakewords, on_wake=None):
+        """
+        :param wakewords: Wake words of every persona, all detected by one Porcupine instance.
+        :param on_wake: Called with the index of the wake word as soon as it is detected, e.g. to switch to its persona
+        and warm up connections.
+        """
         self.wakewords = wakewords
-        self.mic_rate = mic_rate
+        self.on_wake = on_wake
 
     # TODO add a wake word that simply responds with who the current personality is: "what personality is loaded?"
-    def run(self):
+    def run(self, reader):
         logging.info("Entering Sleep state")
-        return wait_for_wake_word(self.wakewords, self.mic_rate)
+        keyword_index = wait_for_wake_word(self.wakewords, reader)
+        if self.on_wake:
+            self.on_wake(keyword_index)
+        return StateEvent.WAKE_WORD
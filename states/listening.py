@@ -1,24 +1,23 @@
 import logging
 import os
-import queue
-import re
 import threading
 import time
 import traceback
-import wave
 
 import numpy as np
 import pvcobra
-import requests.exceptions
 from termcolor import cprint
 
-# from clients.tts.riva_tts import RivaTTS as tts_client
-# from clients.tts.openai_tts import OpenAITTS as tts_client
-import conversationmanager
-from clients.tts.polly_tts import PollyTTS as tts_client
-from conversationmanager import ConversationManager, InvalidInputError
+from clients.warmup import warm_up_in_background
+from enums.state_event_enum import StateEvent
+from persona_context import PersonaContext
+from pipeline.response_pipeline import ResponsePipeline
+from pipeline.scheduler import RequestScheduler
 from preprocessing import Action, preprocess
 from utils import audio as audio
+from utils.speculative_stt import SPECULATIVE_PAUSE_TIME, SpeculativeStt
+from utils.speech_gate import SpeechGate
+from utils.stt_encoder import StreamingEncoder
 from web.web_service import WebService
 from .state_interface import State
 
@@ -26,38 +25,57 @@ VOICE_DETECTION_RATE = 16000  # voice detection rate to be downsampled to
 VOICE_DETECTION_THRESHOLD = 0.5  # voice activity sensitivity
 MAX_DURATION = 25  # how long to listen for regardless of voice detection
 ENDING_PAUSE_TIME = 1  # seconds of pause before listening stops
-QUEUE_TIMEOUT = 5  # how long for pipeline to wait for an empty queue
 INITIAL_PAUSE_TIME = 4  # time to wait for first words
-TRANSCRIPTION_FILE = "tmp_transcription.wav"
-MAX_LLM_RETRIES = 2  # max llm timeouts
-MAX_TTS_RETRIES = 2  # max tts timeouts
+# seconds at the end of playback kept for a follow-up that starts over the response's last words. Voice in them
+# doesn't count as the first words, since it is mostly the speaker's echo.
+FOLLOW_UP_OVERLAP = 0.5
+TRANSCRIPTION_FILE = "tmp_transcription"  # without the extension, which depends on the codec
 MAX_STT_RETRIES = 2  # max stt timeouts
 
 
-def initialize_audio_file(mic_rate):
-    wf = wave.open(TRANSCRIPTION_FILE, 'wb')
-    wf.setnchannels(audio.CHANNELS)
-    wf.setsampwidth(2)  # assuming 16-bit samples (2 bytes)
-    wf.setframerate(mic_rate)
-    return wf
-
-
-def record_query(audio_stream, audio_file, voice_detected, mic_rate, mic_amplification_factor, vad):
-    audio_stream.start_stream()
+def record_query(reader, encoder, voice_detected, mic_rate, mic_amplification_factor, vad, speculative_stt=None,
+                 speech_gate=None):
+    """
+    Records until the speaker pauses for ENDING_PAUSE_TIME (or INITIAL_PAUSE_TIME before the first words). Audio the
+    reader was rewound into (the end of the wake word, see audio.wait_for_wake_word(), or of the last response) is
+    recorded, but voice in it doesn't count as the first words.
+    :param encoder: StreamingEncoder the recording is written to (at VOICE_DETECTION_RATE).
+    :param speculative_stt: Optional SpeculativeStt that transcribes the recording so far during shorter pauses.
+    :param speech_gate: Optional SpeechGate that rejects recordings without enough speech and trims silence.
+    :return: Whether voice was detected (and the recording passed the speech gate).
+    """
     frames = []
+    voiced = []  # VAD decision for every frame
     buffer = np.array([], dtype=np.int16)
-    silence_since = time.time()
+    # time is counted in captured samples: audio handed on from the previous state can be read faster than real time
+    samples_read = 0
+    silence_since = 0
     frame_length = vad.frame_length
-    start_time = time.time()
     pause_time = INITIAL_PAUSE_TIME
-    while time.time() - start_time <= MAX_DURATION:
-        audio_data = audio_stream.read(audio.FRAMES_PER_BUFFER, exception_on_overflow=False)
+    # VAD samples (at VOICE_DETECTION_RATE) that were already heard before the reader was rewound
+    replayed = reader.replayed() * VOICE_DETECTION_RATE / mic_rate
+    if speech_gate is not None:
+        encoder.extend_to(0)  # nothing is encoded before the first words
+    while samples_read / mic_rate <= MAX_DURATION:
+        audio_data = reader.read(audio.FRAMES_PER_BUFFER)
+        if samples_read == 0:
+            dead_time = reader.dead_time()
+            if dead_time is not None:
+                logging.info(f"Recording started {dead_time * 1000:.0f} ms after the previous state stopped listening")
+        samples_read += len(audio_data)
         audio_data = audio.resample_audio(audio_data, mic_rate, VOICE_DETECTION_RATE)
 
         if audio_data is not None:
             buffer = np.concatenate((buffer, audio_data))
-            if silence_since is not None and time.time() - silence_since >= pause_time:
+            if silence_since is not None and (samples_read - silence_since) / mic_rate >= pause_time:
                 break
+            if speculative_stt is not None and voice_detected and not speculative_stt.pending() and \
+                    (samples_read - silence_since) / mic_rate >= SPECULATIVE_PAUSE_TIME and \
+                    (speech_gate is None or speech_gate.enough_speech(voiced, frame_length)):
+                recording = np.concatenate(frames)
+                if speech_gate is not None:
+                    recording = recording[speech_gate.leading_trim(voiced, frame_length):]
+                speculative_stt.start([recording], VOICE_DETECTION_RATE)  # frames are already resampled
 
             # take chunks out of size frame_length for voice detection
             while len(buffer) >= frame_length:
@@ -66,8 +84,19 @@ def record_query(audio_stream, audio_file, voice_detected, mic_rate, mic_amplifi
                 frame = np.int16(frame * mic_amplification_factor)
 
                 try:
-                    if vad.process(frame) > VOICE_DETECTION_THRESHOLD:
-                        silence_since = time.time()
+                    is_voiced = vad.process(frame) > VOICE_DETECTION_THRESHOLD
+                    voiced.append(is_voiced)
+                    if is_voiced and (len(voiced) - 1) * frame_length < replayed:
+                        # most likely the end of the wake word; kept in case the query started right after it
+                        cprint("w", "green", end="", flush=True)
+                    elif is_voiced:
+                        if speech_gate is not None:
+                            if not voice_detected:
+                                encoder.skip_to(speech_gate.leading_trim(voiced, frame_length))
+                            encoder.extend_to(speech_gate.trailing_limit(len(voiced), frame_length))
+                        silence_since = samples_read
+                        if speculative_stt is not None and speculative_stt.pending():
+                            speculative_stt.cancel()  # not the end of the query after all
                         voice_detected = True
                         pause_time = ENDING_PAUSE_TIME  # reset pause time after first words
                         cprint("V", "green", end="", flush=True)
@@ -79,9 +108,13 @@ def record_query(audio_stream, audio_file, voice_detected, mic_rate, mic_amplifi
                     exit(-1)
 
         frames.append(audio_data)
+        encoder.write(audio_data)
     print("")  # newline
-    # write audio to the file
-    audio_file.writeframes(b''.join(frames))
+    if voice_detected and speech_gate is not None:
+        if speech_gate.check(np.concatenate(frames), voiced, frame_length):
+            if speculative_stt is not None:
+                speculative_stt.cancel()
+            return False
     return voice_detected
 
 
@@ -112,39 +145,104 @@ def speech_to_text(file):
 
 class Listening(State):
 
-    def __init__(self, light, bt_light, persona, sound_config, web_service: WebService):
-        self.conversation_manager = ConversationManager(persona, web_service)
+    def __init__(self, light, bt_light, personas, sound_config, web_service: WebService, scheduler: RequestScheduler,
+                 on_persona_loaded=None):
+        """
+        :param personas: Personas to load. The first one is active until another one's wake word is detected.
+        :param on_persona_loaded: Called with each PersonaContext once it is loaded.
+        """
         self.web_service = web_service
-        self.web_service.conversation_manager = self.conversation_manager
-        self.persona = persona
+        self.scheduler = scheduler
         self.sound_config = sound_config
         self.light = light
         self.bt_light = bt_light
         self.vad = pvcobra.create(access_key=os.getenv('PICOVOICE_API_KEY'))
+        self.speculative_stt = SpeculativeStt()
+        self.speech_gate = SpeechGate(VOICE_DETECTION_RATE)
 
         # TODO load appropriate clients depending on config
         # TODO also load appropriate modules based on config
 
-        # self.tts_client = RivaTTS(self.persona, sample_rate=self.sound_config['tts']['rate'])
-        self.tts_client = tts_client(self.persona)
-        # self.tts_client = OpenAITTS(self.persona)
-
-    def run(self):
+        self.response_pipeline = ResponsePipeline(scheduler, self.light, self.bt_light, self.sound_config,
+                                                  self.web_service)
+        self.contexts = []
+        for persona in personas:
+            self.contexts.append(PersonaContext(persona, web_service, self.response_pipeline.player, sound_config))
+            if on_persona_loaded:
+                on_persona_loaded(self.contexts[-1])
+        self.context = None
+        self.switch_lock = threading.Lock()
+        self.activate(self.contexts[0])
+
+    @property
+    def persona_names(self):
+        return [context.name for context in self.contexts]
+
+    def activate(self, context):
+        """
+        Makes the given PersonaContext the one that answers, both by voice and on the web. Its conversation is
+        rehydrated if it was suspended, and the other personas' conversations are suspended.
+        """
+        with self.switch_lock:
+            if context is self.context:
+                return
+            start_time = time.perf_counter()
+            context.conversation_manager.resume()
+            self.response_pipeline.use(context)
+            self.context = context
+            self.persona = context.persona
+            self.conversation_manager = context.conversation_manager
+            self.tts_client = context.tts_client
+            self.web_service.switch_conversation(context.conversation_manager, self.persona_names)
+            logging.info(f"{context.name} is answering (switched in {(time.perf_counter() - start_time) * 1000:.1f} "
+                         f"ms)")
+        self.suspend_inactive()
+
+    def suspend_inactive(self):
+        """
+        Suspends the conversations of the inactive personas. One that is still in use, e.g. by a web request sent
+        before the switch, is suspended at the next switch or the end of the next conversation.
+        """
+        for context in self.contexts:
+            conversation_manager = context.conversation_manager
+            if context is not self.context and conversation_manager.suspended is None:
+                self.scheduler.run_if_idle(conversation_manager, conversation_manager.suspend)
+
+    def switch_persona(self, name):
+        """
+        :param name: Persona name, in any case.
+        :return: The PersonaContext switched to, or None if no persona of that name is loaded.
+        """
+        for context in self.contexts:
+            if context.name.lower() == name.lower():
+                self.activate(context)
+                return context
+        logging.info(f"No persona named '{name}' is loaded.")
+        return None
+
+    def wake(self, context):
+        """
+        Called when a persona's wake word is detected.
+        """
+        self.activate(context)
+        self.warm_up()
+
+    def run(self, reader):
         while True:
             voice_detected = False
+            encoder = None
             self.light.turn_on()
             self.bt_light.turn_on()
             logging.info("Entering Listening state.")
 
             try:
                 # record query
-                audio_stream = audio.get_audio_stream(self.sound_config['microphone']['rate'])
-                audio_file = initialize_audio_file(self.sound_config['microphone']['rate'])
-                voice_detected = record_query(audio_stream, audio_file, voice_detected,
+                # the recording is compressed for upload while it is being recorded
+                encoder = StreamingEncoder(VOICE_DETECTION_RATE)
+                voice_detected = record_query(reader, encoder, voice_detected,
                                               self.sound_config['microphone']['rate'],
                                               self.sound_config['microphone']['amplification'],
-                                              self.vad)
-                audio_file.close()
+                                              self.vad, self.speculative_stt, self.speech_gate)
 
                 if not voice_detected:
                     logging.info("No speech detected. Exiting state...")
@@ -154,12 +252,13 @@ class Listening(State):
 
                 # begin processing
                 proc_start_time = time.time()
+                self.response_pipeline.cues.play("acknowledge")
                 self.light.begin_pulse()
                 self.bt_light.begin_pulse()
 
                 # transcribe
                 # TODO add this to streaming pipeline
-                question_text = speech_to_text(TRANSCRIPTION_FILE)
+                question_text = self.take_speculative_transcript() or speech_to_text(self.finish_upload(encoder))
                 if not question_text:
                     logging.warning("Unable to convert speech to text...")
                     break
@@ -171,213 +270,73 @@ class Listening(State):
                     break
 
                 # begin pipeline to play response
-                timeout_flag, continue_conversation = self.run_response_pipeline(response, question_text,
-                                                                                 proc_start_time)
+                # the follow-up is recorded from the end of playback, without the echo of the response
+                timeout_flag, continue_conversation = self.run_response_pipeline(
+                    response, question_text, proc_start_time,
+                    on_playback_finished=lambda: reader.clear(keep=FOLLOW_UP_OVERLAP))
 
                 if timeout_flag or not continue_conversation:
-                    return False
-
-                time.sleep(0.5)
+                    return StateEvent.CONVERSATION_ENDED
 
             except Exception as e:
                 logging.error(f"An error occurred: {e}")
                 traceback.print_exc()
-                return False
+                return StateEvent.CONVERSATION_ENDED
 
             finally:
-                try:
-                    os.remove(TRANSCRIPTION_FILE)
-                except OSError:
-                    pass
+                if encoder is not None:
+                    encoder.abort()
+                for extension in ("wav", "flac", "ogg"):
+                    try:
+                        os.remove(f"{TRANSCRIPTION_FILE}.{extension}")
+                    except OSError:
+                        pass
                 self.light.turn_off()
                 self.bt_light.turn_off()
-        time.sleep(0.5)
+                self.suspend_inactive()
+        reader.mark()
         self.light.blink(1)
         self.bt_light.blink(1)
 
-        return True
-
-    def run_response_pipeline(self, response, question_text, proc_start_time):
-        text_queue = queue.Queue(maxsize=50)
-        voice_queue = queue.Queue(maxsize=50)
-        # using a dictionary as a mutable container to share between threads
-        shared_vars = {
-            'timeout_flag': False,
-            'text_received_time': 0.0,
-            'audio_received_time': 0.0,
-            "continue_conversation": True,
-            "stop_playback": False
-        }
-        start_time = time.time()
-
-        # thread functions
-        def enqueue_text():
-            if response is not None:
-                text_queue.put(response)
-                text_queue.put(None)
-            else:  # ask LLM
-                retries = 0
-                while retries < MAX_LLM_RETRIES:
-                    try:
-                        response_generator = self.conversation_manager.get_response(question_text, origin="voice")
-                        for response_chunk in response_generator:
-                            if shared_vars['stop_playback']:
-                                # stop word detected
-                                break
-                            text_queue.put(response_chunk)
-                            if response_chunk is None:
-                                break
-
-                        break  # generator has been fully consumed, so exit the loop
-                    except requests.exceptions.HTTPError as e:
-                        self.web_service.send_new_assistant_msg("<Error processing request>", self.conversation_manager.llm_client.model)
-                        # self.conversation_manager.conversation.pop()  # TODO remove user message (it probably went to the disk)
-                        logging.error(f"Error retrieving response from LLM: {e}")
-                    except InvalidInputError:
-                        self.web_service.send_new_assistant_msg("<Nonsense detected>", self.conversation_manager.llm_client.model)
-                        logging.warning("Nonsense detected!")
-                        shared_vars['continue_conversation'] = False
-                        break
-                    except TimeoutError:
-                        logging.warning(f"LLM timeout. Retrying {MAX_LLM_RETRIES - retries - 1} more times...")
-                        retries += 1
-                    except Exception as e:
-                        logging.error(
-                            f"Unknown error when attempting LLM request - retrying {MAX_LLM_RETRIES - retries - 1} more times: {e}")
-                        traceback.print_exc()
-                        retries += 1
-                    finally:
-                        text_queue.put(None)
-                if retries > MAX_LLM_RETRIES:
-                    shared_vars['timeout_flag'] = True
-
-        def enqueue_audio():
-            def process_tts_sentence(sentence):
-                # sends a given sentence to the tts generator and queues the output to voice_queue
-                # sentence = re.sub(r"^\[.+\] ", '', sentence)  # remove timestamp
-                sentence = conversationmanager.remove_timestamp(sentence)
-                for audio_chunk in self.tts_client.get_audio_generator(sentence):
-                    if shared_vars['stop_playback']:
-                        # Stop word detected
-                        while not text_queue.empty():
-                            text_queue.get()
-                        break
-                    voice_queue.put(audio_chunk)
-
-            if not shared_vars['timeout_flag']:
-                retries = 0
-                first_chunk = True
-                sentence_buffer = ""
-                while retries < MAX_TTS_RETRIES:
-                    try:
-                        if shared_vars['stop_playback']:
-                            break
-                        response_chunk = text_queue.get(timeout=QUEUE_TIMEOUT)
-                        if response_chunk is not None:
-                            if first_chunk:
-                                shared_vars['text_received_time'] = time.time()
-                                logging.info(
-                                    f"First text chunk received ({shared_vars['text_received_time'] - start_time:.2f} seconds)")
-                                first_chunk = False
-                            sentence_buffer += response_chunk  # current sentence
-                        # check if the buffer contains a full sentence to send to the tts queue
-                        match = re.search(r"(^.*[^\s.\d]{2,}[\.\?!\n])(.+)", sentence_buffer)
-                        if match:
-                            full_sentence, trailing_text = match.groups()
-                            process_tts_sentence(full_sentence)
-                            sentence_buffer = trailing_text  # keep the trailing text in buffer
-                        elif response_chunk is None and sentence_buffer:
-                            process_tts_sentence(sentence_buffer)
-                            sentence_buffer = ""  # clear the buffer
-
-                        if response_chunk is None:
-                            break
-                    except TimeoutError:
-                        logging.warning(f"TTS timeout. Retrying {MAX_LLM_RETRIES - retries - 1} more times...")
-                        retries += 1
-                    except queue.Empty:
-                        # check if there was a timeout and, if so, terminate
-                        if shared_vars['timeout_flag']:
-                            break
-                    except Exception as e:
-                        logging.error(f"Unknown error when attempting TTS request: {e}")
-                        retries += 1
-
-                voice_queue.put(None)
-                if retries > MAX_TTS_RETRIES:
-                    shared_vars['timeout_flag'] = True
-            else:
-                logging.warning("Skipping audio enqueue due to LLM timeout.")
-
-        def stream_audio_chunks():
-            first_chunk = True
-            if not shared_vars['timeout_flag']:
-                while True:
-                    if shared_vars['stop_playback']:
-                        # stop word detected
-                        while not voice_queue.empty():
-                            voice_queue.get()
-                        break
-                    try:
-                        audio_chunk = voice_queue.get(timeout=QUEUE_TIMEOUT)
-                        if audio_chunk is None:
-                            break
-                        else:
-                            if first_chunk:
-                                self.light.turn_off()
-                                self.bt_light.turn_off()
-                                shared_vars['audio_received_time'] = time.time()
-                                logging.info(
-                                    f"First audio chunk received ({shared_vars['audio_received_time'] - shared_vars['text_received_time']:.2f} seconds)")
-                                logging.info(
-                                    f"Total time since query: {shared_vars['audio_received_time'] - proc_start_time:.2f} seconds")
-                                first_chunk = False
-                            # TODO move tts rate to tts clients
-                            audio.stream_audio(audio_chunk, self.tts_client.sample_rate,
-                                               self.sound_config['speaker']['rate'],
-                                               volume=self.sound_config['speaker']['volume'],
-                                               device_name=self.sound_config['speaker']['device_name'])
-                    except queue.Empty:
-                        if shared_vars['timeout_flag']:
-                            break
-                    finally:
-                        self.light.turn_off()
-                        self.bt_light.turn_off()
-            else:
-                logging.warning("Skipping audio stream due to timeout.")
-            shared_vars['stop_playback'] = True
-
-        def monitor_stop_word():
-            # TODO get wakeword sensitivities from persona
-            shared_vars['stop_playback'] = audio.wait_for_wake_word(self.persona.stop_words,
-                                                                    self.sound_config['microphone']['rate'],
-                                                                    shared_vars)
-
-        # create threads
-        text_thread = threading.Thread(target=enqueue_text)
-        audio_thread = threading.Thread(target=enqueue_audio)
-        stream_thread = threading.Thread(target=stream_audio_chunks)
-        stop_word_thread = threading.Thread(target=monitor_stop_word)
-
-        # set threads to terminate with main program
-        audio_thread.daemon = True
-        text_thread.daemon = True
-        stream_thread.daemon = True
-        stop_word_thread.daemon = True
-
-        # start threads
-        text_thread.start()
-        audio_thread.start()
-        stream_thread.start()
-        stop_word_thread.start()
-
-        # wait for threads to finish
-        text_thread.join()
-        audio_thread.join()
-        stream_thread.join()
-        stop_word_thread.join()
-
-        return shared_vars['timeout_flag'], shared_vars['continue_conversation']
+        return StateEvent.CONVERSATION_ENDED
+
+    def warm_up(self):
+        """
+        Opens the STT, LLM and TTS connections in parallel while the user is still speaking so the requests that
+        follow the recording reuse them.
+        """
+        warm_up_in_background({
+            "STT": audio.warm_up_stt,
+            "speculative STT": self.speculative_stt.warm_up,
+            "LLM": self.conversation_manager.llm_client.warm_up,
+            "TTS": self.tts_client.warm_up,
+        })
+
+    @staticmethod
+    def finish_upload(encoder):
+        """
+        :return: Path of the recording, encoded for upload.
+        """
+        file_path = encoder.finish(TRANSCRIPTION_FILE)
+        size = os.path.getsize(file_path)
+        logging.info(f"Uploading {size / 1024:.0f} KiB ({size / max(1, len(encoder.pcm()) * 2):.0%} of the PCM), "
+                     f"encoder used {encoder.cpu_time * 1000:.0f} ms CPU and took {encoder.finish_time * 1000:.0f} ms "
+                     f"to finish")
+        return file_path
+
+    def take_speculative_transcript(self):
+        question_text = self.speculative_stt.take(timeout=audio.STT_TIMEOUT)
+        stats = self.speculative_stt.stats()
+        logging.info(f"Speculative STT: {stats['win_rate']:.0%} used, {stats['waste_rate']:.0%} cancelled of "
+                     f"{stats['started']}, {stats['saved_time']:.1f} s of STT off the critical path")
+        if question_text:
+            question_text = question_text.strip('\n')
+            logging.info(f"I heard '{question_text}'")
+        return question_text
+
+    def run_response_pipeline(self, response, question_text, proc_start_time, on_playback_finished=None):
+        return self.response_pipeline.run_turn(response, question_text, proc_start_time,
+                                               on_playback_finished=on_playback_finished)
 
     def preprocess_text(self, question_text):
         logging.info("Preprocessing query...")
@@ -395,5 +354,11 @@ class Listening(State):
             response = "Done."
             logging.info(f"Setting volume to {float(question_text) * 100}%.")
             self.sound_config['speaker']['volume'] = question_text
+        elif action == Action.SWITCH_PERSONA:
+            context = self.switch_persona(question_text)
+            if context is None:
+                action = Action.CONTINUE  # not a persona, let the LLM answer
+            else:
+                response = context.persona.greeting
 
         return action, response
@@ -4,5 +4,9 @@ from abc import ABC, abstractmethod
 class State(ABC):
 
     @abstractmethod
-    def run(self):
+    def run(self, reader):
+        """
+        :param reader: CaptureReader handed on by the previous state, positioned where that state stopped reading.
+        :return: The StateEvent that ended the state.
+        """
         pass
@@ -0,0 +1,54 @@
+import importlib
+import sys
+
+import pytest
+
+import conversationmanager
+from benchmarks import bench_hot_paths
+from benchmarks.harness import SkipBenchmark, get_benchmarks
+
+# (module, command line, module constants) that run each benchmark script in a few seconds
+SCRIPTS = [
+    ("bench_devices", [], {"CHUNKS": 5}),
+    ("bench_gemini_chat", ["--turns", "2"], {}),
+    ("bench_hedging", [], {"REQUESTS_PER_SCENARIO": 1}),
+    ("bench_local_session", ["--turns", "3"], {}),
+    ("bench_message_memory", ["100"], {}),
+    ("bench_prompt_timestamps", [], {"SYNTHETIC_SESSIONS": 2}),
+    ("bench_scheduler", [], {"CHUNKS": 2, "RESPONSE_TIME": 0.01, "WEB_BACKLOG": 1, "BURST": 3,
+                             "OVERHEAD_CHUNKS": 100}),
+    ("bench_speculative_stt", ["--latency", "0.05"], {"QUERIES": [[(0.3, None)]]}),
+    ("bench_stt_upload", ["--seconds", "1"], {}),
+    ("bench_warmup", ["--connect-delay", "0.01"], {"TURNS": 1}),
+    ("bench_web_connect", [], {"HISTORY_SIZES": (20,), "ON_DISK_MESSAGES": 50}),
+    ("bench_web_stream", [], {"FAST_CLIENTS": 1, "CHUNKS": 10, "SLOW_RTT": 0.02}),
+]
+
+
+@pytest.fixture
+def restore_tokenizer(monkeypatch):
+    # the benchmarks may replace the tokenizer offline, see bench_hot_paths._require_tokenizer()
+    monkeypatch.setattr(conversationmanager, "encoding_for_model", conversationmanager.encoding_for_model)
+    monkeypatch.setattr(bench_hot_paths, "_tokenizer", None)
+
+
+@pytest.mark.parametrize("bench", get_benchmarks(), ids=lambda bench: bench['name'])
+def test_hot_path_benchmark_runs(bench, restore_tokenizer):
+    try:
+        run = bench['setup']()
+    except (SkipBenchmark, ImportError) as e:
+        pytest.skip(f"{type(e).__name__}: {e}")
+    run()
+
+
+@pytest.mark.parametrize("module, argv, constants", SCRIPTS, ids=[script[0] for script in SCRIPTS])
+def test_benchmark_script_runs(module, argv, constants, monkeypatch, restore_tokenizer):
+    try:
+        bench = importlib.import_module(f"benchmarks.{module}")
+    except ImportError as e:
+        pytest.skip(f"{type(e).__name__}: {e}")
+    for name, value in constants.items():
+        assert hasattr(bench, name), f"{module} has no {name}"
+        monkeypatch.setattr(bench, name, value)
+    monkeypatch.setattr(sys, "argv", [module] + argv)
+    bench.main()
@@ -0,0 +1,87 @@
+import pytest
+
+from conversation_history import CHUNK_SIZE, ConversationHistory
+
+
+def filled(count):
+    history = ConversationHistory()
+    for i in range(count):
+        history.append(i)
+    return history
+
+
+def test_snapshot_ignores_later_appends():
+    history = filled(CHUNK_SIZE - 1)
+    snapshot = history.snapshot()
+    # the first append fills the shared chunk, the rest start new ones
+    for i in range(CHUNK_SIZE - 1, 3 * CHUNK_SIZE):
+        history.append(i)
+
+    assert len(snapshot) == CHUNK_SIZE - 1
+    assert list(snapshot) == list(range(CHUNK_SIZE - 1))
+    assert snapshot[-1] == CHUNK_SIZE - 2
+    assert list(history.snapshot()) == list(range(3 * CHUNK_SIZE))
+
+
+def test_snapshot_ignores_pruning():
+    history = filled(4 * CHUNK_SIZE)
+    snapshot = history.snapshot()
+    # enough to release pruned chunks from the directory
+    for _ in range(3 * CHUNK_SIZE + 5):
+        history.popleft()
+    history.append("new")
+
+    assert list(snapshot) == list(range(4 * CHUNK_SIZE))
+    assert snapshot[0] == 0 and snapshot[-1] == 4 * CHUNK_SIZE - 1
+    assert list(reversed(snapshot)) == list(reversed(range(4 * CHUNK_SIZE)))
+    assert list(history.snapshot()) == list(range(3 * CHUNK_SIZE + 5, 4 * CHUNK_SIZE)) + ["new"]
+
+
+def test_snapshot_ignores_pop_and_replacement():
+    history = filled(CHUNK_SIZE + 3)
+    snapshot = history.snapshot()
+    assert history.pop() == CHUNK_SIZE + 2
+    history.append("replacement")
+
+    assert snapshot[-1] == CHUNK_SIZE + 2
+    assert list(snapshot)[-2:] == [CHUNK_SIZE + 1, CHUNK_SIZE + 2]
+    assert history.snapshot()[-1] == "replacement"
+
+
+def test_pop_across_a_chunk_boundary():
+    history = filled(CHUNK_SIZE + 1)
+    snapshot = history.snapshot()
+    assert history.pop() == CHUNK_SIZE
+    history.append("replacement")
+    history.append("next")
+
+    assert list(snapshot) == list(range(CHUNK_SIZE + 1))
+    assert list(history.snapshot())[-3:] == [CHUNK_SIZE - 1, "replacement", "next"]
+
+
+def test_snapshot_slicing_and_indexing():
+    history = filled(2 * CHUNK_SIZE)
+    history.popleft()
+    snapshot = history.snapshot()
+
+    assert snapshot[:3] == [1, 2, 3]
+    assert snapshot[-2:] == [2 * CHUNK_SIZE - 2, 2 * CHUNK_SIZE - 1]
+    with pytest.raises(IndexError):
+        snapshot[len(snapshot)]
+
+
+def test_every_change_bumps_the_version():
+    history = filled(3)
+    versions = [history.snapshot().version]
+    for change in (lambda: history.append(3), history.popleft, history.pop):
+        change()
+        versions.append(history.snapshot().version)
+    assert versions == sorted(set(versions))
+
+
+def test_pop_from_empty_history():
+    history = ConversationHistory()
+    with pytest.raises(IndexError):
+        history.pop()
+    with pytest.raises(IndexError):
+        history.popleft()
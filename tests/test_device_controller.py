@@ -0,0 +1,67 @@
+import threading
+import time
+
+from devices.controller import DeviceController
+from enums.light_state_enum import LightState
+
+
+class RecordingDriver:
+    step_interval = 0.02
+
+    def __init__(self):
+        self.applied = []  # (time.perf_counter(), state)
+        self.steps = 0
+        self.changed = threading.Condition()
+
+    def apply(self, state):
+        with self.changed:
+            self.applied.append((time.perf_counter(), state))
+            self.changed.notify_all()
+
+    def step(self):
+        self.steps += 1
+
+    def wait_for(self, state, timeout=2):
+        with self.changed:
+            self.changed.wait_for(lambda: self.applied and self.applied[-1][1] == state, timeout)
+        return self.applied[-1][1] == state
+
+
+def states(driver):
+    return [state for _, state in driver.applied]
+
+
+def test_state_change_stops_a_blink():
+    driver = RecordingDriver()
+    controller = DeviceController("test", driver)
+    controller.blink(5, pause=0.5)
+    assert driver.wait_for(LightState.ON)
+
+    start = time.perf_counter()
+    controller.set_state(LightState.PULSE)
+    assert driver.wait_for(LightState.PULSE)
+    assert driver.applied[-1][0] - start < 0.25
+    time.sleep(0.6)
+    # the rest of the blink was dropped and the light pulses
+    assert states(driver) == [LightState.ON, LightState.PULSE]
+    assert driver.steps > 0
+
+
+def test_turning_off_stops_a_blink():
+    driver = RecordingDriver()
+    controller = DeviceController("test", driver)
+    controller.blink(3, pause=0.5)
+    assert driver.wait_for(LightState.ON)
+    controller.set_state(LightState.OFF)
+    assert driver.wait_for(LightState.OFF, timeout=0.25)
+    time.sleep(0.6)
+    assert states(driver) == [LightState.ON, LightState.OFF]
+
+
+def test_blinks_run_one_after_the_other():
+    driver = RecordingDriver()
+    controller = DeviceController("test", driver)
+    controller.blink(1, pause=0.01)
+    controller.blink(2, pause=0.01)
+    time.sleep(0.3)
+    assert states(driver) == [LightState.ON, LightState.OFF] * 3
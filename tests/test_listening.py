@@ -0,0 +1,137 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+MIC_RATE = 16000
+WAKE_WORD_TAIL = 0.3  # seconds, as rewound by wait_for_wake_word()
+
+
+class ReplayingReader:
+    """
+    Stands in for a CaptureReader that was rewound into the end of the wake word.
+    """
+
+    def __init__(self, samples, replayed_seconds):
+        self.samples = samples
+        self.position = 0
+        self.replayed_samples = int(replayed_seconds * MIC_RATE)
+
+    def read(self, samples, timeout=None):
+        if self.position + samples > len(self.samples):
+            # silence once the script is over
+            self.samples = np.concatenate((self.samples, np.zeros(samples, dtype=np.int16)))
+        data = self.samples[self.position:self.position + samples]
+        self.position += samples
+        return data
+
+    def dead_time(self):
+        return None
+
+    def replayed(self):
+        return max(0, self.replayed_samples - self.position)
+
+
+class LevelVad:
+    """
+    Any frame that isn't silent is voice.
+    """
+    frame_length = 512
+
+    def process(self, frame):
+        return 1.0 if np.abs(frame).max() > 0 else 0.0
+
+
+class Recorder:
+    """
+    Stands in for the StreamingEncoder.
+    """
+
+    def __init__(self):
+        self.samples = 0
+
+    def write(self, data):
+        self.samples += len(data)
+
+    def extend_to(self, samples):
+        pass
+
+    def skip_to(self, samples):
+        pass
+
+
+def script(*parts):
+    """
+    :param parts: (seconds, voiced) pairs.
+    """
+    return np.concatenate([np.full(int(seconds * MIC_RATE), 1000 if voiced else 0, dtype=np.int16)
+                           for seconds, voiced in parts])
+
+
+@pytest.fixture
+def record_query():
+    pytest.importorskip("pyaudio")
+    from states.listening import record_query
+    return lambda reader, encoder: record_query(reader, encoder, False, MIC_RATE, 1, LevelVad())
+
+
+def test_pause_after_the_wake_word(record_query):
+    # "Natalie ... what's the weather like?": the query starts after a pause longer than ENDING_PAUSE_TIME
+    reader = ReplayingReader(script((WAKE_WORD_TAIL, True), (1.5, False), (1.0, True)), WAKE_WORD_TAIL)
+    encoder = Recorder()
+
+    assert record_query(reader, encoder)
+    # the query was recorded in full, not cut off a second after the wake word
+    assert encoder.samples >= (WAKE_WORD_TAIL + 1.5 + 1.0) * MIC_RATE
+
+
+def test_wake_word_alone_is_not_a_query(record_query):
+    reader = ReplayingReader(script((WAKE_WORD_TAIL, True)), WAKE_WORD_TAIL)
+    assert not record_query(reader, Recorder())
+
+
+def test_query_right_after_the_wake_word(record_query):
+    reader = ReplayingReader(script((WAKE_WORD_TAIL, True), (1.0, True)), WAKE_WORD_TAIL)
+    encoder = Recorder()
+
+    assert record_query(reader, encoder)
+    # stopped after ENDING_PAUSE_TIME, not INITIAL_PAUSE_TIME
+    assert encoder.samples < (WAKE_WORD_TAIL + 1.0 + 2) * MIC_RATE
+
+
+class CountingStream:
+    """
+    Microphone whose samples count up, so a sample's value is its capture index. Goes quiet after the given number
+    of samples.
+    """
+
+    def __init__(self, samples):
+        self.next = 0
+        self.samples = samples
+
+    def read(self, frames, exception_on_overflow=True):
+        if self.next >= self.samples:
+            # the capture thread is a daemon, so it can block here until the tests exit
+            threading.Event().wait()
+        data = np.arange(self.next, self.next + frames, dtype=np.int16)
+        self.next += frames
+        return data.tobytes()
+
+
+def test_clear_keeps_the_end_of_playback():
+    pytest.importorskip("pyaudio")
+    from utils.audio import FRAMES_PER_BUFFER, AudioCapture
+
+    capture = AudioCapture(MIC_RATE, stream=CountingStream(40 * FRAMES_PER_BUFFER))
+    reader = capture.open_reader()
+    deadline = time.perf_counter() + 5
+    while capture.captured < 40 * FRAMES_PER_BUFFER and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    reader.clear(keep=0.5)
+    kept = int(0.5 * MIC_RATE)
+    assert reader.replayed() == kept
+    assert reader.read(kept, timeout=1)[0] == 40 * FRAMES_PER_BUFFER - kept
+    assert reader.replayed() == 0
+    reader.close()
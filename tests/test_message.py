@@ -0,0 +1,227 @@
+import pickle
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import conversationmanager
+from conversation_history import ConversationHistory
+from conversationmanager import ConversationManager
+from enums.role_enum import Role
+from message import Message
+
+# messages as older versions stored them: one pickled dictionary each, with the timestamp baked into user messages
+BASELINE_MESSAGES = [
+    {"role": Role.USER, "content": "[October 17, 2026 3:04:05PM] What's the weather like?", "origin": "voice",
+     "timestamp": 1792249445.5},
+    {"role": Role.ASSISTANT, "content": "Sunny all day.", "origin": "gpt-4-1106-preview", "timestamp": 1792249447},
+    {"role": Role.USER, "content": "[October 17, 2026 3:05:00PM] Thanks!", "origin": "web", "timestamp": 1792249500.0},
+    {"role": Role.ASSISTANT, "content": "You're welcome.", "origin": "gpt-4-1106-preview", "timestamp": None},
+]
+
+
+def count_words(text, model=None):
+    return len(text.split())
+
+
+@pytest.fixture
+def baseline_file(tmp_path):
+    path = tmp_path / "Natalie.pkl"
+    with open(path, "wb") as f:
+        for message in BASELINE_MESSAGES:
+            pickle.dump(message, f)
+    return path
+
+
+def read_all(path):
+    messages = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                messages.append(pickle.load(f))
+            except EOFError:
+                return messages
+
+
+def conversation_manager(pkl_file, monkeypatch):
+    # tiktoken needs to download its encodings, so tokens are counted as words
+    monkeypatch.setattr(conversationmanager, "count_tokens", count_words)
+    manager = ConversationManager.__new__(ConversationManager)
+    manager.persona = SimpleNamespace(name="Natalie")
+    manager.llm_client = SimpleNamespace(model="gpt-4-1106-preview", token_model="gpt-4-1106-preview",
+                                         max_context_tokens=4096, max_response_tokens=256,
+                                         release_caches=lambda: None)
+    manager.system_msg = {"role": Role.SYSTEM, "content": "Be brief."}
+    manager.total_tokens = count_words(manager.system_msg["content"])
+    manager.pkl_file = str(pkl_file)
+    manager._history = ConversationHistory()
+    manager.suspended = None
+    manager.suspend_lock = threading.Lock()
+    manager.history_offsets = []
+    manager.prompt_history = None
+    manager.last_reply = None
+    return manager
+
+
+def test_from_baseline_dict(baseline_file):
+    for stored, expected in zip(read_all(baseline_file), BASELINE_MESSAGES):
+        message = Message.from_dict(stored)
+        assert message.role is expected["role"]
+        assert message == expected
+        assert dict(message) == expected
+        assert isinstance(message.timestamp, float) or message.timestamp is None
+
+
+def test_from_dict_without_origin_or_timestamp():
+    message = Message.from_dict({"role": Role.USER, "content": "Hi"})
+    assert message["origin"] is None and message["timestamp"] is None
+    with pytest.raises(KeyError):
+        message["tokens"]
+
+
+def test_pickle_round_trip():
+    message = Message(Role.ASSISTANT, "Sunny all day.", origin="gpt-4-1106-preview", timestamp=1792249447)
+    message.tokens("gpt-4-1106-preview", count_words)
+    loaded = pickle.loads(pickle.dumps(message))
+
+    assert isinstance(loaded, Message)
+    assert loaded == message
+    assert loaded.role is Role.ASSISTANT
+    # the token count isn't pickled; a record keeps it
+    assert loaded._token_count is None
+    assert Message.restore(message.record())._token_count == 3
+
+
+def test_load_baseline_file(baseline_file, monkeypatch):
+    manager = conversation_manager(baseline_file, monkeypatch)
+    manager.load_conversation()
+
+    conversation = list(manager.conversation)
+    assert all(isinstance(message, Message) for message in conversation)
+    assert [message["content"] for message in conversation] == [
+        "What's the weather like?", "Sunny all day.", "Thanks!", "You're welcome."]
+    assert [message["origin"] for message in conversation] == [m["origin"] for m in BASELINE_MESSAGES]
+    assert conversation[0]["timestamp"] == 1792249445.5
+    assert manager.history_offsets[0] == 0 and len(manager.history_offsets) == len(BASELINE_MESSAGES)
+    assert manager.total_tokens == manager.get_total_token_count()
+
+
+class RoleOnlyUnpickler(pickle.Unpickler):
+    """
+    Loads what an older build could: the only class a history file may refer to is Role.
+    """
+
+    def find_class(self, module, name):
+        if (module, name) != ("enums.role_enum", "Role"):
+            raise pickle.UnpicklingError(f"{module}.{name} is not available")
+        return Role
+
+
+def read_as_older_build(path):
+    messages = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                messages.append(RoleOnlyUnpickler(f).load())
+            except EOFError:
+                return messages
+
+
+def test_new_messages_are_stored_in_the_baseline_format(baseline_file, monkeypatch):
+    manager = conversation_manager(baseline_file, monkeypatch)
+    manager.load_conversation()
+    manager.append_message(Role.USER, "And tomorrow?", origin="voice", to_disk=True)
+    manager.append_message(Role.ASSISTANT, "Rain.", origin="gpt-4-1106-preview", to_disk=True)
+
+    stored = read_as_older_build(baseline_file)
+    assert all(type(message) is dict for message in stored)
+    assert stored[-1] == {"role": Role.ASSISTANT, "content": "Rain.", "origin": "gpt-4-1106-preview",
+                          "timestamp": manager.conversation[-1]["timestamp"]}
+    assert all(isinstance(message, Message) for message in manager.load_history(0, manager.history_length()))
+
+    # removing the last message rewrites the file in the same format
+    manager.pop_message()
+    assert read_as_older_build(baseline_file) == stored[:-1]
+
+
+def test_load_file_with_pickled_message_objects(tmp_path, monkeypatch):
+    # for a while, new messages were stored as pickled Message objects
+    path = tmp_path / "Natalie.pkl"
+    with open(path, "wb") as f:
+        for message in BASELINE_MESSAGES:
+            pickle.dump(Message.from_dict(message), f)
+    manager = conversation_manager(path, monkeypatch)
+    manager.load_conversation()
+    assert [message["content"] for message in manager.conversation][-1] == "You're welcome."
+
+
+def test_baseline_file_stays_readable_after_new_messages(baseline_file, monkeypatch):
+    manager = conversation_manager(baseline_file, monkeypatch)
+    manager.load_conversation()
+    manager.append_message(Role.USER, "And tomorrow?", origin="voice", to_disk=True)
+    manager.append_message(Role.ASSISTANT, "Rain.", origin="gpt-4-1106-preview", to_disk=True)
+
+    reloaded = conversation_manager(baseline_file, monkeypatch)
+    reloaded.load_conversation()
+    assert [message["content"] for message in reloaded.conversation][-3:] == ["You're welcome.", "And tomorrow?",
+                                                                              "Rain."]
+
+
+class ScriptedLlm:
+    """
+    Streams a fixed list of chunks.
+    """
+    model = "gpt-4-1106-preview"
+    token_model = "gpt-4-1106-preview"
+    max_context_tokens = 4096
+    max_response_tokens = 256
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def new_request(self):
+        return SimpleNamespace(cancelled=False)
+
+    def response_generator(self, messages, token=None):
+        yield from self.chunks
+
+    def release_caches(self):
+        pass
+
+
+def answered_manager(tmp_path, monkeypatch, tag):
+    manager = conversation_manager(tmp_path / "Natalie.pkl", monkeypatch)
+    manager.llm_client = ScriptedLlm(["It will ", "be sunny ", "all day."])
+    manager.web_service = SimpleNamespace(send_new_user_msg=lambda *args: None,
+                                          send_new_assistant_msg=lambda *args: None,
+                                          append_assistant_msg=lambda *args: None)
+    list(manager.get_response("What's the weather like?", origin="voice", tag=tag))
+    return manager
+
+
+def test_interrupted_response_replaces_the_full_reply_of_its_turn(tmp_path, monkeypatch):
+    # the whole response arrived before the stop word, so it was already stored
+    turn = object()
+    manager = answered_manager(tmp_path, monkeypatch, turn)
+    manager.append_interrupted_response("It will be", tag=turn)
+
+    assert [message["content"] for message in manager.conversation][-2:] == ["What's the weather like?",
+                                                                             "It will be..."]
+    assert manager.total_tokens == manager.get_total_token_count()
+    assert [message["content"] for message in read_all(manager.pkl_file)][-1] == "It will be..."
+
+
+def test_interrupted_response_keeps_a_reply_of_another_turn(tmp_path, monkeypatch):
+    manager = answered_manager(tmp_path, monkeypatch, "web")
+    manager.append_interrupted_response("Hello", tag=object())
+    assert [message["content"] for message in manager.conversation][-2:] == ["It will be sunny all day.",
+                                                                             "Hello..."]
+
+
+def test_interrupted_response_keeps_a_reply_that_is_no_longer_last(tmp_path, monkeypatch):
+    turn = object()
+    manager = answered_manager(tmp_path, monkeypatch, turn)
+    manager.append_message(Role.USER, "Thanks!", origin="web")
+    manager.append_interrupted_response("It will be", tag=turn)
+    assert [message["content"] for message in manager.conversation][-3:] == ["It will be sunny all day.", "Thanks!",
+                                                                             "It will be..."]
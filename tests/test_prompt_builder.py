@@ -0,0 +1,122 @@
+import random
+
+from clients.llm.local_llm import serialize_message
+from clients.llm.prompt_builder import PromptBuilder
+from conversationmanager import RenderedHistory, render_message, timestamp_header
+from enums.role_enum import Role
+from message import Message
+
+SYSTEM_MSG = {"role": Role.SYSTEM, "content": "Be brief."}
+DAY = 24 * 3600
+
+
+def new_message(rng, i, timestamp):
+    role = Role.USER if rng.random() < 0.55 else Role.ASSISTANT
+    return Message(role, f"message {i}", origin="test", timestamp=timestamp)
+
+
+def render_all(messages):
+    """
+    Renders a conversation from scratch, the way every prompt used to be built.
+    """
+    rendered = []
+    anchored = False
+    for i, message in enumerate(messages):
+        rendered.append(render_message(message, messages[i - 1] if i else None, anchored))
+        anchored = anchored or message['role'] == Role.USER
+    return rendered
+
+
+def contents(messages):
+    return [message['content'] for message in messages]
+
+
+def test_rendered_history_matches_a_full_render():
+    rng = random.Random(3)
+    messages = []
+    history = RenderedHistory()
+    timestamp = 1792249445.0
+    for i in range(2000):
+        change = rng.random()
+        if change < 0.6 or not messages:
+            # pauses of up to a few days, so some messages get headers
+            timestamp += rng.choice((10, 60, 45 * 60, 3 * 3600, DAY))
+            message = new_message(rng, i, timestamp)
+            messages.append(message)
+            history.append(message)
+        elif change < 0.8:
+            messages.pop()
+            history.pop()
+        else:
+            messages.pop(0)
+            history.popleft()
+        assert contents(history.rendered) == contents(render_all(messages))
+
+
+def test_first_user_message_gets_the_full_date_after_pruning():
+    first = Message(Role.USER, "Hi", timestamp=1792249445.0)
+    second = Message(Role.USER, "Still there?", timestamp=1792249445.0 + 3 * 3600)
+    history = RenderedHistory([first, second])
+    assert history.rendered[1]['content'] == "[3 hours later] Still there?"
+
+    history.popleft()
+    assert history.rendered[0]['content'] == f"{timestamp_header(second['timestamp'])} Still there?"
+    assert history.prompt(SYSTEM_MSG).start == 1
+
+
+def test_incremental_build_matches_a_full_conversion():
+    rng = random.Random(7)
+    messages = []
+    history = RenderedHistory()
+    builder = PromptBuilder(serialize_message)
+    timestamp = 1792249445.0
+    for i in range(1000):
+        change = rng.random()
+        if change < 0.6 or not messages:
+            timestamp += rng.choice((10, 45 * 60, DAY))
+            message = new_message(rng, i, timestamp)
+            messages.append(message)
+            history.append(message)
+        elif change < 0.8:
+            messages.pop()
+            history.pop()
+        else:
+            messages.pop(0)
+            history.popleft()
+        prompt = history.prompt(SYSTEM_MSG)
+        bump = rng.random() < 0.5
+        built = builder.build(prompt, bump=bump)
+
+        expected = [serialize_message(message) for message in prompt]
+        if bump and len(prompt) > 5:
+            position = -3 if prompt[-4]["role"] == Role.ASSISTANT else -4
+            expected = expected[1:position] + expected[:1] + expected[position:]
+        assert built == expected
+
+
+def test_only_new_messages_are_converted():
+    history = RenderedHistory(Message(Role.USER if i % 2 == 0 else Role.ASSISTANT, f"message {i}", timestamp=i)
+                              for i in range(500))
+    builder = PromptBuilder(serialize_message)
+    builder.build(history.prompt(SYSTEM_MSG))
+    assert builder.converted_count == 501
+
+    history.append(Message(Role.USER, "one more", timestamp=600))
+    builder.build(history.prompt(SYSTEM_MSG))
+    assert builder.converted_count == 1
+    assert builder.unchanged_prefix == 501
+
+    # pruning keeps the conversions, but only the system message is where it was
+    history.popleft()
+    builder.build(history.prompt(SYSTEM_MSG))
+    assert builder.converted_count == 1  # the new first user message, which now has the full date
+    assert builder.unchanged_prefix == 1
+
+
+def test_unrelated_list_reuses_conversions_by_identity():
+    messages = [SYSTEM_MSG] + [Message(Role.USER, f"message {i}") for i in range(10)]
+    builder = PromptBuilder(serialize_message)
+    builder.build(messages)
+    assert builder.build(messages[:5] + messages[6:]) == [serialize_message(m) for m in messages[:5] + messages[6:]]
+    assert builder.converted_count == 0
+    assert builder.unchanged_prefix == 5
@@ -0,0 +1,63 @@
+import json
+import time
+from types import SimpleNamespace
+
+from clients.llm import router
+from clients.llm.router import RoutedLlm, TokenUsage
+
+
+def count_words(text, model=None):
+    return len(text.split())
+
+
+def route(model):
+    return SimpleNamespace(model=model, token_model=model, max_context_tokens=4096, max_response_tokens=256)
+
+
+def routed_llm(tmp_path, **kwargs):
+    usage = TokenUsage(str(tmp_path / "llm_usage.json"))
+    return RoutedLlm(SimpleNamespace(name="Natalie"), {"fast": route("fast-model"), "capable": route("capable-model")},
+                     count_tokens=count_words, usage=usage, **kwargs)
+
+
+def test_slow_capable_route_is_probed_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(router, "SAVE_DELAY", 60)
+    llm = routed_llm(tmp_path, ttft_target=1.5, ttft_probe_interval=300)
+    llm.usage.record("capable-model", 100, ttft=4.0)
+    question = "What is the tallest mountain in Europe?"
+    assert llm.choose_route(question)[0] == "fast"
+
+    # once the last measurement is old enough, one question goes to the capable route
+    llm.usage.ttft_time["capable-model"] -= 301
+    route_name, decision = llm.choose_route(question)
+    assert route_name == "capable" and decision['reason'].startswith("probing")
+    assert llm.choose_route(question)[0] == "fast"
+
+    # the probe was fast, so questions go to the capable route again
+    for _ in range(10):
+        llm.usage.record("capable-model", 100, ttft=0.5)
+    assert llm.choose_route(question)[0] == "capable"
+
+
+def test_usage_is_written_once_per_delay(tmp_path, monkeypatch):
+    monkeypatch.setattr(router, "SAVE_DELAY", 0.2)
+    usage = TokenUsage(str(tmp_path / "llm_usage.json"))
+    for _ in range(5):
+        usage.record("capable-model", 100, ttft=1.0)
+    assert not (tmp_path / "llm_usage.json").exists()
+
+    time.sleep(0.5)
+    with open(tmp_path / "llm_usage.json") as f:
+        data = json.load(f)
+    assert len(data['usage']['capable-model']) == 5
+    assert TokenUsage(str(tmp_path / "llm_usage.json")).ttft_time["capable-model"] == data['ttft_time'][
+        'capable-model']
+
+
+def test_flush_writes_a_pending_update(tmp_path, monkeypatch):
+    monkeypatch.setattr(router, "SAVE_DELAY", 60)
+    usage = TokenUsage(str(tmp_path / "llm_usage.json"))
+    usage.record("fast-model", 42)
+    usage.flush()
+    assert usage.save_timer is None
+    assert TokenUsage(str(tmp_path / "llm_usage.json")).used("fast-model") == 42
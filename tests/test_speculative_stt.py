@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from clients.cancellable import CancellableClient
+from clients.stt.openai_stt import OpenAiStt
+
+UPLOAD_SIZE = 8 * 1024 * 1024  # bytes; more than the socket buffers hold, so the upload takes a while
+READ_BLOCK = 16384
+READ_DELAY = 0.01  # seconds between the blocks the server reads, ~1.6 MB/s
+
+
+class SlowUplinkServer:
+    """
+    Transcription endpoint behind a slow uplink: the request body is read in small blocks.
+    """
+
+    def __init__(self):
+        self.received = []  # bytes of the body received per request
+        self.finished = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                remaining = int(self.headers.get("Content-Length", 0))
+                received = 0
+                while remaining:
+                    block = self.rfile.read(min(READ_BLOCK, remaining))
+                    if not block:
+                        break
+                    received += len(block)
+                    remaining -= len(block)
+                    time.sleep(READ_DELAY)
+                server.received.append(received)
+                server.finished.set()
+                if not remaining:
+                    self.send_response(200)
+                    self.send_header("Content-Length", "5")
+                    self.end_headers()
+                    self.wfile.write(b"hello")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = SlowUplinkServer()
+    yield server
+    server.stop()
+
+
+def recording(tmp_path, size):
+    path = tmp_path / "recording.wav"
+    path.write_bytes(bytes(size))
+    return str(path)
+
+
+def test_transcribe(server, tmp_path):
+    file_path = recording(tmp_path, 1000)
+    assert OpenAiStt(url=server.url).transcribe(file_path) == "hello"
+    assert not (tmp_path / "recording.wav").exists()
+
+
+def test_cancel_before_the_request_starts(server, tmp_path):
+    client = OpenAiStt(url=server.url)
+    token = client.new_request()
+    client.cancel(token)
+    assert client.transcribe(recording(tmp_path, 1000), token=token) is None
+    assert not server.received
+
+
+def test_cancel_stops_the_upload(server, tmp_path):
+    client = OpenAiStt(url=server.url)
+    token = client.new_request()
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        client.transcribe(recording(tmp_path, UPLOAD_SIZE), token=token)))
+    thread.start()
+    time.sleep(0.3)
+    start_time = time.perf_counter()
+    client.cancel(token)
+    thread.join(2)
+
+    assert not thread.is_alive() and result == [None]
+    assert time.perf_counter() - start_time < 1
+    assert server.finished.wait(2)
+    assert server.received[0] < UPLOAD_SIZE / 2
+
+
+class BlockingStt(CancellableClient):
+    """
+    Stands in for OpenAiStt: each request waits until it is cancelled or released.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.tokens = []
+
+    def transcribe(self, file_path, token=None):
+        token = self._begin_request(token)
+        os.remove(file_path)
+        self.tokens.append(token)
+        while not token.cancelled:
+            if self.release.wait(0.01):
+                return "what time is it"
+        return None
+
+
+@pytest.fixture
+def speculative_stt(tmp_path, monkeypatch):
+    pytest.importorskip("pyaudio")
+    monkeypatch.chdir(tmp_path)  # speculations are encoded to files in the working directory
+    from utils.speculative_stt import SpeculativeStt
+
+    return SpeculativeStt(BlockingStt())
+
+
+def wait_for_request(stt_client, count):
+    deadline = time.perf_counter() + 5
+    while len(stt_client.tokens) < count and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return stt_client.tokens[count - 1]
+
+
+def test_speculation_cancelled_when_the_speaker_goes_on(speculative_stt):
+    samples = np.zeros(1600, dtype=np.int16)
+    speculative_stt.start([samples], 16000)
+    token = wait_for_request(speculative_stt.stt_client, 1)
+    speculative_stt.cancel()
+
+    assert token.cancelled
+    assert not speculative_stt.pending()
+    assert speculative_stt.stats()["wasted"] == 1
+
+
+def test_new_speculation_cancels_the_previous_one(speculative_stt):
+    samples = np.zeros(1600, dtype=np.int16)
+    speculative_stt.start([samples], 16000)
+    first = wait_for_request(speculative_stt.stt_client, 1)
+    speculative_stt.start([samples, samples], 16000)
+    second = wait_for_request(speculative_stt.stt_client, 2)
+    speculative_stt.stt_client.release.set()
+
+    assert first.cancelled and not second.cancelled
+    assert speculative_stt.take(timeout=5) == "what time is it"
+    assert speculative_stt.stats()["won"] == 1
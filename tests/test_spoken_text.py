@@ -0,0 +1,83 @@
+import io
+import json
+from types import SimpleNamespace
+
+from pipeline.messages import Sentence, Turn
+from pipeline.segmenter import spoken_text, truncate_to_marks, truncate_to_played
+
+RATE = 16000
+TEXT = "The tallest mountain in Europe is Mount Elbrus."
+# (seconds, offset after the word) of every word in TEXT, as PollyTTS.word_marks() returns them
+MARKS = [(0.0, 3), (0.15, 11), (0.6, 20), (0.75, 23), (0.95, 30), (1.45, 33), (1.55, 39), (1.8, 47)]
+
+
+def sentences(*texts):
+    turn = Turn(question_text="")
+    return [Sentence(turn, text, index) for index, text in enumerate(texts)]
+
+
+def test_truncate_to_played_cuts_at_a_word_boundary():
+    # 45% of the audio ends in the middle of "in"
+    assert truncate_to_played(TEXT, 45, 100) == "The tallest mountain"
+    assert truncate_to_played(TEXT, 100, 100) == TEXT
+    assert truncate_to_played(TEXT, 1, 100) == ""
+
+
+def test_truncate_to_marks_keeps_words_whose_successor_started():
+    # "Europe" started at 0.95 s, but "is" hadn't yet, so it may have been cut off
+    assert truncate_to_marks(TEXT, 1.2, MARKS) == "The tallest mountain in"
+    assert truncate_to_marks(TEXT, 1.45, MARKS) == "The tallest mountain in Europe"
+    assert truncate_to_marks(TEXT, 0.1, MARKS) == ""
+
+
+def test_spoken_text_keeps_played_sentences_and_cuts_the_last():
+    parts = sentences("Sure. ", TEXT, " It is in Russia.")
+    played = {0: RATE // 2, 1: int(1.5 * RATE)}
+    totals = {0: RATE // 2, 1: 2 * RATE, 2: RATE}
+
+    # without marks, words are assumed to be spread evenly over the sentence's audio
+    assert spoken_text(parts, played, totals, RATE) == "Sure. The tallest mountain in Europe is"
+    requested = []
+
+    def word_marks(text):
+        requested.append(text)
+        return MARKS
+
+    assert spoken_text(parts, played, totals, RATE, word_marks=word_marks) == "Sure. The tallest mountain in Europe"
+    # only the sentence that was cut off needs marks
+    assert requested == [TEXT]
+
+
+def test_spoken_text_falls_back_without_marks():
+    parts = sentences(TEXT)
+    assert spoken_text(parts, {0: RATE}, {0: 2 * RATE}, RATE, word_marks=lambda text: None) == \
+        spoken_text(parts, {0: RATE}, {0: 2 * RATE}, RATE)
+
+
+class FakePolly:
+    """
+    Answers speech mark requests. Polly's offsets count bytes of the ssml it was sent.
+    """
+
+    def synthesize_speech(self, Text, **kwargs):
+        marks = []
+        start = Text.index(">", Text.index("<prosody")) + 1
+        for word in Text[start:Text.index("</prosody>")].split(" "):
+            begin = Text.index(word, start)
+            start = begin + len(word)
+            marks.append({"time": len(marks) * 200, "type": "word",
+                          "start": len(Text[:begin].encode("utf-8")), "end": len(Text[:start].encode("utf-8"))})
+        return {"AudioStream": io.BytesIO("\n".join(json.dumps(m) for m in marks).encode("utf-8"))}
+
+
+def test_polly_word_marks_are_character_offsets_in_the_text(monkeypatch):
+    from clients.tts import polly_tts
+
+    monkeypatch.setattr(polly_tts, "_polly_client", FakePolly())
+    tts = polly_tts.PollyTTS(SimpleNamespace(voice_id="Joanna", voice_engine="neural", voice_rate="110"))
+    text = "Café crème, s'il vous plaît."
+    marks = tts.word_marks(text)
+
+    assert [seconds for seconds, _ in marks] == [0.0, 0.2, 0.4, 0.6, 0.8]
+    assert [text[:end] for _, end in marks] == ["Café", "Café crème,", "Café crème, s'il", "Café crème, s'il vous",
+                                              text]
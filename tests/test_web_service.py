@@ -0,0 +1,69 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pipeline.scheduler import RequestScheduler
+
+RESPONSE_TIME = 0.5  # seconds
+
+
+class SlowConversation:
+    """
+    Answers every message after RESPONSE_TIME.
+    """
+    persona = SimpleNamespace(name="Natalie")
+    llm_client = SimpleNamespace(model="gpt-4-1106-preview")
+
+    def __init__(self):
+        self.answered = threading.Event()
+
+    def get_response(self, message, origin="server", tag=None):
+        time.sleep(RESPONSE_TIME)
+        yield "Hello!"
+        self.answered.set()
+        yield None
+
+
+@pytest.fixture
+def web_service(monkeypatch):
+    from web.web_service import WebService
+
+    # WebService is a singleton, so everything set here is restored after the test
+    service = WebService()
+    rejected = []
+    monkeypatch.setattr(service, "scheduler", RequestScheduler(web_burst=2, web_rate=1))
+    monkeypatch.setattr(service, "conversation_manager", SlowConversation())
+    monkeypatch.setattr(service, "history_snapshot", lambda: (b"", 0))
+    monkeypatch.setattr(service, "send_to_client", lambda sid, message, model: rejected.append(message))
+    monkeypatch.setattr(service, "rejected", rejected, raising=False)
+    return service
+
+
+def connect(service):
+    # the flask test client gives the connection an address, like a browser's
+    return service.socketio.test_client(service.app, flask_test_client=service.app.test_client())
+
+
+def test_message_handler_returns_once_the_message_is_queued(web_service):
+    client = connect(web_service)
+    start = time.perf_counter()
+    client.emit("client_user_msg", "Hi there")
+    assert time.perf_counter() - start < RESPONSE_TIME / 2
+
+    assert web_service.conversation_manager.answered.wait(5)
+    client.disconnect()
+
+
+def test_reconnecting_does_not_reset_the_rate_limit(web_service):
+    client = connect(web_service)
+    for _ in range(2):
+        client.emit("client_user_msg", "Hi there")
+    client.disconnect()
+    assert not web_service.rejected
+
+    client = connect(web_service)
+    client.emit("client_user_msg", "Hi again")
+    assert web_service.rejected == ["<Too many messages, please wait a moment>"]
+    client.disconnect()
@@ -1,8 +1,10 @@
 import logging
 import math
 import os
-import struct
+import threading
+import time
 import wave
+from collections import deque
 
 import numpy as np
 import openai
@@ -10,11 +12,20 @@ import pvporcupine
 import pyaudio
 import sounddevice as sd
 from pydub import AudioSegment
-from scipy.signal import resample
 from timeout_function_decorator.timeout_decorator import timeout
 
+from clients.warmup import WARM_UP_TIMEOUT
+from utils.resampling import convert_frame_length, resample_audio  # noqa: F401 (re-exported)
+
 CHANNELS = 1
 FRAMES_PER_BUFFER = 512
+STT_MODEL = "whisper-1"
+STT_TIMEOUT = 6  # seconds
+PLAYBACK_BLOCK_DURATION = 0.02  # seconds of audio written to the speaker at a time
+DUCK_TIME = 0.08  # seconds over which audio fades out when it is ducked
+MAX_READER_BUFFER = 60  # seconds of audio a capture reader keeps if it isn't read
+PRE_ROLL_DURATION = 2  # seconds of the most recent audio the capture keeps for readers to rewind into
+WAKE_WORD_TAIL = 0.3  # seconds between the end of a wake word and its detection by Porcupine
 
 
 def amplify_wav(file_path, amplification_factor):
@@ -40,25 +51,6 @@ def adjust_volume(file_path, percentage, file_format="mp3"):
     amplified_sound.export(file_path, format=file_format)
 
 
-def resample_audio(audio_data, from_rate, to_rate):
-    # convert to numpy array if audio_data is in bytes
-    if isinstance(audio_data, bytes):
-        audio_data = np.frombuffer(audio_data, dtype=np.int16)
-
-    audio_data = np.array(audio_data)
-    ratio = to_rate / from_rate
-    audio_len = len(audio_data)
-    new_len = int(audio_len * ratio)
-    resampled_audio = resample(audio_data, new_len)
-    return np.int16(resampled_audio)
-
-
-def convert_frame_length(audio_data, target_frame_length):
-    audio_data = np.array(audio_data, dtype=np.float32)
-    resampled_audio = resample(audio_data, target_frame_length)
-    return np.array(resampled_audio, dtype=np.int16)
-
-
 def frequency_filter(frame, cutoff_low=15, cutoff_high=250, sample_rate=16000):
     """
     Uses fast fourier transform to filter out frequencies outside of human speech.
@@ -83,12 +75,20 @@ def frequency_filter(frame, cutoff_low=15, cutoff_high=250, sample_rate=16000):
     return filtered_frame
 
 
-@timeout(6)
+def warm_up_stt():
+    """
+    Opens the connection used by transcribe_audio(). The openai module keeps one client, and its connection pool,
+    for the whole process.
+    """
+    openai.models.retrieve(STT_MODEL, timeout=WARM_UP_TIMEOUT)
+
+
+@timeout(STT_TIMEOUT)
 def transcribe_audio(file_path):
     with open(file_path, "rb") as audio_file:
         question_text = openai.audio.transcriptions.create(
             file=audio_file,
-            model="whisper-1",
+            model=STT_MODEL,
             response_format="text",
             language="en"
         )
@@ -115,35 +115,351 @@ def stream_audio(audio_chunk, audio_rate, speaker_rate, volume=0.5, device_name=
     sd.wait()
 
 
-def wait_for_wake_word(wakeword_sensitivity_pairs, mic_rate, stop_flag: dict = {'stop_playback': False}):
+def sample_count(audio_chunk):
+    """
+    Number of 16-bit samples in a chunk given either as bytes or as an array of samples.
+    """
+    return len(audio_chunk) // 2 if isinstance(audio_chunk, (bytes, bytearray)) else len(audio_chunk)
+
+
+class AudioPlayer:
+    """
+    Plays chunks through one persistent output stream, written in short blocks. Unlike stream_audio, playback can be
+    aborted between blocks from another thread, there is no gap between consecutive chunks, and the number of samples
+    that actually reached the speaker is known.
+    """
+
+    def __init__(self, speaker_rate, device_name=""):
+        self.speaker_rate = speaker_rate
+        self.device_name = device_name
+        self._stream = None
+        self._aborted = False
+        self.lock = threading.Lock()  # one chunk or clip plays at a time
+
+    def _get_stream(self):
+        if self._stream is None:
+            self._stream = sd.OutputStream(samplerate=self.speaker_rate, channels=CHANNELS, dtype='int16',
+                                           device=self.device_name if self.device_name else None)
+        if not self._stream.active:
+            self._stream.start()
+        return self._stream
+
+    def play(self, audio_chunk, audio_rate, volume=0.5, is_cancelled=None, duck=None):
+        """
+        Plays a chunk, blocking until it has been handed to the audio device or playback is cancelled.
+        :param is_cancelled: Optional callable checked between blocks.
+        :param duck: Optional callable checked between blocks. Once it returns True, the chunk fades out over DUCK_TIME
+        instead of being cut off.
+        :return: The number of samples of audio_chunk (at audio_rate) that were played.
+        """
+        # make sure the chunk length is a multiple of 2 (for np.int16)
+        if isinstance(audio_chunk, (bytes, bytearray)) and len(audio_chunk) % 2 != 0:
+            audio_chunk = audio_chunk[:-1]
+        source_samples = sample_count(audio_chunk)
+
+        if audio_rate == self.speaker_rate:
+            audio_array = np.frombuffer(audio_chunk, dtype=np.int16) \
+                if isinstance(audio_chunk, (bytes, bytearray)) else audio_chunk
+        else:
+            audio_array = resample_audio(audio_chunk, from_rate=audio_rate, to_rate=self.speaker_rate)
+        # change volume by scaling amplitude
+        audio_array = np.int16(audio_array * volume)
+
+        with self.lock:
+            self._aborted = False
+            stream = self._get_stream()
+            block = max(1, int(self.speaker_rate * PLAYBACK_BLOCK_DURATION))
+            written = 0
+            try:
+                for start in range(0, len(audio_array), block):
+                    if self._aborted or (is_cancelled is not None and is_cancelled()):
+                        break
+                    if duck is not None and duck():
+                        tail = audio_array[start:start + int(self.speaker_rate * DUCK_TIME)]
+                        stream.write(np.int16(tail * np.linspace(1, 0, len(tail))))
+                        written += len(tail)
+                        break
+                    stream.write(audio_array[start:start + block])
+                    written += len(audio_array[start:start + block])
+            except sd.PortAudioError as e:
+                if not self._aborted:
+                    raise
+                logging.debug(f"Playback aborted: {e}")
+
+        if written == len(audio_array) and not self._aborted:
+            return source_samples
+        # whatever was still buffered in the device was discarded by abort()
+        played = max(0, written - int(stream.latency * self.speaker_rate))
+        return min(source_samples, int(played * audio_rate / self.speaker_rate))
+
+    def abort(self):
+        """
+        Stops playback immediately, discarding buffered audio. Safe to call from another thread.
+        """
+        self._aborted = True
+        if self._stream is not None and self._stream.active:
+            self._stream.abort()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+_porcupines = {}
+_porcupines_lock = threading.Lock()
+
+
+def get_porcupine(wakeword_sensitivity_pairs):
+    """
+    :return: Porcupine instance for the wake words, created once per set of wake words.
+    """
+    key = tuple(tuple(pair) for pair in wakeword_sensitivity_pairs)
+    with _porcupines_lock:
+        if key not in _porcupines:
+            dir_path = os.path.dirname(os.path.realpath(__file__))
+            wakewords, sensitivities = zip(*wakeword_sensitivity_pairs)
+            file_paths = list(map(lambda file: os.path.join(dir_path, "../..", file), wakewords))
+            _porcupines[key] = pvporcupine.create(
+                access_key=os.getenv('PICOVOICE_API_KEY'),
+                keyword_paths=file_paths,
+                sensitivities=sensitivities
+            )
+        return _porcupines[key]
+
+
+def wait_for_wake_word(wakeword_sensitivity_pairs, reader, stop_event=None):
+    """
+    Blocks until one of the wake words is detected.
+    :param reader: CaptureReader to take the audio from. Reading continues from it after the wake word.
+    :param stop_event: Optional threading.Event that ends the wait early when set (e.g. playback finished).
+    :return: Index of the wake word that was detected, or None if stop_event was set first.
+    """
     # TODO filter out the system's voice based on its frequency (180 - 300) or only look at my voice's (80 - 120
-    # stop_flag must be mutable since it may be shared between threads
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    wakewords, sensitivities = zip(*wakeword_sensitivity_pairs)
-    file_paths = list(map(lambda file: os.path.join(dir_path, "../..", file), wakewords))
-    porcupine = pvporcupine.create(
-        access_key=os.getenv('PICOVOICE_API_KEY'),
-        keyword_paths=file_paths,
-        sensitivities=sensitivities
-    )
+    porcupine = get_porcupine(wakeword_sensitivity_pairs)
 
     # calculate the initial frame length based on Porcupine's requirements
-    initial_frame_length = int(porcupine.frame_length * (mic_rate / porcupine.sample_rate))
-    audio_stream = get_audio_stream(mic_rate, initial_frame_length)
+    initial_frame_length = int(porcupine.frame_length * (reader.mic_rate / porcupine.sample_rate))
 
-    while not stop_flag['stop_playback']:
-        audio = audio_stream.read(initial_frame_length, exception_on_overflow=False)
-        audio = struct.unpack_from("h" * initial_frame_length, audio)
+    while stop_event is None or not stop_event.is_set():
+        audio = reader.read(initial_frame_length, timeout=PLAYBACK_BLOCK_DURATION * 5)
+        if audio is None:
+            continue
 
         audio_resampled = convert_frame_length(audio, porcupine.frame_length)
 
         # feed resampled audio into porcupine
-        # TODO add keywords. Return value is the one detected
-        # TODO dynamically filter them out here based on persona
-        if porcupine.process(audio_resampled) >= 0:
+        # the index tells which of the wake words (and so which persona) was detected
+        keyword_index = porcupine.process(audio_resampled)
+        if keyword_index >= 0:
             logging.info("Wake word detected!")
-            break
-    return True
+            reader.mark()
+            # the query may have started before the wake word was detected
+            reader.rewind(WAKE_WORD_TAIL)
+            return keyword_index
+    return None
+
+
+class CaptureReader:
+    """
+    One consumer of the AudioCapture. Frames captured after the reader was created are buffered until they are read,
+    so a reader handed from one state to the next continues exactly where the previous state stopped reading. A reader
+    can also rewind into the capture's pre-roll to read recent audio again.
+    """
+
+    def __init__(self, capture, position):
+        """
+        :param position: Capture sample index of the first sample to read.
+        """
+        self.capture = capture
+        self.mic_rate = capture.mic_rate
+        self.cond = threading.Condition()
+        self.frames = deque()  # (capture sample index, time.perf_counter() when captured, samples)
+        self.buffered = 0
+        self.position = position  # capture sample index of the next sample read() returns
+        self.closed = False
+        self.marked_at = None  # see mark()
+        self.first_sample_time = None  # capture time of the first sample returned by the last read()
+        self.replay_end = position  # capture sample index up to which rewound audio was already read, see rewind()
+
+    def feed(self, index, captured_at, frame):
+        with self.cond:
+            self.frames.append((index, captured_at, frame))
+            self.buffered += len(frame)
+            while self.buffered > MAX_READER_BUFFER * self.mic_rate:
+                _, _, dropped = self.frames.popleft()
+                self.buffered -= len(dropped)
+                self.position += len(dropped)
+            self.cond.notify()
+
+    def read(self, samples, timeout=None):
+        """
+        Blocks until the given number of samples has been captured.
+        :return: Array of int16 samples, or None if they weren't captured within the timeout.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.buffered >= samples or self.closed, timeout) or self.closed:
+                return None
+            parts = []
+            needed = samples
+            self.first_sample_time = self.frames[0][1]
+            while needed:
+                index, captured_at, frame = self.frames[0]
+                if len(frame) <= needed:
+                    self.frames.popleft()
+                    parts.append(frame)
+                    needed -= len(frame)
+                else:
+                    parts.append(frame[:needed])
+                    # the rest of the frame was captured a bit later
+                    self.frames[0] = (index + needed, captured_at + needed / self.mic_rate, frame[needed:])
+                    needed = 0
+            self.buffered -= samples
+            self.position += samples
+            return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def rewind(self, seconds):
+        """
+        Moves the reader back so that the last seconds of audio are read again, as far as the pre-roll reaches.
+        :return: Seconds actually rewound.
+        """
+        with self.cond:
+            self.replay_end = max(self.replay_end, self.position)
+            earlier = self.capture.pre_roll(self.position - int(seconds * self.mic_rate), self.position)
+            self.frames.extendleft(reversed(earlier))
+            rewound = sum(len(frame) for _, _, frame in earlier)
+            self.buffered += rewound
+            self.position -= rewound
+        return rewound / self.mic_rate
+
+    def replayed(self):
+        """
+        :return: Number of samples from the read position on that were already read before a rewind().
+        """
+        with self.cond:
+            return max(0, self.replay_end - self.position)
+
+    def clear(self, keep=0):
+        """
+        Drops everything captured so far, e.g. the response that was playing, and marks the time.
+        :param keep: Seconds of the most recent audio to keep. They are read again like rewound audio (see replayed()).
+        """
+        with self.cond:
+            self.position += self.buffered
+            self.frames.clear()
+            self.buffered = 0
+        if keep:
+            self.rewind(keep)
+        self.mark()
+
+    def mark(self):
+        """
+        Records the time a state stopped using the audio, to measure the dead time before the next read.
+        """
+        self.marked_at = time.perf_counter()
+
+    def dead_time(self):
+        """
+        :return: Seconds between mark() and the capture of the audio returned by the last read(), or None.
+        """
+        if self.marked_at is None or self.first_sample_time is None:
+            return None
+        return max(0.0, self.first_sample_time - self.marked_at)
+
+    def close(self):
+        self.capture.remove(self)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class AudioCapture:
+    """
+    Reads the microphone on its own thread through one stream that stays open, and hands every frame to each open
+    CaptureReader. Moving between waiting for the wake word, recording a query and the next turn only hands a reader
+    on, so no audio is lost and no stream is reopened between states. The last PRE_ROLL_DURATION seconds are kept in a
+    ring buffer, so a query spoken straight through the wake word is recorded from where the wake word ended.
+    """
+
+    def __init__(self, mic_rate, stream=None):
+        """
+        :param stream: Input stream to read from; the shared pyaudio stream if None.
+        """
+        self.mic_rate = mic_rate
+        self.stream = stream if stream is not None else get_audio_stream(mic_rate)
+        self.lock = threading.Lock()
+        self.readers = []
+        self.ring = deque(maxlen=math.ceil(PRE_ROLL_DURATION * mic_rate / FRAMES_PER_BUFFER))
+        self.captured = 0  # samples captured so far, i.e. the index of the next one
+        thread = threading.Thread(target=self._run, name="audio-capture")
+        thread.daemon = True
+        thread.start()
+
+    def open_reader(self, pre_roll=0):
+        """
+        :param pre_roll: Seconds of already captured audio the reader starts with, as far as the pre-roll reaches.
+        """
+        with self.lock:
+            reader = CaptureReader(self, self.captured)
+            self.readers.append(reader)
+        if pre_roll:
+            reader.rewind(pre_roll)
+        return reader
+
+    def remove(self, reader):
+        with self.lock:
+            if reader in self.readers:
+                self.readers.remove(reader)
+
+    def pre_roll(self, start, stop):
+        """
+        :return: The frames of the ring buffer between capture sample indexes start and stop, cut to that range.
+        """
+        with self.lock:
+            frames = list(self.ring)
+        earlier = []
+        for index, captured_at, frame in frames:
+            first, last = max(start, index), min(stop, index + len(frame))
+            if first < last:
+                earlier.append((first, captured_at + (first - index) / self.mic_rate,
+                                frame[first - index:last - index]))
+        return earlier
+
+    def _run(self):
+        while True:
+            try:
+                data = self.stream.read(FRAMES_PER_BUFFER, exception_on_overflow=False)
+            except Exception as e:
+                logging.error(f"Error reading from the microphone: {e}")
+                time.sleep(FRAMES_PER_BUFFER / self.mic_rate)
+                continue
+            # time the first sample of the frame was captured
+            captured_at = time.perf_counter() - FRAMES_PER_BUFFER / self.mic_rate
+            frame = np.frombuffer(data, dtype=np.int16)
+            with self.lock:
+                index = self.captured
+                self.captured += len(frame)
+                self.ring.append((index, captured_at, frame))
+                readers = list(self.readers)
+            for reader in readers:
+                reader.feed(index, captured_at, frame)
+
+
+_capture = None
+_capture_lock = threading.Lock()
+
+
+def get_capture(mic_rate):
+    """
+    :return: The process-wide AudioCapture, started on first use.
+    """
+    global _capture
+    with _capture_lock:
+        if _capture is None:
+            _capture = AudioCapture(mic_rate)
+        elif _capture.mic_rate != mic_rate:
+            logging.warning(f"Audio capture is already running at {_capture.mic_rate} Hz, not {mic_rate} Hz.")
+        return _capture
 
 
 def get_audio_stream(mic_rate, frames_per_buffer=FRAMES_PER_BUFFER):
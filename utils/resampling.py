@@ -0,0 +1,25 @@
+"""
+Resampling helpers that only need numpy and scipy, so they can be used (and benchmarked) without an audio device.
+utils.audio re-exports them.
+"""
+import numpy as np
+from scipy.signal import resample
+
+
+def resample_audio(audio_data, from_rate, to_rate):
+    # convert to numpy array if audio_data is in bytes
+    if isinstance(audio_data, bytes):
+        audio_data = np.frombuffer(audio_data, dtype=np.int16)
+
+    audio_data = np.array(audio_data)
+    ratio = to_rate / from_rate
+    audio_len = len(audio_data)
+    new_len = int(audio_len * ratio)
+    resampled_audio = resample(audio_data, new_len)
+    return np.int16(resampled_audio)
+
+
+def convert_frame_length(audio_data, target_frame_length):
+    audio_data = np.array(audio_data, dtype=np.float32)
+    resampled_audio = resample(audio_data, target_frame_length)
+    return np.array(resampled_audio, dtype=np.int16)
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from clients.stt.openai_stt import OpenAiStt
+from utils.stt_encoder import StreamingEncoder
+
+SPECULATIVE_PAUSE_TIME = 0.3  # seconds of pause before the audio recorded so far is transcribed speculatively
+SPECULATION_FILE = "tmp_speculative_{}"  # without the extension, which depends on the codec
+
+
+class Speculation:
+    def __init__(self, samples, rate, token):
+        self.samples = samples  # the recording it transcribes
+        self.rate = rate
+        self.token = token  # RequestToken of its STT request
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self.done = threading.Event()
+        self.cancelled = False
+        self.text = None
+
+
+class SpeculativeStt:
+    """
+    Transcribes the recording so far whenever the speaker pauses, while record_query keeps listening for the end of
+    the query. If the pause turns out to be the end, the speculative transcript is used and the STT round trip is off
+    the critical path; if the speaker goes on, the speculation is cancelled, which stops its upload so it doesn't
+    compete with the rest of the recording for the uplink. Speculations are compressed like the query itself (see
+    StreamingEncoder).
+    """
+
+    def __init__(self, stt_client=None):
+        """
+        :param stt_client: OpenAiStt the speculations are transcribed with.
+        """
+        self.stt_client = stt_client if stt_client is not None else OpenAiStt()
+        self.current = None
+        self.count = 0
+        # what happened to the speculations
+        self.won = 0  # transcript used
+        self.wasted = 0  # cancelled because the speaker went on
+        self.failed = 0  # the endpoint was reached but the speculation failed, so the query was transcribed again
+        self.saved_time = 0  # seconds of STT that happened before the endpoint
+
+    def warm_up(self):
+        self.stt_client.warm_up()
+
+    def start(self, frames, rate):
+        """
+        Starts transcribing the given frames in the background, replacing (and cancelling) any earlier speculation.
+        :param rate: Sample rate of the frames.
+        """
+        self.cancel()
+        self.count += 1
+        speculation = Speculation(np.concatenate(frames), rate, self.stt_client.new_request())
+        self.current = speculation
+        thread = threading.Thread(target=self._run, args=(speculation, SPECULATION_FILE.format(self.count)),
+                                  name="speculative-stt")
+        thread.daemon = True
+        thread.start()
+        logging.debug(f"Speculative transcription {self.count} started")
+
+    def _run(self, speculation, file_stem):
+        if speculation.cancelled:
+            speculation.done.set()
+            return
+        encoder = StreamingEncoder(speculation.rate)
+        try:
+            encoder.write(speculation.samples)
+            file_path = encoder.finish(file_stem)
+            speculation.text = self.stt_client.transcribe(file_path, token=speculation.token)
+        except Exception as e:
+            if not speculation.cancelled:
+                logging.warning(f"Speculative transcription failed: {e}")
+        finally:
+            encoder.abort()
+            speculation.finished_at = time.perf_counter()
+            speculation.done.set()
+
+    def pending(self):
+        return self.current is not None
+
+    def cancel(self):
+        """
+        Discards the current speculation, e.g. because the speaker went on. Its upload is stopped; if it has already
+        been uploaded, the transcript is ignored.
+        """
+        if self.current is not None:
+            self._abort(self.current)
+            self.current = None
+            self.wasted += 1
+
+    def _abort(self, speculation):
+        speculation.cancelled = True
+        self.stt_client.cancel(speculation.token)
+
+    def take(self, timeout=None):
+        """
+        Called at the endpoint. Waits for the current speculation, which covers the whole query.
+        :return: The speculative transcript, or None if there is none and the recording has to be transcribed.
+        """
+        speculation, self.current = self.current, None
+        if speculation is None:
+            return None
+        endpoint = time.perf_counter()
+        if not speculation.done.wait(timeout) or not speculation.text:
+            self._abort(speculation)
+            self.failed += 1
+            return None
+        self.won += 1
+        self.saved_time += min(speculation.finished_at, endpoint) - speculation.started_at
+        logging.info(f"Using speculative transcript, waited {(time.perf_counter() - endpoint) * 1000:.0f} ms "
+                     f"after the endpoint")
+        return speculation.text
+
+    def stats(self):
+        """
+        :return: Dictionary with the number of speculations, the share that was used (win rate) or cancelled (waste
+        rate), and the STT time taken off the critical path.
+        """
+        started = self.won + self.wasted + self.failed
+        return {
+            "started": started,
+            "won": self.won,
+            "wasted": self.wasted,
+            "failed": self.failed,
+            "win_rate": self.won / started if started else 0,
+            "waste_rate": self.wasted / started if started else 0,
+            "saved_time": self.saved_time,
+        }
@@ -0,0 +1,97 @@
+import logging
+from collections import Counter
+
+import numpy as np
+
+MIN_VOICED_DURATION = 0.25  # seconds of voiced VAD frames a recording needs to be sent to STT
+MIN_VAD_COVERAGE = 0.2  # share of voiced frames between the first and the last voiced one
+MIN_SNR = 6  # dB between the median level of voiced and unvoiced frames
+TRIM_PADDING = 0.2  # seconds of silence kept before the first and after the last voiced frame
+
+
+def frame_levels(samples, frame_length):
+    """
+    :return: RMS level of every complete frame of the recording.
+    """
+    frames = len(samples) // frame_length
+    frames = samples[:frames * frame_length].reshape(frames, frame_length).astype(np.float64)
+    return np.sqrt(np.mean(frames ** 2, axis=1))
+
+
+class SpeechGate:
+    """
+    Cheap local check of a recording before it is uploaded for STT, based on the VAD decision for every frame that
+    record_query has already made: recordings with too little speech (a cough, a door) are rejected, and
+    leading_trim() and trailing_limit() give the part of the rest the encoder keeps. Accepted and rejected counts are
+    kept so the thresholds can be tuned.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.accepted = 0
+        self.rejected = Counter()  # reason -> count
+        self.trimmed = 0  # seconds of silence not uploaded
+
+    def enough_speech(self, voiced, frame_length):
+        """
+        :return: Whether the recording so far has enough voiced frames to be worth transcribing.
+        """
+        return sum(voiced) * frame_length / self.rate >= MIN_VOICED_DURATION
+
+    def leading_trim(self, voiced, frame_length):
+        """
+        :return: Number of samples of silence to drop from the start of a recording, keeping TRIM_PADDING.
+        """
+        first = next((i for i, is_voiced in enumerate(voiced) if is_voiced), 0)
+        return max(0, first * frame_length - int(TRIM_PADDING * self.rate))
+
+    def trailing_limit(self, voiced_count, frame_length):
+        """
+        :return: Offset up to which a recording is kept if its last voiced frame is voiced_count - 1.
+        """
+        return voiced_count * frame_length + int(TRIM_PADDING * self.rate)
+
+    def check(self, samples, voiced, frame_length):
+        """
+        :param samples: The recording, at the rate the VAD ran at.
+        :param voiced: VAD decision for each frame_length frame of the recording.
+        :return: Reason the recording was rejected, or None. The recording isn't trimmed here; the encoder it was
+        written to already left out the silence, see leading_trim() and trailing_limit().
+        """
+        levels = frame_levels(samples, frame_length)
+        voiced = np.array(voiced[:len(levels)], dtype=bool)
+        levels = levels[:len(voiced)]
+        voiced_frames = np.flatnonzero(voiced)
+
+        reason = None
+        voiced_duration = len(voiced_frames) * frame_length / self.rate
+        coverage = snr = 0
+        if not len(voiced_frames) or voiced_duration < MIN_VOICED_DURATION:
+            reason = "too little speech"
+        else:
+            coverage = len(voiced_frames) / (voiced_frames[-1] - voiced_frames[0] + 1)
+            if coverage < MIN_VAD_COVERAGE:
+                reason = "sparse speech"
+            elif not voiced.all():
+                silence = max(float(np.median(levels[~voiced])), 1.0)
+                snr = 20 * np.log10(max(float(np.median(levels[voiced])), 1.0) / silence)
+                if snr < MIN_SNR:
+                    reason = "too quiet"
+
+        stats = f"{voiced_duration:.2f} s voiced, {coverage:.0%} coverage, {snr:.1f} dB"
+        if reason:
+            self.rejected[reason] += 1
+            logging.info(f"Speech gate rejected the recording: {reason} ({stats}); {self._counts()}")
+            return reason
+
+        start = self.leading_trim(voiced, frame_length)
+        stop = min(len(samples), self.trailing_limit(voiced_frames[-1] + 1, frame_length))
+        self.accepted += 1
+        self.trimmed += (len(samples) - (stop - start)) / self.rate
+        logging.info(f"Speech gate accepted the recording ({stats}), trimmed to {(stop - start) / self.rate:.2f} of "
+                     f"{len(samples) / self.rate:.2f} s; {self._counts()}")
+        return None
+
+    def _counts(self):
+        rejected = ", ".join(f"{count} {reason}" for reason, count in self.rejected.items())
+        return f"{self.accepted} accepted, {sum(self.rejected.values())} rejected ({rejected or 'none'})"
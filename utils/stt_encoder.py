@@ -0,0 +1,166 @@
+import logging
+import resource
+import subprocess
+import threading
+import time
+import wave
+from collections import deque
+
+import numpy as np
+
+from utils import audio
+
+STT_CODEC = "flac"  # codec of the audio uploaded for STT: "flac", "opus" or "wav"
+ENCODER_TIMEOUT = 2  # seconds to wait for the encoder to flush at the endpoint before falling back to WAV
+# ffmpeg output options and file extension per codec
+CODECS = {
+    "flac": (["-c:a", "flac", "-compression_level", "5", "-f", "flac"], "flac"),
+    "opus": (["-c:a", "libopus", "-b:a", "24k", "-application", "voip", "-f", "ogg"], "ogg"),
+}
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StreamingEncoder:
+    """
+    Encodes a recording for upload while it is being recorded: samples are piped into an ffmpeg process as they are
+    written, so the compressed file is ready almost as soon as the recording ends. If ffmpeg is missing or fails, the
+    samples (which are kept) are written as WAV instead.
+
+    Only the part of the recording between skip_to() and extend_to() is encoded; samples past the limit wait until it
+    is extended, so trailing silence the speech gate would trim is never encoded.
+    """
+
+    def __init__(self, rate, codec=STT_CODEC, limit=None):
+        """
+        :param limit: Number of samples to encode, see extend_to(). None encodes everything.
+        """
+        self.rate = rate
+        self.codec = codec
+        self.limit = limit
+        self.start = 0
+        self.position = 0  # offset of the first sample that is neither encoded nor skipped
+        self.pending = deque()  # samples written but not encoded yet
+        self.samples = []
+        self.output = bytearray()
+        self.process = None
+        self.output_reader = None
+        self.cpu_time = 0  # seconds of CPU the encoder used
+        self.finish_time = 0  # seconds the caller waited for the encoder at the endpoint
+        self._cpu_start = children_cpu_time()
+        if codec not in CODECS:
+            return
+        options, _ = CODECS[codec]
+        try:
+            self.process = subprocess.Popen(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "s16le", "-ar", str(rate),
+                 "-ac", str(audio.CHANNELS), "-i", "pipe:0", *options, "pipe:1"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logging.warning(f"Unable to start the {codec} encoder, uploading WAV: {e}")
+            return
+        self.output_reader = threading.Thread(target=self._read_output, name="stt-encoder")
+        self.output_reader.daemon = True
+        self.output_reader.start()
+
+    def _read_output(self):
+        while True:
+            data = self.process.stdout.read1(65536)
+            if not data:
+                break
+            self.output += data
+
+    def write(self, samples):
+        """
+        Appends int16 samples to the recording and encodes them as far as the limit allows.
+        """
+        self.pending.append(samples)
+        self._encode()
+
+    def skip_to(self, offset):
+        """
+        Drops the recording before the given sample offset, e.g. leading silence.
+        """
+        self.start = offset
+        self._encode()
+
+    def extend_to(self, limit):
+        """
+        Allows the recording up to the given sample offset to be encoded, e.g. up to the end of the last word.
+        """
+        self.limit = limit
+        self._encode()
+
+    def _encode(self):
+        while self.pending:
+            samples = self.pending.popleft()
+            if self.position < self.start:
+                skipped = min(len(samples), self.start - self.position)
+                self.position += skipped
+                samples = samples[skipped:]
+                if not len(samples):
+                    continue
+            if self.limit is not None:
+                allowed = self.limit - self.position
+                if allowed <= 0:
+                    self.pending.appendleft(samples)
+                    break
+                if len(samples) > allowed:
+                    self.pending.appendleft(samples[allowed:])
+                    samples = samples[:allowed]
+            self.position += len(samples)
+            self.samples.append(samples)
+            if self.process is None:
+                continue
+            try:
+                self.process.stdin.write(samples.tobytes())
+            except (BrokenPipeError, OSError) as e:
+                logging.warning(f"The {self.codec} encoder failed, uploading WAV: {e}")
+                self.abort()
+
+    def finish(self, file_stem):
+        """
+        Ends the recording and writes it to a file, compressed if the encoder succeeded.
+        :param file_stem: File path without the extension.
+        :return: Path of the file written.
+        """
+        start_time = time.perf_counter()
+        self.pending.clear()
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(ENCODER_TIMEOUT)
+                self.output_reader.join(ENCODER_TIMEOUT)
+            except (subprocess.TimeoutExpired, OSError) as e:
+                logging.warning(f"The {self.codec} encoder did not finish, uploading WAV: {e}")
+                self.abort()
+        self.cpu_time = children_cpu_time() - self._cpu_start
+
+        if self.process is not None and self.process.returncode == 0 and self.output:
+            file_path = f"{file_stem}.{CODECS[self.codec][1]}"
+            with open(file_path, "wb") as f:
+                f.write(self.output)
+        else:
+            if self.process is not None:
+                logging.warning(f"The {self.codec} encoder exited with {self.process.returncode}, uploading WAV")
+            file_path = f"{file_stem}.wav"
+            with wave.open(file_path, 'wb') as wf:
+                wf.setnchannels(audio.CHANNELS)
+                wf.setsampwidth(2)  # assuming 16-bit samples (2 bytes)
+                wf.setframerate(self.rate)
+                wf.writeframes(self.pcm().tobytes())
+        self.finish_time = time.perf_counter() - start_time
+        return file_path
+
+    def pcm(self):
+        return np.concatenate(self.samples) if self.samples else np.array([], dtype=np.int16)
+
+    def abort(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
@@ -0,0 +1,71 @@
+import threading
+
+MAX_IN_FLIGHT = 2  # frames sent to a client that it hasn't acknowledged yet
+MAX_PENDING = 100  # updates waiting for a client before they are dropped and the client is resynced
+
+
+class ClientOutbox:
+    """
+    Updates waiting to be sent to one web client. Adding an update never blocks on the socket: consecutive chunks of
+    the same assistant message are merged into one update, and a client that has too many frames unacknowledged
+    simply accumulates (merged) updates until it catches up. If even the merged updates grow past MAX_PENDING, they
+    are dropped and the client is sent a fresh history snapshot instead.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.lock = threading.Lock()
+        self.pending = []
+        self.in_flight = 0
+        self.needs_resync = False
+        self.fell_behind = False  # whether the resync is due to dropped updates
+        self.dropped = 0  # updates dropped over the client's lifetime
+        self.merged = 0  # updates merged into a previous one over the client's lifetime
+
+    def put(self, update):
+        """
+        :param update: Dictionary with the fields of a chat update (see WebService.emit_update()).
+        """
+        with self.lock:
+            if self.needs_resync:
+                self.dropped += 1
+                return
+            last = self.pending[-1] if self.pending else None
+            if update['msg_type'] == "assistant_append" and last and last['msg_type'] in ("assistant_msg",
+                                                                                        "assistant_append"):
+                self.pending[-1] = {**last, "message": last['message'] + update['message']}
+                self.merged += 1
+            else:
+                self.pending.append(update)
+            if len(self.pending) > MAX_PENDING:
+                self.dropped += len(self.pending)
+                self.pending = []
+                self.needs_resync = True
+                self.fell_behind = True
+
+    def resync(self):
+        """
+        Drops the pending updates and sends the client a fresh history snapshot instead, e.g. because another
+        conversation is shown.
+        """
+        with self.lock:
+            self.pending = []
+            self.needs_resync = True
+
+    def take(self):
+        """
+        :return: Tuple of the pending updates and whether the client needs a resync, or None if nothing should be
+        sent to this client right now.
+        """
+        with self.lock:
+            if self.in_flight >= MAX_IN_FLIGHT or not (self.pending or self.needs_resync):
+                return None
+            updates, self.pending = self.pending, []
+            needs_resync, self.needs_resync = self.needs_resync, False
+            self.in_flight += 1
+            return updates, needs_resync
+
+    def acknowledge(self):
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            return bool(self.pending or self.needs_resync)
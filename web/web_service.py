@@ -1,15 +1,24 @@
+import json
 import logging
 import threading
 import time
+import zlib
 
-from flask import Flask, render_template
-from flask_socketio import SocketIO
+from flask import Flask, jsonify, render_template, request
+from flask_socketio import SocketIO, emit
 
 import conversationmanager
 from conversationmanager import InvalidInputError
 from enums.role_enum import Role
+from pipeline.scheduler import RateLimitedError
+from preprocessing import check_for_persona_switch
+from web.outbox import ClientOutbox
 
 PORT = 8080
+SNAPSHOT_SIZE = 50  # most recent messages sent to a client when it connects
+PAGE_SIZE = 50  # older messages sent per "load older" request
+MAX_PAGE_SIZE = 200
+FLUSH_INTERVAL = 0.05  # seconds updates are collected for before they are sent to the clients as one frame
 
 
 class SingletonMeta(type):
@@ -23,7 +32,10 @@ class SingletonMeta(type):
 
 
 class WebService(metaclass=SingletonMeta):
-    def __init__(self):
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        """
+        :param flush_interval: Seconds updates are collected for before they are sent to the clients as one frame.
+        """
         if hasattr(self, "initialized") and self.initialized:
             return
 
@@ -32,6 +44,17 @@ class WebService(metaclass=SingletonMeta):
         self._setup_routes()
         self._setup_socket_events()
         self.conversation_manager = None
+        self.scheduler = None  # RequestScheduler shared with the voice pipeline
+        self.persona_switcher = None  # switch_persona(name) of the voice pipeline, see switch_conversation()
+        self.persona_names = []
+
+        # updates are queued per client and sent by a separate thread, so the LLM loop never waits on a socket
+        self.flush_interval = flush_interval
+        self.outboxes = {}  # sid -> ClientOutbox
+        self.outboxes_lock = threading.Lock()
+        self.frame_ready = threading.Event()
+        self.streaming_msg = None  # the assistant message being streamed, so far
+        threading.Thread(target=self._flush_frames, daemon=True).start()
         self.initialized = True
 
     def _setup_routes(self):
@@ -39,35 +62,121 @@ class WebService(metaclass=SingletonMeta):
         def index():
             return render_template("index.html")
 
+        @self.app.route("/metrics")
+        def metrics():
+            return jsonify({"scheduler": self.scheduler.metrics() if self.scheduler else None,
+                            "web_clients": len(self.outboxes)})
+
     def _setup_socket_events(self):
         @self.socketio.on("connect")
         def handle_connect():
+            with self.outboxes_lock:
+                self.outboxes[request.sid] = ClientOutbox(request.sid)
+            if self.conversation_manager:
+                start_time = time.perf_counter()
+                snapshot, count = self.history_snapshot()
+                emit("history_snapshot", snapshot)  # only to the client that connected
+                emit("personas", self.personas())
+                logging.info(f"New web client connection. Sent the latest {count} messages ({len(snapshot)} bytes) "
+                             f"in {time.perf_counter() - start_time:.3f} seconds.")
+
+        @self.socketio.on("disconnect")
+        def handle_disconnect():
+            with self.outboxes_lock:
+                outbox = self.outboxes.pop(request.sid, None)
+            if outbox and outbox.dropped:
+                logging.info(f"Web client {request.sid} disconnected after {outbox.dropped} updates were dropped for it.")
+
+        @self.socketio.on("load_older")
+        def handle_load_older(request):
+            """
+            :param request: Dictionary with the 'cursor' of the oldest message the client has and optionally 'limit'.
+            """
             if self.conversation_manager:
-                messages = self.conversation_manager.conversation
-                for message in messages:
-                    if message['role'] == Role.ASSISTANT:
-                        self.send_new_assistant_msg(message['content'], message['origin'], timestamp=message['timestamp'])
-                    else:
-                        self.send_new_user_msg(conversationmanager.remove_timestamp(message['content']), message['origin'], timestamp=message['timestamp'])
-                logging.info(f"New web client connection. Sending {len(messages)} messages from conversation.")
+                cursor = int(request.get('cursor', 0))
+                limit = min(int(request.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+                emit("history_page", self.history_page(cursor, limit))
+
+        @self.socketio.on("switch_persona")
+        def handle_switch_persona(name):
+            if self.persona_switcher and not self.persona_switcher(str(name)):
+                self.send_to_client(request.sid, f"<No persona named {name}>", "n/a")
 
         @self.socketio.on('client_user_msg')
         def handle_recv_user_msg(message):
             # TODO preprocess!
             # TODO ``code`` and copy
+            persona_name = check_for_persona_switch(message.strip(".?! \t\n").lower())
+            if persona_name and self.persona_switcher and self.persona_switcher(persona_name):
+                return
             try:
-                gen = self.conversation_manager.get_response(message, origin="web")
-                for chunk in gen:
-                    pass  # messages are automatically sent by the generator (for centralization)
+                # limited per address rather than per connection, so reconnecting doesn't reset the limit
+                scheduled = self.scheduler.submit(self.conversation_manager, message, origin="web",
+                                                  client=request.remote_addr or request.sid)
+            except RateLimitedError as e:
+                logging.warning(f"Rejected web message: {e}")
+                self.send_to_client(request.sid, "<Too many messages, please wait a moment>",
+                                    self.conversation_manager.llm_client.model)
+                return
+            # the response is sent to the clients as it streams, so the socket's thread doesn't have to wait for it
+            threading.Thread(target=self._consume, args=(scheduled, self.conversation_manager), daemon=True).start()
+
+    def _consume(self, scheduled, conversation_manager):
+        """
+        Runs a queued web message to the end.
+        """
+        try:
+            for chunk in scheduled:
+                pass  # messages are automatically sent by the generator (for centralization)
 
-            except InvalidInputError:
-                self.send_new_assistant_msg("<Nonsense detected>", self.conversation_manager.llm_client.model)
-            except TimeoutError:
-                pass
+        except InvalidInputError:
+            self.send_new_assistant_msg("<Nonsense detected>", conversation_manager.llm_client.model)
+        except TimeoutError:
+            pass
 
-    def emit_update(self, msg_type, message, origin, timestamp=None):
+    def switch_conversation(self, conversation_manager, persona_names=None):
+        """
+        Shows another persona's conversation. Updates still queued for the previous one are dropped and every client
+        is sent a snapshot of the new one.
+        :param persona_names: Names of the personas that can be switched to.
+        """
+        self.conversation_manager = conversation_manager
+        if persona_names is not None:
+            self.persona_names = persona_names
+        self.streaming_msg = None
+        with self.outboxes_lock:
+            outboxes = list(self.outboxes.values())
+        for outbox in outboxes:
+            outbox.resync()
+        self.socketio.emit("personas", self.personas())
+        self.frame_ready.set()
+
+    def personas(self):
+        """
+        :return: Dictionary with the name of the active persona and the names of the personas that can be switched to.
+        """
+        active = self.conversation_manager.persona.name if self.conversation_manager else None
+        return {"active": active, "available": self.persona_names or [active]}
+
+    def history_snapshot(self):
+        """
+        :return: Compressed page with the most recent messages, and the number of messages in it. The messages come
+        from the in-memory conversation, which is the end of the on-disk history.
+        """
+        messages = self.conversation_manager.conversation[-SNAPSHOT_SIZE:]
+        cursor = max(0, self.conversation_manager.history_length() - len(messages))
+        return compress_page(messages, cursor), len(messages)
+
+    def history_page(self, cursor, limit):
+        """
+        :return: Compressed page with up to 'limit' messages before the cursor, read from the on-disk history.
         """
+        start = max(0, cursor - limit)
+        return compress_page(self.conversation_manager.load_history(start, cursor), start)
 
+    def emit_update(self, msg_type, message, origin, timestamp=None):
+        """
+        Queues an update for every connected client. Doesn't wait for the clients; see _flush_frames().
         :param msg_type: 'user_msg', 'assistant_msg', or 'assistant_append' depending on whether it is a whole user
         messages, the first chunk of an assistant message, or a subsequent chunk of an assistant message
         :param message:
@@ -78,8 +187,65 @@ class WebService(metaclass=SingletonMeta):
 
         if timestamp is None:
             timestamp = time.time()
-        if message is not None:
-            self.socketio.emit('server_chat_msg', {"msg_type": msg_type, "message": message, "origin": origin, "timestamp": timestamp})
+        if message is None:
+            return
+        update = {"msg_type": msg_type, "message": message, "origin": origin, "timestamp": timestamp}
+        if msg_type == 'assistant_msg':
+            self.streaming_msg = update
+        elif msg_type == 'assistant_append' and self.streaming_msg:
+            self.streaming_msg = {**self.streaming_msg, "message": self.streaming_msg['message'] + message}
+
+        with self.outboxes_lock:
+            outboxes = list(self.outboxes.values())
+        for outbox in outboxes:
+            outbox.put(update)
+        self.frame_ready.set()
+
+    def _flush_frames(self):
+        """
+        Sends each client its queued updates as one 'server_chat_frame' event, at most every flush_interval seconds.
+        A client is only sent a new frame once it has acknowledged the earlier ones, so a slow client gets fewer,
+        bigger frames instead of a backlog. A client whose outbox overflowed gets a history snapshot instead.
+        """
+        while True:
+            self.frame_ready.wait()
+            time.sleep(self.flush_interval)  # let more chunks arrive so they are sent together
+            self.frame_ready.clear()
+            with self.outboxes_lock:
+                outboxes = list(self.outboxes.values())
+            for outbox in outboxes:
+                taken = outbox.take()
+                if taken is None:
+                    continue
+                updates, needs_resync = taken
+                frame = {"updates": updates}
+                if needs_resync:
+                    frame = self.resync_frame()
+                    if outbox.fell_behind:
+                        outbox.fell_behind = False
+                        logging.warning(f"Web client {outbox.sid} fell behind; resyncing it after {outbox.dropped} "
+                                        f"dropped updates.")
+                try:
+                    self.socketio.emit("server_chat_frame", frame, to=outbox.sid,
+                                       callback=lambda *args, acked=outbox: self._frame_acknowledged(acked))
+                except Exception as e:
+                    logging.warning(f"Error sending frame to web client {outbox.sid}: {e}")
+
+    def _frame_acknowledged(self, outbox):
+        if outbox.acknowledge():
+            self.frame_ready.set()
+
+    def resync_frame(self):
+        """
+        :return: Frame with a history snapshot, plus the assistant message being streamed if it isn't in the
+        conversation yet.
+        """
+        if not self.conversation_manager:
+            return {"updates": []}
+        snapshot, _ = self.history_snapshot()
+        conversation = self.conversation_manager.conversation
+        streaming = self.streaming_msg and conversation and conversation[-1]['role'] == Role.USER
+        return {"snapshot": snapshot, "updates": [self.streaming_msg] if streaming else []}
 
     def send_new_user_msg(self, message, origin, timestamp=None):
         self.emit_update('user_msg', message, origin, timestamp=timestamp)
@@ -90,6 +256,16 @@ class WebService(metaclass=SingletonMeta):
     def append_assistant_msg(self, message):
         self.emit_update('assistant_append', message, origin="n/a")
 
+    def send_to_client(self, sid, message, origin):
+        """
+        Sends an assistant message to one client only, e.g., to tell it its message was rejected.
+        """
+        with self.outboxes_lock:
+            outbox = self.outboxes.get(sid)
+        if outbox:
+            outbox.put({"msg_type": 'assistant_msg', "message": message, "origin": origin, "timestamp": time.time()})
+            self.frame_ready.set()
+
     def run_threaded(self):
         t = threading.Thread(target=self.run)
         t.daemon = True
@@ -99,6 +275,27 @@ class WebService(metaclass=SingletonMeta):
         self.socketio.run(self.app, host='0.0.0.0', port=PORT)
 
 
+def client_message(message):
+    """
+    Converts a conversation message into the fields of a chat update.
+    """
+    if message['role'] == Role.ASSISTANT:
+        return {"msg_type": "assistant_msg", "message": message['content'], "origin": message['origin'],
+                "timestamp": message['timestamp']}
+    return {"msg_type": "user_msg", "message": conversationmanager.remove_timestamp(message['content']),
+            "origin": message['origin'], "timestamp": message['timestamp']}
+
+
+def compress_page(messages, cursor):
+    """
+    :param cursor: Index of the first message in the full history. The client sends it back to load older messages;
+    0 means there are none.
+    :return: zlib-compressed json, decompressed in the browser with DecompressionStream("deflate").
+    """
+    page = {"cursor": cursor, "messages": [client_message(message) for message in messages]}
+    return zlib.compress(json.dumps(page).encode())
+
+
 if __name__ == "__main__":
     server = WebService()
     server.run_threaded()